@@ -4,18 +4,34 @@ import boto3
 from botocore.config import Config
 from PIL import Image
 from utils import invoke_bedrock_agent
-from utils import read_agent_response
+from utils import cached_answer_session_state
 from utils import enable_artifacts_download
-from utils import retrieve_environment_variables
+from config import retrieve_environment_variables
 from utils import save_conversation
-from utils import invoke_bedrock_model_streaming
+from utils import model_router
 from layout import create_tabs, create_option_tabs, welcome_sidebar, login_page
 from styles import apply_styles
+from stream_renderer import StreamRenderer
+from rate_limiter import call_with_rate_limit
 from cost_estimate_widget import generate_cost_estimates
 from generate_arch_widget import generate_arch
 from generate_cdk_widget import generate_cdk
 from generate_cfn_widget import generate_cfn
 from generate_doc_widget import generate_doc
+from concurrent_generation import CONCURRENT_GENERATION
+from concurrent_generation import generate_artifacts_concurrently
+from concurrent_generation import ARTIFACT_GENERATORS
+from speculative_generation import SPECULATIVE_GENERATION
+from speculative_generation import start_speculation
+from generation_jobs import generation_jobs
+from generation_jobs import run_generation
+from starter_answers import STARTER_QUESTIONS
+from starter_answers import starter_answer_store
+from semantic_cache import semantic_cache
+from session_artifacts import append_message
+from session_artifacts import set_messages
+from conversation_resume import can_resume
+from conversation_resume import resume_conversation
 import io
 
 # Streamlit configuration 
@@ -24,15 +40,16 @@ apply_styles()
 
 # Initialize AWS clients
 AWS_REGION = os.getenv("AWS_REGION")
-config = Config(read_timeout=1000, retries=dict(max_attempts=5))
-bedrock_client = boto3.client('bedrock-runtime', region_name=AWS_REGION, config=config)
+# Point the Bedrock clients at a local stand-in such as fake_bedrock.py
+BEDROCK_ENDPOINT_URL = os.getenv("BEDROCK_ENDPOINT_URL")
+# Throttles are retried by call_with_rate_limit, not stacked under botocore's own retries
+config = Config(read_timeout=1000, retries=dict(max_attempts=1, mode="standard"))
+bedrock_client = boto3.client('bedrock-runtime', region_name=AWS_REGION, config=config,
+                              endpoint_url=BEDROCK_ENDPOINT_URL)
 s3_client = boto3.client('s3', region_name=AWS_REGION)
-sts_client = boto3.client('sts', region_name=AWS_REGION)
 dynamodb_resource = boto3.resource('dynamodb', region_name=AWS_REGION)
 
-ACCOUNT_ID = sts_client.get_caller_identity()["Account"]
 # Constants
-BEDROCK_MODEL_ID = f"arn:aws:bedrock:{AWS_REGION}:{ACCOUNT_ID}:inference-profile/us.anthropic.claude-3-5-sonnet-20241022-v2:0"  # noqa
 CONVERSATION_TABLE_NAME = retrieve_environment_variables("CONVERSATION_TABLE_NAME")
 FEEDBACK_TABLE_NAME = retrieve_environment_variables("FEEDBACK_TABLE_NAME")
 SESSION_TABLE_NAME = retrieve_environment_variables("SESSION_TABLE_NAME")
@@ -73,30 +90,39 @@ def get_image_insights(image_data, query="Explain in detail the architecture flo
             {"text": query}
         ]}
     ]
-    try:
+    model_id = model_router.model_for("image_insight")
+    output_placeholder = st.empty()
+    renderer = StreamRenderer(
+        output_placeholder,
+        render=lambda text: output_placeholder.markdown(f"<div class='wrapped-text'>{text}</div>", unsafe_allow_html=True))  # noqa
+
+    # The stream is read inside the rate limited call, so throttles raised mid-stream are retried too
+    def stream_insights(model_id, max_tokens):
         streaming_response = bedrock_client.converse_stream(
-            modelId=BEDROCK_MODEL_ID,
+            modelId=model_id,
             messages=messages,
-            inferenceConfig={"maxTokens": 2000, "temperature": 0.1, "topP": 0.9}
+            inferenceConfig={"maxTokens": max_tokens, "temperature": 0.1, "topP": 0.9}
         )
-
-        full_response = ""
-        output_placeholder = st.empty()
+        renderer.reset()
         for chunk in streaming_response["stream"]:
             if "contentBlockDelta" in chunk:
-                text = chunk["contentBlockDelta"]["delta"]["text"]
-                full_response += text
-                output_placeholder.markdown(f"<div class='wrapped-text'>{full_response}</div>", unsafe_allow_html=True)
+                renderer.write(chunk["contentBlockDelta"]["delta"]["text"])
+            elif "messageStop" in chunk:
+                renderer.close()
+
+    try:
+        model_router.call(
+            "image_insight", lambda model_id, max_tokens: call_with_rate_limit(stream_insights, model_id, max_tokens))
+        full_response = renderer.text()
         output_placeholder.write("")
 
-        if 'mod_messages' not in st.session_state:
-            st.session_state.mod_messages = []
-        st.session_state.mod_messages.append({"role": "assistant", "content": full_response})
+        append_message("mod_messages", {"role": "assistant", "content": full_response})
         st.session_state.interaction.append({"type": "Architecture details", "details": full_response})
-        save_conversation(st.session_state['conversation_id'], prompt, full_response)
+        save_conversation(
+            st.session_state['conversation_id'], prompt, full_response, "image_insight", "mod_messages")
 
     except Exception as e:
-        st.error(f"ERROR: Can't invoke '{BEDROCK_MODEL_ID}'. Reason: {e}")
+        st.error(f"ERROR: Can't invoke '{model_id}'. Reason: {e}")
 
 
 # Reset the chat history in session state
@@ -108,7 +134,10 @@ def reset_chat():
     for key in keys_to_remove:
         del st.session_state[key]
 
-    st.session_state.messages = []
+    set_messages("messages", [])
+
+
+WELCOME_MESSAGES = [{"role": "assistant", "content": "Welcome to DevGenius — turning ideas into reality. Together, we’ll design your architecture and solution, with each conversation shaping your vision. Let’s get started on building!"}]  # noqa
 
 
 # Reset the chat history in session state
@@ -116,14 +145,28 @@ def reset_messages():
     # st.session_state['conversation_id'] = str(uuid.uuid4())
 
     initial_question = get_initial_question(st.session_state.topic_selector)
-    st.session_state.messages = [{"role": "assistant", "content": "Welcome to DevGenius — turning ideas into reality. Together, we’ll design your architecture and solution, with each conversation shaping your vision. Let’s get started on building!"}]
+    set_messages("messages", list(WELCOME_MESSAGES))
 
     if initial_question:
-        st.session_state.messages.append({"role": "user", "content": initial_question})
-        response = invoke_bedrock_agent(st.session_state.conversation_id, initial_question)
-        event_stream = response['completion']
-        ask_user, agent_answer = read_agent_response(event_stream)
-        st.session_state.messages.append({"role": "assistant", "content": agent_answer})
+        append_message("messages", {"role": "user", "content": initial_question})
+        # Serve the precomputed answer when there is one, and hand the exchange to the agent with the next prompt
+        agent_answer = starter_answer_store.get(initial_question)
+        if agent_answer is not None:
+            st.session_state.agent_session_state = cached_answer_session_state(initial_question, agent_answer)
+        else:
+            agent_answer = invoke_bedrock_agent(st.session_state.conversation_id, initial_question).answer
+            starter_answer_store.put(initial_question, agent_answer)
+        append_message("messages", {"role": "assistant", "content": agent_answer})
+
+
+# Show which orchestration step the agent is in until its answer starts streaming
+def show_agent_progress(progress_placeholder, orchestration_trace):
+    if 'rationale' in orchestration_trace:
+        progress_placeholder.caption("Reasoning about your request...")
+    elif 'knowledgeBaseLookupInput' in orchestration_trace.get('invocationInput', {}):
+        progress_placeholder.caption("Searching the knowledge base...")
+    elif orchestration_trace.get('observation', {}).get('type') in ("FINISH", "ASK_USER"):
+        progress_placeholder.caption("Writing the answer...")
 
 
 # Function to format assistant's response for markdown
@@ -132,10 +175,7 @@ def format_for_markdown(response_text):
 
 
 def get_initial_question(topic):
-    return {
-        "Data Lake": "How can I build an enterprise data lake on AWS?",
-        "Log Analytics": "How can I build a log analytics solution on AWS?"
-    }.get(topic, "")
+    return STARTER_QUESTIONS.get(topic, "")
 
 
 # Function to compress or resize image if it exceeds 5MB
@@ -185,6 +225,18 @@ else:
     with tabs[0]:
         st.header("Generate Architecture Diagram and Solution")
 
+        # Rebuild a conversation requested from the sidebar instead of generating it again
+        resume_conversation_id = st.session_state.pop("resume_conversation_id", None)
+        if resume_conversation_id:
+            if can_resume(resume_conversation_id, st.session_state.get('user_email')):
+                generation_jobs.cancel_conversation(st.session_state.conversation_id)
+                reset_chat()
+                st.session_state.conversation_id = resume_conversation_id
+                st.session_state.topic_selector = ""
+                resume_conversation(resume_conversation_id, WELCOME_MESSAGES)
+                st.rerun()
+            st.error("This conversation can only be resumed by the signed in user who started it.")
+
         if "topic_selector" not in st.session_state:
             st.session_state.topic_selector = ""
             reset_messages()
@@ -210,6 +262,7 @@ else:
         prompt = st.chat_input(key='Generate')
 
         if prompt:
+            st.session_state.resumed_artifacts = False
 
             # when the user refines the solution , reset checkbox of all tabs
             # and force user to re-check to generate updated solution
@@ -218,24 +271,46 @@ else:
             st.session_state.cdk = False
             st.session_state.cfn = False
             st.session_state.doc = False
+            # Running generations, speculative ones included, were made for the previous answer
+            generation_jobs.cancel_conversation(st.session_state.conversation_id)
 
             st.chat_message("user").markdown(prompt)
-            st.session_state.messages.append({"role": "user", "content": prompt})
+            append_message("messages", {"role": "user", "content": prompt})
 
             with st.chat_message("assistant"):
-                with st.spinner("Thinking..."):
-                    response = invoke_bedrock_agent(st.session_state.conversation_id, prompt)
-                    event_stream = response['completion']
-                    ask_user, agent_answer = read_agent_response(event_stream)
+                # Near-duplicates of earlier first questions are answered from the semantic cache
+                first_turn = sum(1 for message in st.session_state.messages if message["role"] == "user") == 1
+                cached_answer, query_embedding = semantic_cache.lookup(prompt) if first_turn else (None, None)
+                if cached_answer:
+                    ask_user, agent_answer = cached_answer["ask_user"], cached_answer["answer"]
                     st.markdown(agent_answer)
-
-            st.session_state.messages.append({"role": "assistant", "content": agent_answer})
+                    st.session_state.agent_session_state = cached_answer_session_state(prompt, agent_answer)
+                else:
+                    progress_placeholder = st.empty()
+                    progress_placeholder.caption("Thinking...")
+                    # Render the answer progressively as the chunks arrive
+                    agent_stream = invoke_bedrock_agent(
+                        st.session_state.conversation_id, prompt,
+                        session_state=st.session_state.pop("agent_session_state", None),
+                        renderer=StreamRenderer(st.empty()),
+                        on_trace=lambda trace: show_agent_progress(progress_placeholder, trace))
+                    progress_placeholder.empty()
+                    ask_user, agent_answer = agent_stream.ask_user, agent_stream.answer
+                    if first_turn:
+                        semantic_cache.store(prompt, query_embedding, agent_answer, ask_user)
+
+            append_message("messages", {"role": "assistant", "content": agent_answer})
 
             # Check if we have reached the number of questions
             if not ask_user:
                 st.session_state.interaction.append(
                     {"type": "Details", "details": st.session_state.messages[-1]['content']})
                 devgenius_option_tabs = create_option_tabs()
+                if CONCURRENT_GENERATION:
+                    generate_artifacts_concurrently(
+                        st.session_state.conversation_id, st.session_state.messages, devgenius_option_tabs)
+                elif SPECULATIVE_GENERATION:
+                    start_speculation(st.session_state.conversation_id, st.session_state.messages, ARTIFACT_GENERATORS)
                 with devgenius_option_tabs[0]:
                     generate_cost_estimates(st.session_state.messages)
                 with devgenius_option_tabs[1]:
@@ -250,6 +325,21 @@ else:
 
             save_conversation(st.session_state['conversation_id'], prompt, agent_answer)
 
+        # Artifacts of a resumed conversation are rendered from session state until the next prompt
+        elif st.session_state.get("resumed_artifacts"):
+            devgenius_option_tabs = create_option_tabs()
+            with devgenius_option_tabs[0]:
+                generate_cost_estimates(st.session_state.messages)
+            with devgenius_option_tabs[1]:
+                generate_arch(st.session_state.messages)
+            with devgenius_option_tabs[2]:
+                generate_cdk(st.session_state.messages)
+            with devgenius_option_tabs[3]:
+                generate_cfn(st.session_state.messages)
+            with devgenius_option_tabs[4]:
+                generate_doc(st.session_state.messages)
+            enable_artifacts_download()
+
     # Tab for "Generate Solution from Existing Architecture"
     with tabs[1]:
         st.header("Generate Solution from Existing Architecture")
@@ -302,21 +392,6 @@ else:
         if 'mod_messages' not in st.session_state:
             st.session_state.mod_messages = []
 
-        if 'generate_arch_called' not in st.session_state:
-            st.session_state.generate_arch_called = False
-
-        if 'generate_cost_estimates_called' not in st.session_state:
-            st.session_state.generate_cost_estimates_called = False
-
-        if 'generate_cdk_called' not in st.session_state:
-            st.session_state.generate_cdk_called = False
-
-        if 'generate_cfn_called' not in st.session_state:
-            st.session_state.generate_cfn_called = False
-
-        if 'generate_doc_called' not in st.session_state:
-            st.session_state.generate_doc_called = False
-
         # Display chat history
         for msg in st.session_state.mod_messages:
             if msg["role"] == "user":
@@ -329,41 +404,23 @@ else:
         # Trigger actions for generating solution
         if uploaded_file:
             devgenius_option_tabs = create_option_tabs()
+            # Artifacts of the current conversation version are rendered from session state without Bedrock calls
             with devgenius_option_tabs[0]:
-                if not st.session_state.generate_cost_estimates_called:
-                    generate_cost_estimates(st.session_state.mod_messages)
-                    st.session_state.generate_cost_estimates_called = True
+                generate_cost_estimates(st.session_state.mod_messages, history="mod_messages")
             with devgenius_option_tabs[1]:
-                if not st.session_state.generate_arch_called:
-                    generate_arch(st.session_state.mod_messages)
-                    st.session_state.generate_arch_called = True
-
+                generate_arch(st.session_state.mod_messages, history="mod_messages")
             with devgenius_option_tabs[2]:
-                if not st.session_state.generate_cdk_called:
-                    generate_cdk(st.session_state.mod_messages)
-                    st.session_state.generate_cdk_called = True
-
+                generate_cdk(st.session_state.mod_messages, history="mod_messages")
             with devgenius_option_tabs[3]:
-                if not st.session_state.generate_cfn_called:
-                    generate_cfn(st.session_state.mod_messages)
-                    st.session_state.generate_cfn_called = True
-
+                generate_cfn(st.session_state.mod_messages, history="mod_messages")
             with devgenius_option_tabs[4]:
-                if not st.session_state.generate_doc_called:
-                    generate_doc(st.session_state.mod_messages)
-                    st.session_state.generate_doc_called = True
+                generate_doc(st.session_state.mod_messages, history="mod_messages")
 
             if st.session_state.interaction:
                 enable_artifacts_download()
 
         # Handle new chat input
         if prompt := st.chat_input():
-            st.session_state.generate_arch_called = False
-            st.session_state.generate_cdk_called = False
-            st.session_state.generate_cfn_called = False
-            st.session_state.generate_cost_estimates_called = False
-            st.session_state.generate_doc_called = False
-
             # when the user refines the solution , reset checkbox of all tabs
             # and force user to re-check to generate updated solution
             st.session_state.cost = False
@@ -372,15 +429,17 @@ else:
             st.session_state.cfn = False
             st.session_state.doc = False
 
-            st.session_state.mod_messages.append({"role": "user", "content": prompt})
+            append_message("mod_messages", {"role": "user", "content": prompt})
             st.chat_message("user").markdown(prompt)
 
             with st.chat_message("assistant"):
                 with st.spinner("Thinking..."):
-                    response = invoke_bedrock_model_streaming(st.session_state.mod_messages)
+                    response = run_generation(
+                        st.session_state['conversation_id'], "chat", st.session_state.mod_messages)
                     st.session_state.interaction.append({"type": "Architecture details", "details": response})
                     st.markdown(f"<div class='wrapped-text'>{response}</div>", unsafe_allow_html=True)
 
-            st.session_state.mod_messages.append({"role": "assistant", "content": response[0]})
-            save_conversation(st.session_state['conversation_id'], prompt, response[0])
+            append_message("mod_messages", {"role": "assistant", "content": response[0]})
+            save_conversation(
+                st.session_state['conversation_id'], prompt, response[0], "modify", "mod_messages")
             st.rerun()
@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from config import retrieve_environment_variables
+
+AWS_REGION = os.getenv("AWS_REGION")
+# Generated artifacts are uploaded to S3 in the background, keyed by their content hash
+ARTIFACT_UPLOAD_WORKERS = int(os.getenv("ARTIFACT_UPLOAD_WORKERS", "4"))
+ARTIFACT_UPLOAD_MAX_ATTEMPTS = int(os.getenv("ARTIFACT_UPLOAD_MAX_ATTEMPTS", "4"))
+ARTIFACT_UPLOAD_BACKOFF_SECONDS = float(os.getenv("ARTIFACT_UPLOAD_BACKOFF_SECONDS", "0.5"))
+# Conversations whose manifest and uploaded keys are kept in memory
+ARTIFACT_STORE_MAX_CONVERSATIONS = int(os.getenv("ARTIFACT_STORE_MAX_CONVERSATIONS", "1000"))
+# Longest wait for a conversation's pending uploads before zipping its artifacts
+ARTIFACT_FLUSH_TIMEOUT_SECONDS = float(os.getenv("ARTIFACT_FLUSH_TIMEOUT_SECONDS", "30"))
+
+MANIFEST_NAME = "manifest.json"
+
+s3_client = boto3.client('s3', region_name=AWS_REGION, config=Config(retries=dict(max_attempts=5)))
+
+
+class ConversationArtifacts:
+    """Manifest and pending uploads of one conversation."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.manifest_lock = threading.Lock()
+        self.manifest = None  # loaded from S3 by the first upload
+        self.manifest_sequences = {}  # artifact type -> sequence of the artifact in the manifest
+        self.keys = set()  # artifact keys known to be in S3
+        self.pending = set()
+        self.sequence = 0
+
+
+class ArtifactStore:
+    """Content addressed artifact uploads with a per-conversation manifest of the latest artifact per type.
+
+    The manifest (<conversation_id>/manifest.json) maps each artifact type to its key, hash, size and upload time.
+    """
+
+    def __init__(self, workers, max_attempts, backoff_seconds, max_conversations):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="artifact-upload")
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_conversations = max_conversations
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+        self.uploaded = 0
+        self.skipped = 0
+        self.failed = 0
+        self.retries = 0
+
+    def _conversation(self, conversation_id):
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+            if conversation is None:
+                conversation = self._conversations[conversation_id] = ConversationArtifacts()
+                for evicted_id in list(self._conversations)[:-self.max_conversations]:
+                    if not self._conversations[evicted_id].pending:
+                        del self._conversations[evicted_id]
+            self._conversations.move_to_end(conversation_id)
+            return conversation
+
+    def put(self, conversation_id, content_type, content):
+        """Upload an artifact in the background and return its key.
+
+        An artifact whose key (content type and content hash) was uploaded before is not uploaded again.
+        """
+        body = content.encode("utf-8")
+        digest = hashlib.sha256(body).hexdigest()
+        # The .md suffix keeps the artifact in the conversation's download zip
+        key = f"{conversation_id}/{content_type}-{digest[:16]}.md"
+        conversation = self._conversation(conversation_id)
+        with conversation.lock:
+            conversation.sequence += 1
+            sequence = conversation.sequence
+            known = key in conversation.keys
+        future = self.executor.submit(
+            self._upload, conversation_id, conversation, content_type, key, body, digest, sequence, known)
+        with conversation.lock:
+            conversation.pending.add(future)
+        future.add_done_callback(lambda done: self._done(conversation, done))
+        return key
+
+    def _done(self, conversation, future):
+        with conversation.lock:
+            conversation.pending.discard(future)
+
+    def _upload(self, conversation_id, conversation, content_type, key, body, digest, sequence, known):
+        bucket = retrieve_environment_variables("S3_BUCKET_NAME")
+        try:
+            if known or self._exists(bucket, key):
+                with self._lock:
+                    self.skipped += 1
+            else:
+                self._with_retries(lambda: s3_client.put_object(
+                    Body=body, Bucket=bucket, Key=key, ContentType="text/markdown; charset=utf-8"))
+                with self._lock:
+                    self.uploaded += 1
+            with conversation.lock:
+                conversation.keys.add(key)
+            self._update_manifest(bucket, conversation_id, conversation, content_type, {
+                "key": key,
+                "sha256": digest,
+                "size": len(body),
+                "updated_at": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+            }, sequence)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            print(f"Artifact upload of {key} failed: {str(e)}")
+
+    def _exists(self, bucket, key):
+        try:
+            s3_client.head_object(Bucket=bucket, Key=key)
+            return True
+        except ClientError:
+            return False
+
+    def _with_retries(self, operation):
+        for attempt in range(self.max_attempts):
+            try:
+                return operation()
+            except ClientError:
+                if attempt == self.max_attempts - 1:
+                    raise
+                with self._lock:
+                    self.retries += 1
+                time.sleep(self.backoff_seconds * 2 ** attempt)
+
+    def _update_manifest(self, bucket, conversation_id, conversation, content_type, entry, sequence):
+        manifest_key = f"{conversation_id}/{MANIFEST_NAME}"
+        # Manifest updates of a conversation are serialized, and an upload finishing late never replaces the
+        # entry of an artifact generated after it
+        with conversation.manifest_lock:
+            if conversation.manifest is None:
+                conversation.manifest = self._read_manifest(bucket, manifest_key)
+            if conversation.manifest_sequences.get(content_type, 0) > sequence:
+                return
+            conversation.manifest_sequences[content_type] = sequence
+            conversation.manifest["artifacts"][content_type] = entry
+            conversation.manifest["updated_at"] = entry["updated_at"]
+            body = json.dumps(conversation.manifest, indent=2)
+            self._with_retries(lambda: s3_client.put_object(
+                Body=body, Bucket=bucket, Key=manifest_key, ContentType="application/json"))
+
+    def _read_manifest(self, bucket, manifest_key):
+        try:
+            response = s3_client.get_object(Bucket=bucket, Key=manifest_key)
+            return json.loads(response['Body'].read())
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ("404", "NoSuchKey"):
+                raise
+            return {"artifacts": {}, "updated_at": None}
+
+    def flush(self, conversation_id, timeout=ARTIFACT_FLUSH_TIMEOUT_SECONDS):
+        """Wait for the pending uploads of a conversation. Returns False on timeout."""
+        conversation = self._conversation(conversation_id)
+        with conversation.lock:
+            pending = list(conversation.pending)
+        _, not_done = wait(pending, timeout=timeout)
+        return not not_done
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "uploaded": self.uploaded,
+                "skipped": self.skipped,
+                "failed": self.failed,
+                "retries": self.retries,
+                "pending": sum(len(conversation.pending) for conversation in self._conversations.values()),
+            }
+
+
+artifact_store = ArtifactStore(
+    ARTIFACT_UPLOAD_WORKERS, ARTIFACT_UPLOAD_MAX_ATTEMPTS, ARTIFACT_UPLOAD_BACKOFF_SECONDS,
+    ARTIFACT_STORE_MAX_CONVERSATIONS)
@@ -0,0 +1,371 @@
+"""Replay recorded Bedrock event streams through the streaming decode path, without network access.
+
+Usage:
+    python bench_stream_replay.py                      # synthetic 1k/10k/100k token recordings
+    python bench_stream_replay.py --recordings DIR     # replay model-*.jsonl / agent-*.jsonl recordings
+    python bench_stream_replay.py --update-baseline    # store the results as the new baseline
+    python bench_stream_replay.py record --prompt "..." --output recordings/model-custom.jsonl
+    python bench_stream_replay.py record --agent --prompt "..." --output recordings/agent-custom.jsonl
+
+Recordings are JSON lines. Model stream events are {"chunk": {"bytes": "<base64>"}}, agent stream events
+are either {"chunk": {"bytes": "<base64>"}} or {"trace": {...}} as returned by invoke_agent.
+"""
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import contextlib
+from pathlib import Path
+from unittest import mock
+
+# Keep the limiter, the response cache and the prompt cache breakpoint out of the measurements
+os.environ.setdefault("BEDROCK_RATE_LIMIT_INITIAL", "1000000")
+os.environ.setdefault("BEDROCK_RATE_LIMIT_MAX", "1000000")
+os.environ.setdefault("BEDROCK_RATE_LIMIT_BURST", "1000000")
+os.environ.setdefault("RESPONSE_CACHE_ENABLED", "false")
+os.environ.setdefault("BEDROCK_PROMPT_CACHING", "false")
+os.environ.setdefault("AWS_REGION", "us-east-1")
+# Agent trace records are still built, but written nowhere
+os.environ.setdefault("AGENT_TRACE_SINK", "file")
+os.environ.setdefault("AGENT_TRACE_FILE", os.devnull)
+
+BASELINE_PATH = Path(__file__).with_name("bench_baseline.json")
+TOKEN_SIZES = {"1k": 1000, "10k": 10000, "100k": 100000}
+# Average characters per streamed delta, close to what Claude emits
+CHARS_PER_DELTA = 12
+# Timings below this are mostly scheduling noise and are not compared against the baseline
+BASELINE_MIN_SECONDS = 0.001
+# Deltas streamed between two polls of render_job, about 80 tokens per second at its 0.25 s interval
+JOB_POLL_DELTAS = 7
+
+
+class StubClient:
+    """Stands in for every boto3 client and resource created at import time."""
+
+    def __init__(self, *args, **kwargs):
+        self.model_events = []
+        self.agent_events = []
+
+    def get_caller_identity(self):
+        return {"Account": "000000000000"}
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        return {"body": iter(self.model_events)}
+
+    def invoke_agent(self, **kwargs):
+        return {"completion": iter(self.agent_events)}
+
+    def __getattr__(self, name):
+        return mock.MagicMock(name=name)
+
+
+class CountingPlaceholder:
+    """Placeholder that records what would be sent over the Streamlit websocket."""
+
+    def __init__(self):
+        self.updates = 0
+        self.bytes_sent = 0
+
+    def markdown(self, text, **kwargs):
+        self.updates += 1
+        self.bytes_sent += len(text.encode("utf-8"))
+
+
+def _encode(payload):
+    return {"chunk": {"bytes": base64.b64encode(json.dumps(payload).encode("utf-8")).decode("ascii")}}
+
+
+def synthesize_model_recording(tokens):
+    """Model stream of roughly the given number of output tokens."""
+    deltas = max(1, tokens * 4 // CHARS_PER_DELTA)
+    events = [
+        _encode({"type": "message_start", "message": {"usage": {"input_tokens": 2000, "output_tokens": 1}}}),
+        _encode({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}),
+    ]
+    for index in range(deltas):
+        text = "lorem ipsum\n" if index % 20 == 19 else "lorem ipsum "
+        events.append(_encode(
+            {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": text}}))
+    events += [
+        _encode({"type": "content_block_stop", "index": 0}),
+        _encode({"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": tokens}}),
+        _encode({"type": "message_stop", "amazon-bedrock-invocationMetrics": {
+            "inputTokenCount": 2000, "outputTokenCount": tokens, "invocationLatency": 0, "firstByteLatency": 0}}),
+    ]
+    return events
+
+
+def _trace(orchestration_trace):
+    return {"trace": {"agentId": "AGENT", "agentAliasId": "ALIAS", "sessionId": "session",
+                      "trace": {"orchestrationTrace": orchestration_trace}}}
+
+
+def synthesize_agent_recording(tokens):
+    """Agent stream with orchestration traces followed by the answer in chunks."""
+    events = []
+    for step in range(5):
+        trace_id = f"trace-{step}"
+        events.append(_trace({"rationale": {"traceId": trace_id, "text": "Searching the knowledge base " * 20}}))
+        events.append(_trace({"modelInvocationInput": {
+            "traceId": trace_id, "text": "prompt " * 2000, "type": "ORCHESTRATION"}}))
+        events.append(_trace({"observation": {
+            "traceId": trace_id, "type": "KNOWLEDGE_BASE",
+            "knowledgeBaseLookupOutput": {"retrievedReferences": [{"content": {"text": "ref " * 300}}] * 5}}}))
+    events.append(_trace({"observation": {
+        "traceId": "trace-final", "type": "FINISH", "finalResponse": {"text": "done"}}}))
+    answer = ("lorem ipsum " * (tokens * 4 // 12 + 1)).encode("utf-8")
+    chunk_size = 4096
+    for offset in range(0, len(answer), chunk_size):
+        events.append({"chunk": {"bytes": base64.b64encode(answer[offset:offset + chunk_size]).decode("ascii")}})
+    return events
+
+
+def load_recording(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _decode_events(events):
+    # Recordings store bytes as base64, the live event stream hands out raw bytes
+    decoded = []
+    for event in events:
+        if 'chunk' in event:
+            decoded.append({"chunk": dict(event['chunk'], bytes=base64.b64decode(event['chunk']['bytes']))})
+        else:
+            decoded.append(event)
+    return decoded
+
+
+def _best_of(repeat, function):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def bench_model_stream(utils, stub, events, repeat):
+    from stream_renderer import StreamRenderer
+
+    raw_chunks = [event['chunk']['bytes'] for event in events]
+    deltas = [json.loads(raw.decode("utf-8")) for raw in raw_chunks]
+    texts = [d["delta"].get("text", "") for d in deltas if d.get("type") == "content_block_delta"]
+
+    def decode():
+        for raw in raw_chunks:
+            json.loads(raw.decode("utf-8"))
+
+    def accumulate_concat():
+        result = ""
+        for text in texts:
+            result += text
+        return result
+
+    def accumulate_join():
+        chunks = []
+        for text in texts:
+            chunks.append(text)
+        return ''.join(chunks)
+
+    def stream(renderer_factory):
+        def run():
+            stub.model_events = list(events)
+            utils.stream_bedrock_model([{"role": "user", "content": "benchmark"}], bypass_cache=True,
+                                       renderer=renderer_factory())
+        return run
+
+    per_token = CountingPlaceholder()
+    coalesced = CountingPlaceholder()
+    decode_s = _best_of(repeat, decode)
+    results = {
+        "events": len(events),
+        "decode_s": decode_s,
+        "decode_per_event_us": decode_s / len(events) * 1e6,
+        "accumulate_concat_s": _best_of(repeat, accumulate_concat),
+        "accumulate_join_s": _best_of(repeat, accumulate_join),
+        "stream_no_render_s": _best_of(repeat, stream(lambda: None)),
+        "stream_per_token_render_s": _best_of(
+            repeat, stream(lambda: StreamRenderer(per_token, interval=0, flush_bytes=0))),
+        "stream_coalesced_render_s": _best_of(repeat, stream(lambda: StreamRenderer(coalesced))),
+    }
+    results["per_token_render_bytes"] = per_token.bytes_sent // repeat
+    results["coalesced_render_bytes"] = coalesced.bytes_sent // repeat
+    results["coalesced_render_updates"] = coalesced.updates // repeat
+    return results
+
+
+def bench_job_render(events, repeat):
+    """Replay a model stream into a generation job, polling it the way render_job does."""
+    from stream_renderer import StreamRenderer
+    from generation_jobs import GenerationJob
+    from generation_jobs import JobView
+
+    deltas = [json.loads(event['chunk']['bytes'].decode("utf-8")) for event in events]
+    texts = [d["delta"].get("text", "") for d in deltas if d.get("type") == "content_block_delta"]
+    placeholder = CountingPlaceholder()
+
+    def run():
+        job = GenerationJob(("conversation", "chat", "benchmark"), [], {}, True)
+        # Polls are counted in deltas rather than waited for. As in the coalesced model benchmark, the replay is
+        # faster than the render interval, so only the renderer's size threshold triggers updates.
+        view = JobView(job, StreamRenderer(placeholder))
+        job.reset()
+        for index, text in enumerate(texts, 1):
+            job.write(text)
+            if index % JOB_POLL_DELTAS == 0:
+                view.update()
+        view.update()
+        # render_job empties the placeholder once the job is done, the renderer's final flush is what remains
+        view.renderer.close()
+
+    results = {"job_render_s": _best_of(repeat, run)}
+    results["job_render_bytes"] = placeholder.bytes_sent // repeat
+    results["job_render_updates"] = placeholder.updates // repeat
+    return results
+
+
+def bench_agent_stream(utils, events, repeat):
+    def run():
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            utils.read_agent_response(iter(events))
+
+    return {"events": len(events), "read_agent_response_s": _best_of(repeat, run)}
+
+
+def import_utils_with_stub():
+    stub = StubClient()
+    with mock.patch("boto3.client", return_value=stub), mock.patch("boto3.resource", return_value=stub):
+        sys.path.insert(0, str(Path(__file__).parent))
+        import utils
+    utils.bedrock_client = stub
+    utils.bedrock_agent_runtime_client = stub
+    return utils, stub
+
+
+def run_benchmarks(recordings_dir, repeat):
+    utils, stub = import_utils_with_stub()
+    results = {}
+    if recordings_dir:
+        for path in sorted(Path(recordings_dir).glob("model-*.jsonl")):
+            events = _decode_events(load_recording(path))
+            results[path.stem] = bench_model_stream(utils, stub, events, repeat)
+            results[path.stem].update(bench_job_render(events, repeat))
+        for path in sorted(Path(recordings_dir).glob("agent-*.jsonl")):
+            results[path.stem] = bench_agent_stream(utils, _decode_events(load_recording(path)), repeat)
+    else:
+        for label, tokens in TOKEN_SIZES.items():
+            events = _decode_events(synthesize_model_recording(tokens))
+            results[f"model-{label}"] = bench_model_stream(utils, stub, events, repeat)
+            results[f"model-{label}"].update(bench_job_render(events, repeat))
+            results[f"agent-{label}"] = bench_agent_stream(
+                utils, _decode_events(synthesize_agent_recording(tokens)), repeat)
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Return (name, metric, baseline, current) for every timing that regressed beyond the tolerance."""
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            previous = baseline.get(name, {}).get(metric)
+            if not previous or (metric.endswith("_s") and previous < BASELINE_MIN_SECONDS):
+                continue
+            if metric.endswith(("_s", "_us", "_bytes")) and value > previous * (1 + tolerance):
+                regressions.append((name, metric, previous, value))
+    return regressions
+
+
+def _record_event(event):
+    if 'chunk' in event:
+        return {"chunk": {"bytes": base64.b64encode(event['chunk']['bytes']).decode("ascii")}}
+    if 'trace' in event:
+        return {"trace": event['trace']}
+    return None
+
+
+def record(prompt, output, agent=False):
+    """Record a live model stream, or an agent stream with its traces, to a JSON lines file for later replay."""
+    import uuid
+    import boto3
+    from utils import model_router
+    from config import retrieve_environment_variables
+
+    if agent:
+        client = boto3.client('bedrock-agent-runtime', region_name=os.getenv("AWS_REGION"))
+        response = client.invoke_agent(
+            inputText=prompt,
+            agentId=retrieve_environment_variables("BEDROCK_AGENT_ID"),
+            agentAliasId=retrieve_environment_variables("BEDROCK_AGENT_ALIAS_ID"),
+            enableTrace=True,
+            sessionId=str(uuid.uuid4()),
+        )
+        events = response['completion']
+    else:
+        client = boto3.client('bedrock-runtime', region_name=os.getenv("AWS_REGION"))
+        route = model_router.route("chat")
+        body = {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": route.max_tokens,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": 0,
+        }
+        response = client.invoke_model_with_response_stream(
+            body=json.dumps(body), modelId=route.model_id, contentType='application/json', accept='application/json')
+        events = response['body']
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        for event in events:
+            recorded = _record_event(event)
+            if recorded is not None:
+                # Traces hold datetimes, which are replayed as strings
+                f.write(json.dumps(recorded, default=str))
+                f.write("\n")
+    print(f"Recorded stream to {output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", nargs="?", default="run", choices=["run", "record"])
+    parser.add_argument("--recordings", help="directory with model-*.jsonl and agent-*.jsonl recordings")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    parser.add_argument("--baseline", default=str(BASELINE_PATH))
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--prompt", help="prompt to record (record command)")
+    parser.add_argument("--output", help="recording file to write (record command)")
+    parser.add_argument("--agent", action="store_true",
+                        help="record an agent stream with its traces instead of a model stream (record command)")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args.prompt, args.output, agent=args.agent)
+        return 0
+
+    results = run_benchmarks(args.recordings, args.repeat)
+    for name, metrics in results.items():
+        print(name)
+        for metric, value in metrics.items():
+            print(f"    {metric:32} {value:.6f}" if isinstance(value, float) else f"    {metric:32} {value}")
+
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline found, run with --update-baseline to create one")
+        return 0
+
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+    for name, metric, previous, value in regressions:
+        print(f"REGRESSION {name}.{metric}: {previous:.6f} -> {value:.6f}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
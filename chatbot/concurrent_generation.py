@@ -0,0 +1,55 @@
+import os
+import time
+import streamlit as st
+from generation_jobs import generation_jobs
+from generation_jobs import DONE
+from generation_jobs import JobView
+from stream_renderer import StreamRenderer
+from stream_renderer import STREAM_RENDER_INTERVAL_SECONDS
+from cost_estimate_widget import build_cost_request
+from generate_arch_widget import build_arch_request
+from generate_cdk_widget import build_cdk_request
+from generate_cfn_widget import build_cfn_request
+from generate_doc_widget import build_doc_request
+
+CONCURRENT_GENERATION = os.getenv("CONCURRENT_GENERATION", "false").lower() == "true"
+
+# (task and checkbox key, request builder, generation options) in the order of the option tabs
+ARTIFACT_GENERATORS = [
+    ("cost", build_cost_request, {}),
+    ("arch", build_arch_request, {"enable_reasoning": True}),
+    ("cdk", build_cdk_request, {}),
+    ("cfn", build_cfn_request, {}),
+    ("doc", build_doc_request, {}),
+]
+
+
+# Generate all artifacts at once, streaming each one into its own option tab
+def generate_artifacts_concurrently(conversation_id, messages, option_tabs):
+    jobs = []
+    for (task, build_request, options), tab in zip(ARTIFACT_GENERATORS, option_tabs):
+        _, request_messages = build_request(messages[:])
+        job = generation_jobs.submit(conversation_id, task, request_messages, **options)
+        with tab:
+            placeholder = st.empty()
+        jobs.append((job, placeholder, JobView(job, StreamRenderer(placeholder))))
+
+    # The jobs run on the shared job executor; render their new output until all are done
+    rendering = list(jobs)
+    while rendering:
+        for job, placeholder, view in list(rendering):
+            done = job.done
+            view.update()
+            if done:
+                view.renderer.close()
+                rendering.remove((job, placeholder, view))
+        if rendering:
+            time.sleep(STREAM_RENDER_INTERVAL_SECONDS)
+
+    for job, placeholder, _ in jobs:
+        placeholder.empty()
+        if job.status == DONE:
+            # Select the checkbox so the widget renders the finished job
+            st.session_state[job.task] = True
+        else:
+            print(f"Error occurred when generating {job.task} concurrently: {str(job.error)}")
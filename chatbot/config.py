@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import threading
+import boto3
+from botocore.config import Config
+
+AWS_REGION = os.getenv("AWS_REGION")
+# Secrets are served from memory for this long, then refreshed in the background
+SECRET_CACHE_TTL_SECONDS = int(os.getenv("SECRET_CACHE_TTL_SECONDS", "900"))
+# After a failed refresh the last good value is served, and the refresh is retried after this many seconds
+SECRET_REFRESH_RETRY_SECONDS = int(os.getenv("SECRET_REFRESH_RETRY_SECONDS", "30"))
+
+secrets_client = boto3.client('secretsmanager', region_name=AWS_REGION, config=Config(retries=dict(max_attempts=5)))
+
+
+class CachedValue:
+    """A value loaded on first use and kept for ttl seconds.
+
+    Once expired, the cached value is still served while a background thread reloads it. A failed reload keeps
+    the last good value. Only the first load, when there is no good value yet, raises to the caller.
+    """
+
+    def __init__(self, name, loader, ttl, retry_after=SECRET_REFRESH_RETRY_SECONDS):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self._value = None
+        self._expires_at = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self.loads = 0
+        self.errors = 0
+
+    def get(self):
+        if self._expires_at is None:
+            with self._lock:
+                if self._expires_at is None:
+                    self._value = self.loader()
+                    self._expires_at = time.monotonic() + self.ttl
+                    self.loads += 1
+            return self._value
+        if time.monotonic() > self._expires_at:
+            self._refresh_in_background()
+        return self._value
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                value = self.loader()
+                self._value = value
+                self._expires_at = time.monotonic() + self.ttl
+                self.loads += 1
+            except Exception as e:
+                self.errors += 1
+                self._expires_at = time.monotonic() + self.retry_after
+                print(f"Refreshing {self.name} failed, serving the last good value: {str(e)}")
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name="config-refresh", daemon=True).start()
+
+
+# Resource names come from the SSM parameter passed in as an environment variable, which never changes
+# while the process runs
+resource_names = CachedValue(
+    "AWS_RESOURCE_NAMES_PARAMETER", lambda: json.loads(os.getenv("AWS_RESOURCE_NAMES_PARAMETER")), float("inf"))
+
+_secrets = {}
+_secrets_lock = threading.Lock()
+
+
+def retrieve_environment_variables(key):
+    return resource_names.get()[key]
+
+
+def retrieve_secret(secret_id):
+    with _secrets_lock:
+        if secret_id not in _secrets:
+            _secrets[secret_id] = CachedValue(
+                secret_id,
+                lambda: json.loads(secrets_client.get_secret_value(SecretId=secret_id)['SecretString']),
+                SECRET_CACHE_TTL_SECONDS)
+    return _secrets[secret_id].get()
+
+
+def retrieve_cognito_details(key):
+    return retrieve_secret(retrieve_environment_variables("COGNITO_SECRET_ID"))[key]
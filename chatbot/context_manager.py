@@ -0,0 +1,214 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from utils import bedrock_client
+from utils import model_router
+from rate_limiter import call_with_rate_limit
+
+# How widget inputs are fitted to their token budget: "summarize" older turns, "truncate" them, or "none"
+CONTEXT_POLICY = os.getenv("CONTEXT_POLICY", "summarize").lower()
+# Number of most recent messages always kept verbatim
+CONTEXT_KEEP_LATEST_MESSAGES = int(os.getenv("CONTEXT_KEEP_LATEST_MESSAGES", "6"))
+# Repeated assistant answers at least this long are sent once when the history is over budget
+CONTEXT_DEDUP_MIN_CHARS = int(os.getenv("CONTEXT_DEDUP_MIN_CHARS", "500"))
+CONTEXT_SUMMARY_CACHE_SIZE = 256
+CHARS_PER_TOKEN = 4
+
+# Input budget (in tokens) of the conversation history sent with each widget instruction
+WIDGET_INPUT_TOKEN_BUDGETS = {
+    "cost": 24000,
+    "arch": 32000,
+    "cdk": 32000,
+    "cfn": 32000,
+    "doc": 32000,
+}
+WIDGET_INPUT_TOKEN_BUDGETS.update(json.loads(os.getenv("WIDGET_INPUT_TOKEN_BUDGETS", "{}")))
+
+SUMMARY_PROMPT = """
+    Summarize the conversation below between a user and an AWS solutions architect assistant.
+    Keep every requirement, constraint, decision, AWS service and configuration detail that was agreed on,
+    so the summary can replace the conversation when generating architecture, code, cost estimates and documentation.
+    Respond only with the summary.
+
+    <CONVERSATION>
+    {conversation}
+    </CONVERSATION>
+"""
+
+REPEATED_ANSWER_NOTE = "(Same answer as given later in the conversation.)"
+
+_summaries = OrderedDict()
+_summary_lock = threading.Lock()
+# Summaries being generated, so concurrent calls for the same messages make one Bedrock call
+_pending_summaries = {}
+
+
+def estimate_tokens(content):
+    if not isinstance(content, str):
+        content = json.dumps(content, default=str)
+    return len(content) // CHARS_PER_TOKEN + 1
+
+
+def estimate_messages_tokens(messages):
+    return sum(estimate_tokens(message['content']) for message in messages)
+
+
+def _content_key(message):
+    return json.dumps(message['content'], sort_keys=True, default=str)
+
+
+def deduplicate_messages(messages):
+    """Drop repeated (user, assistant) turns, keeping the latest occurrence.
+
+    A repeated assistant answer of at least CONTEXT_DEDUP_MIN_CHARS characters is replaced by a short note. User
+    turns are never dropped on their own, so repeated short answers such as "yes" stay in the history.
+    """
+    turns = []
+    index = 0
+    while index < len(messages):
+        if messages[index]['role'] == "user" and index + 1 < len(messages) \
+                and messages[index + 1]['role'] == "assistant":
+            turns.append(messages[index:index + 2])
+            index += 2
+        else:
+            turns.append(messages[index:index + 1])
+            index += 1
+
+    seen_turns = set()
+    seen_answers = set()
+    deduplicated = []
+    for turn in reversed(turns):
+        key = tuple((message['role'], _content_key(message)) for message in turn)
+        if len(turn) == 2 and key in seen_turns:
+            continue
+        seen_turns.add(key)
+        turn = list(turn)
+        answer = turn[-1]
+        if answer['role'] == "assistant" and isinstance(answer['content'], str) \
+                and len(answer['content']) >= CONTEXT_DEDUP_MIN_CHARS:
+            if answer['content'] in seen_answers:
+                turn[-1] = {"role": "assistant", "content": REPEATED_ANSWER_NOTE}
+            seen_answers.add(answer['content'])
+        deduplicated.extend(reversed(turn))
+    return list(reversed(deduplicated))
+
+
+def merge_consecutive_roles(messages):
+    """Merge adjacent messages of the same role so user and assistant turns keep alternating."""
+    merged = []
+    for message in messages:
+        if merged and merged[-1]['role'] == message['role'] \
+                and isinstance(merged[-1]['content'], str) and isinstance(message['content'], str):
+            merged[-1] = {"role": message['role'], "content": f"{merged[-1]['content']}\n\n{message['content']}"}
+        else:
+            merged.append(message)
+    return merged
+
+
+def _prefix_hashes(messages):
+    # Rolling hash of every prefix, so a summary of older turns is reused as the conversation grows
+    digest = hashlib.sha256()
+    hashes = []
+    for message in messages:
+        digest.update(json.dumps(message, sort_keys=True, default=str).encode("utf-8"))
+        hashes.append(digest.copy().hexdigest())
+    return hashes
+
+
+def _invoke_summary(transcript):
+    def invoke(model_id, max_tokens):
+        body = {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": max_tokens,
+            "messages": [{"role": "user", "content": SUMMARY_PROMPT.format(conversation=transcript)}],
+            "temperature": 0,
+        }
+        response = call_with_rate_limit(
+            bedrock_client.invoke_model,
+            body=json.dumps(body),
+            modelId=model_id,
+            contentType='application/json',
+            accept='application/json'
+        )
+        return json.loads(response['body'].read())
+
+    result = model_router.call("summary", invoke)
+    return ''.join(block.get("text", "") for block in result['content'])
+
+
+def summarize_messages(messages):
+    """Summarize messages once, extending the cached summary of the longest already summarized prefix.
+
+    The Bedrock call is made outside the lock. Concurrent calls for the same messages wait for the first one.
+    """
+    hashes = _prefix_hashes(messages)
+    with _summary_lock:
+        if hashes[-1] in _summaries:
+            _summaries.move_to_end(hashes[-1])
+            return _summaries[hashes[-1]]
+        pending = _pending_summaries.get(hashes[-1])
+        if pending is None:
+            _pending_summaries[hashes[-1]] = Future()
+
+            previous_summary = None
+            start = 0
+            for index in range(len(hashes) - 2, -1, -1):
+                if hashes[index] in _summaries:
+                    previous_summary = _summaries[hashes[index]]
+                    start = index + 1
+                    break
+    if pending is not None:
+        return pending.result()
+
+    transcript = []
+    if previous_summary:
+        transcript.append(f"Summary of the earlier conversation: {previous_summary}")
+    for message in messages[start:]:
+        content = message['content'] if isinstance(message['content'], str) else json.dumps(message['content'])
+        transcript.append(f"{message['role']}: {content}")
+
+    try:
+        summary = _invoke_summary('\n\n'.join(transcript))
+    except Exception as e:
+        with _summary_lock:
+            _pending_summaries.pop(hashes[-1]).set_exception(e)
+        raise
+    with _summary_lock:
+        _summaries[hashes[-1]] = summary
+        while len(_summaries) > CONTEXT_SUMMARY_CACHE_SIZE:
+            _summaries.popitem(last=False)
+        _pending_summaries.pop(hashes[-1]).set_result(summary)
+    return summary
+
+
+def fit_to_budget(messages, widget):
+    """Return the conversation history for a widget call, fitted to the widget's input token budget."""
+    if CONTEXT_POLICY == "none":
+        return messages
+
+    budget = WIDGET_INPUT_TOKEN_BUDGETS.get(widget)
+    if budget is None or estimate_messages_tokens(messages) <= budget:
+        return messages
+    messages = deduplicate_messages(messages)
+    if estimate_messages_tokens(messages) <= budget:
+        return merge_consecutive_roles(messages)
+
+    keep_count = max(1, CONTEXT_KEEP_LATEST_MESSAGES)
+    older, latest = messages[:-keep_count], messages[-keep_count:]
+
+    summary_messages = []
+    if older and CONTEXT_POLICY == "summarize":
+        try:
+            summary = summarize_messages(older)
+            summary_messages = [{"role": "user", "content": f"Summary of the earlier conversation:\n{summary}"}]
+        except Exception as e:
+            print(f"Error occurred when summarizing the conversation, truncating instead: {str(e)}")
+
+    # Drop the oldest of the latest turns until the history fits
+    while len(latest) > 1 and estimate_messages_tokens(summary_messages + latest) > budget:
+        latest = latest[1:]
+
+    return merge_consecutive_roles(summary_messages + latest)
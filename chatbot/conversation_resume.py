@@ -0,0 +1,85 @@
+import os
+import streamlit as st
+from dynamodb import persistence
+from payload_store import payload_store
+from session_artifacts import append_message
+from session_artifacts import put_artifact
+from session_artifacts import set_messages
+
+# Conversation items read per Query page. Small pages show the first turns sooner.
+RESUME_PAGE_SIZE = int(os.getenv("RESUME_PAGE_SIZE", "20"))
+
+# Transcript sections of the artifacts, as written by the widgets
+ARTIFACT_SECTIONS = {
+    "cost": "Cost Analysis",
+    "arch": "Solution Architecture",
+    "cdk": "CDK Template",
+    "cfn": "CloudFormation Template",
+    "doc": "Technical documentation",
+}
+
+
+def can_resume(conversation_id, user_email):
+    """Only the user a session was recorded for can resume its conversation."""
+    if not user_email:
+        return False
+    return persistence.session_owner(conversation_id) == user_email
+
+
+def resume_conversation(conversation_id, welcome_messages):
+    """Rebuild messages, interaction and the generated artifacts of a conversation from the conversation table.
+
+    Turns are rendered page by page as they are read. Offloaded artifacts stay pointers until a widget renders them.
+    """
+    set_messages("messages", list(welcome_messages))
+    st.session_state.interaction = []
+    artifacts = {}
+    final_answer = None
+    restored = skipped = 0
+    with st.status("Restoring your conversation...", expanded=True) as status:
+        for page in persistence.query_conversation(conversation_id, RESUME_PAGE_SIZE):
+            for item in page:
+                interaction_type = item.get('interaction_type')
+                # Turns saved before interaction types were recorded can't be told apart from widget prompts
+                if interaction_type is None:
+                    skipped += 1
+                    continue
+                restored += 1
+                history = item.get('history', "messages")
+                if interaction_type in ARTIFACT_SECTIONS:
+                    # The answer before the first artifact is the final solution the artifacts were made from
+                    if final_answer is not None:
+                        st.session_state.interaction.append({"type": "Details", "details": final_answer})
+                        final_answer = None
+                    artifacts[(history, interaction_type)] = item['assistant_response']
+                    st.session_state.interaction.append(
+                        {"type": ARTIFACT_SECTIONS[interaction_type], "details": item['assistant_response']})
+                    st.caption(f"Restored {ARTIFACT_SECTIONS[interaction_type].lower()}")
+                    continue
+
+                # A later turn of the same history makes its earlier artifacts outdated
+                artifacts = {key: artifact for key, artifact in artifacts.items() if key[0] != history}
+                answer = payload_store.text(item['assistant_response'])
+                if interaction_type != "image_insight":
+                    prompt = payload_store.text(item['user_response'])
+                    append_message(history, {"role": "user", "content": prompt})
+                    st.chat_message("user").markdown(prompt)
+                append_message(history, {"role": "assistant", "content": answer})
+                st.chat_message("assistant").markdown(answer)
+                if interaction_type == "agent":
+                    final_answer = answer
+                else:
+                    st.session_state.interaction.append({"type": "Architecture details", "details": answer})
+            status.update(label=f"Restoring your conversation... {restored} turns")
+
+        # Artifacts belong to the restored version of their history
+        for (history, task), artifact in artifacts.items():
+            put_artifact(history, task, artifact)
+            if history == "messages":
+                st.session_state[task] = True
+        st.session_state.resumed_artifacts = any(history == "messages" for history, _ in artifacts)
+
+        label = f"Restored {restored} turns"
+        if skipped:
+            label += f", {skipped} older turns could not be restored"
+        status.update(label=label, state="complete", expanded=False)
@@ -1,55 +1,389 @@
 import boto3
 import os
+import time
 import uuid
+import queue
+import atexit
 import datetime
-from utils import retrieve_environment_variables
+import threading
+from collections import deque
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+from config import retrieve_environment_variables
+from payload_store import payload_store
+from usage_stats import percentile
+
+# Conversation, session and feedback writes are queued and written behind the request by a background worker
+DYNAMODB_WRITE_BEHIND = os.getenv("DYNAMODB_WRITE_BEHIND", "true").lower() == "true"
+DYNAMODB_WRITE_QUEUE_SIZE = int(os.getenv("DYNAMODB_WRITE_QUEUE_SIZE", "1000"))
+# How long a caller waits on a full queue before writing synchronously itself
+DYNAMODB_WRITE_BLOCK_SECONDS = float(os.getenv("DYNAMODB_WRITE_BLOCK_SECONDS", "1"))
+# How often the idle worker gives a caller on a full queue the chance to take over the writes
+DYNAMODB_WORKER_POLL_SECONDS = 0.5
+# Attempts of a batch, retrying unprocessed items with exponential backoff
+DYNAMODB_WRITE_MAX_ATTEMPTS = int(os.getenv("DYNAMODB_WRITE_MAX_ATTEMPTS", "6"))
+DYNAMODB_WRITE_BACKOFF_SECONDS = float(os.getenv("DYNAMODB_WRITE_BACKOFF_SECONDS", "0.1"))
+# Pending writes are flushed on shutdown for at most this long
+DYNAMODB_FLUSH_TIMEOUT_SECONDS = float(os.getenv("DYNAMODB_FLUSH_TIMEOUT_SECONDS", "10"))
+# Session table index of the sessions of a user (session_user), sorted by session_start_time. session_user is set
+# with the summary at the first prompt, so sessions without a prompt stay out of the sparse index.
+SESSION_USER_INDEX_NAME = os.getenv("SESSION_USER_INDEX_NAME", "session_user-session_start_time-index")
+# The first prompt of a session, cut to this length, is its summary in the session history
+SESSION_SUMMARY_MAX_CHARS = int(os.getenv("SESSION_SUMMARY_MAX_CHARS", "120"))
+
+# BatchWriteItem accepts at most 25 put requests
+BATCH_WRITE_MAX_ITEMS = 25
+# Errors a batch write is retried on. Any other error is caused by the items, which are then written one by one.
+RETRYABLE_ERRORS = {
+    "ProvisionedThroughputExceededException", "ThrottlingException", "RequestLimitExceeded", "InternalServerError"}
+LAG_WINDOW = 1000
+
+
+def _now():
+    return datetime.datetime.now(tz=datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+_uuid_lock = threading.Lock()
+_uuid_last_ms = 0
+_uuid_sequence = 0
+
+
+def _time_ordered_uuid():
+    # UUIDv7: the millisecond timestamp comes first, followed by a sequence number for ids created in the same
+    # millisecond, so the sort keys of a conversation follow the order its turns were saved in
+    global _uuid_last_ms, _uuid_sequence
+    with _uuid_lock:
+        ms = max(time.time_ns() // 1_000_000, _uuid_last_ms)
+        _uuid_sequence = _uuid_sequence + 1 if ms == _uuid_last_ms else 0
+        if _uuid_sequence > 0xfff:
+            ms, _uuid_sequence = ms + 1, 0
+        _uuid_last_ms = ms
+        sequence = _uuid_sequence
+    value = ms << 80 | 0x7 << 76 | sequence << 64 | 0x2 << 62 | int.from_bytes(os.urandom(8), "big") >> 2
+    return str(uuid.UUID(int=value))
 
 
 class DynanmoPersistance():
-    def __init__(self):
+    """Single entry point for the DynamoDB writes of the app.
+
+    Writes are queued in order and drained by a background worker. Puts are grouped into BatchWriteItem
+    calls, updates are applied one by one in queue order. Writes are dequeued and written under _write_lock, so a
+    caller writing synchronously on a full queue waits for the batch in flight and writes the queued writes
+    before its own, and every item keeps the order of its writes.
+    """
+
+    def __init__(self, write_behind=DYNAMODB_WRITE_BEHIND, queue_size=DYNAMODB_WRITE_QUEUE_SIZE,
+                 block_seconds=DYNAMODB_WRITE_BLOCK_SECONDS, max_attempts=DYNAMODB_WRITE_MAX_ATTEMPTS,
+                 backoff_seconds=DYNAMODB_WRITE_BACKOFF_SECONDS):
         AWS_REGION = os.getenv("AWS_REGION")
         self.dynamodb_resource = boto3.resource('dynamodb', region_name=AWS_REGION)
-        self.CONVERSATION_TABLE_NAME = retrieve_environment_variables("CONVERSATION_TABLE_NAME")
-        self.FEEDBACK_TABLE_NAME = retrieve_environment_variables("FEEDBACK_TABLE_NAME")
-        self.SESSION_TABLE_NAME = retrieve_environment_variables("SESSION_TABLE_NAME")
-        self.S3_BUCKET_NAME = retrieve_environment_variables("S3_BUCKET_NAME")
+        self.write_behind = write_behind
+        self.block_seconds = block_seconds
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._worker = None
+        self.enqueued = 0
+        self.written = 0
+        self.failed = 0
+        self.retries = 0
+        self.batches = 0
+        self.sync_writes = 0
+        self.lags = deque(maxlen=LAG_WINDOW)
+
+    @property
+    def CONVERSATION_TABLE_NAME(self):
+        return retrieve_environment_variables("CONVERSATION_TABLE_NAME")
+
+    @property
+    def FEEDBACK_TABLE_NAME(self):
+        return retrieve_environment_variables("FEEDBACK_TABLE_NAME")
+
+    @property
+    def SESSION_TABLE_NAME(self):
+        return retrieve_environment_variables("SESSION_TABLE_NAME")
 
     # Store conversation details in DynamoDB
-    def save_session(self, conversation_id, name, email):
+    def save_session(self, conversation_id, name, email, **attributes):
         item = {
             'conversation_id': conversation_id,
             'user_name': name,
             'user_email': email,
-            'session_start_time': datetime.datetime.now(tz=datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+            **attributes,
+            'session_start_time': _now()
         }
-        self.dynamodb_resource.Table(self.SESSION_TABLE_NAME).put_item(Item=item)
+        # Attributes DynamoDB would store as NULL are left out
+        item = {key: value for key, value in item.items() if value is not None}
+        self._submit({"table": self.SESSION_TABLE_NAME, "item": item})
+        return item
 
     # Store conversation details in DynamoDB
-    def save_conversation(self, conversation_id, prompt, response):
+    def save_conversation(self, conversation_id, prompt, response, interaction_type="agent", history="messages"):
         item = {
             'conversation_id': conversation_id,
-            'uuid': str(uuid.uuid4()),
+            'uuid': _time_ordered_uuid(),
             'user_response': prompt,
             'assistant_response': response,
-            'conversation_time': datetime.datetime.now(tz=datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+            # What produced the turn (agent, modify, image_insight or an artifact task) and the message history
+            # it belongs to, so the conversation can be resumed
+            'interaction_type': interaction_type,
+            'history': history,
+            'conversation_time': _now()
         }
-        self.dynamodb_resource.Table(self.CONVERSATION_TABLE_NAME).put_item(Item=item)
+        self._submit({"table": self.CONVERSATION_TABLE_NAME, "item": item,
+                      "offload": ['user_response', 'assistant_response']})
+
+    # Store feedback in DynamoDB
+    def save_feedback(self, item):
+        self._submit({"table": self.FEEDBACK_TABLE_NAME, "item": item, "offload": ['response']})
 
     # Store conversation details in DynamoDB
     def update_session(self, conversation_id, presigned_url):
         # Update dynamodb table with new attribute pre-signed url for existing conversation id
         print(f"presigned_url: {presigned_url}")
-        # Update the item with new attribute
-        response = self.dynamodb_resource.Table(self.SESSION_TABLE_NAME).update_item(
-            Key={
+        self._submit({"table": self.SESSION_TABLE_NAME, "update": {
+            "Key": {
                 'conversation_id': conversation_id
             },
-            UpdateExpression='SET presigned_url = :url, session_update_time = :update_time',
-            ExpressionAttributeValues={
+            "UpdateExpression": 'SET presigned_url = :url, session_update_time = :update_time',
+            "ExpressionAttributeValues": {
                 ':url': presigned_url,
-                ':update_time': datetime.datetime.now(tz=datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+                ':update_time': _now()
+            }
+        }})
+
+    def update_session_summary(self, conversation_id, summary, user_email=None):
+        """Set the summary of a session, unless it has one, and add the session to the index of its user.
+
+        Returns the summary written, or None for an empty one.
+        """
+        summary = " ".join(summary.split())[:SESSION_SUMMARY_MAX_CHARS]
+        if not summary:
+            return None
+        update_expression = 'SET session_summary = if_not_exists(session_summary, :summary)'
+        values = {':summary': summary}
+        if user_email:
+            update_expression += ', session_user = :user'
+            values[':user'] = user_email
+        self._submit({"table": self.SESSION_TABLE_NAME, "update": {
+            "Key": {
+                'conversation_id': conversation_id
             },
-            ReturnValues="UPDATED_NEW"
-        )
+            "UpdateExpression": update_expression,
+            "ExpressionAttributeValues": values
+        }})
+        return summary
+
+    def list_user_sessions(self, user_email, page_size, start_key=None):
+        """Return one page of the sessions of a user, newest first, and the key of the next page (None after the last).
+
+        Items hold conversation_id, session_start_time and session_summary. Writes still queued behind the request
+        are not part of the result.
+        """
+        query = {
+            "IndexName": SESSION_USER_INDEX_NAME,
+            "KeyConditionExpression": Key('session_user').eq(user_email),
+            "ScanIndexForward": False,
+            "Limit": page_size,
+        }
+        if start_key:
+            query["ExclusiveStartKey"] = start_key
+        response = self.dynamodb_resource.Table(self.SESSION_TABLE_NAME).query(**query)
+        return response['Items'], response.get('LastEvaluatedKey')
+
+    def query_conversation(self, conversation_id, page_size):
+        """Yield the items of a conversation in the order they were written, one Query page at a time.
+
+        Writes still queued behind the request are not part of the result.
+        """
+        table = self.dynamodb_resource.Table(self.CONVERSATION_TABLE_NAME)
+        query = {"KeyConditionExpression": Key('conversation_id').eq(conversation_id), "Limit": page_size}
+        while True:
+            response = table.query(**query)
+            yield response['Items']
+            if 'LastEvaluatedKey' not in response:
+                return
+            query["ExclusiveStartKey"] = response['LastEvaluatedKey']
+
+    def session_owner(self, conversation_id):
+        """Email of the user a session was recorded for, or None."""
+        response = self.dynamodb_resource.Table(self.SESSION_TABLE_NAME).get_item(
+            Key={'conversation_id': conversation_id}, ProjectionExpression='user_email')
+        return response.get('Item', {}).get('user_email')
+
+    def _submit(self, write):
+        write["enqueued_at"] = time.monotonic()
+        with self._lock:
+            self.enqueued += 1
+        if not self.write_behind:
+            self._write([write])
+            return
+        self._ensure_worker()
+        try:
+            self.queue.put(write, timeout=self.block_seconds)
+        except queue.Full:
+            # Backpressure: the caller pays for the backlog instead of growing it. The writes queued before its
+            # own go first, so a write never overtakes an earlier write to the same item.
+            with self._write_lock:
+                with self._lock:
+                    self.sync_writes += 1
+                writes = self._drain(self.queue.qsize())
+                try:
+                    for start in range(0, len(writes), BATCH_WRITE_MAX_ITEMS):
+                        self._write(writes[start:start + BATCH_WRITE_MAX_ITEMS])
+                except Exception as e:
+                    print(f"DynamoDB write failed: {str(e)}")
+                finally:
+                    for _ in writes:
+                        self.queue.task_done()
+                self._write([write])
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="dynamodb-writer", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            with self._write_lock:
+                try:
+                    writes = [self.queue.get(timeout=DYNAMODB_WORKER_POLL_SECONDS)]
+                except queue.Empty:
+                    continue
+                writes += self._drain(BATCH_WRITE_MAX_ITEMS - 1)
+                try:
+                    self._write(writes)
+                except Exception as e:
+                    print(f"DynamoDB write failed: {str(e)}")
+                finally:
+                    for _ in writes:
+                        self.queue.task_done()
+
+    def _drain(self, limit):
+        writes = []
+        while len(writes) < limit:
+            try:
+                writes.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return writes
+
+    def _write(self, writes):
+        puts, keys = [], set()
+        for write in writes:
+            if "update" in write:
+                # Keep queue order, an update may depend on a put still in the batch
+                self._batch_write(puts)
+                puts, keys = [], set()
+                self._update(write)
+                continue
+            if write.get("offload"):
+                # Large prompts and responses go to S3 off the request thread, the item keeps a pointer
+                write["item"] = payload_store.offload(
+                    write["item"]["conversation_id"], write["item"], write["offload"])
+            # A batch may not contain the same key twice
+            key = (write["table"], write["item"]["conversation_id"], write["item"].get("uuid"))
+            if key in keys:
+                self._batch_write(puts)
+                puts, keys = [], set()
+            puts.append(write)
+            keys.add(key)
+        self._batch_write(puts)
+
+    def _batch_write(self, puts):
+        if not puts:
+            return
+        request_items = {}
+        for write in puts:
+            request_items.setdefault(write["table"], []).append({"PutRequest": {"Item": write["item"]}})
+
+        attempt = 0
+        failed = 0
+        while request_items:
+            try:
+                response = self.dynamodb_resource.meta.client.batch_write_item(RequestItems=request_items)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in RETRYABLE_ERRORS:
+                    # One invalid item (e.g. over 400 KB) fails the whole batch, write the items one by one so
+                    # only that item is lost
+                    print(f"DynamoDB batch write failed, writing the items one by one: {str(e)}")
+                    failed = self._put_items(request_items)
+                    break
+                print(f"DynamoDB batch write throttled: {str(e)}")
+            else:
+                request_items = response.get('UnprocessedItems') or {}
+                if not request_items:
+                    break
+            attempt += 1
+            if attempt >= self.max_attempts:
+                failed = sum(len(requests) for requests in request_items.values())
+                print(f"Dropping {failed} DynamoDB items after {attempt} attempts")
+                break
+            with self._lock:
+                self.retries += 1
+            time.sleep(self.backoff_seconds * 2 ** (attempt - 1))
+        with self._lock:
+            self.batches += 1
+        self._record(puts, failed)
+
+    def _put_items(self, request_items):
+        failed = 0
+        for table, requests in request_items.items():
+            for request in requests:
+                try:
+                    self.dynamodb_resource.meta.client.put_item(TableName=table, Item=request["PutRequest"]["Item"])
+                except ClientError as e:
+                    print(f"DynamoDB put failed, dropping the item: {str(e)}")
+                    failed += 1
+        return failed
+
+    def _update(self, write):
+        try:
+            self.dynamodb_resource.Table(write["table"]).update_item(**write["update"])
+            self._record([write], 0)
+        except ClientError as e:
+            print(f"DynamoDB update failed: {str(e)}")
+            self._record([write], 1)
+
+    def _record(self, writes, failed):
+        now = time.monotonic()
+        with self._lock:
+            self.written += len(writes) - failed
+            self.failed += failed
+            self.lags.extend(now - write["enqueued_at"] for write in writes)
+
+    def flush(self, timeout=DYNAMODB_FLUSH_TIMEOUT_SECONDS):
+        """Wait until the queued writes are done. Returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    print(f"DynamoDB flush timed out with {self.queue.unfinished_tasks} pending writes")
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def metrics(self):
+        with self._lock:
+            lags = sorted(self.lags)
+            return {
+                "enqueued": self.enqueued,
+                "written": self.written,
+                "failed": self.failed,
+                "retries": self.retries,
+                "batches": self.batches,
+                "sync_writes": self.sync_writes,
+                "queue_depth": self.queue.qsize(),
+                "p50_lag": percentile(lags, 0.5),
+                "p95_lag": percentile(lags, 0.95),
+            }
+
 
-        return response
+persistence = DynanmoPersistance()
+atexit.register(persistence.flush)
@@ -0,0 +1,351 @@
+"""Export the conversation and feedback tables to Parquet for offline analysis.
+
+Usage:
+    python export_tables.py --output exports                         # both tables, 8 segments on 4 processes
+    python export_tables.py --table feedback --segments 32 --workers 16
+    python export_tables.py --endpoint-url http://localhost:8000 \\
+        --conversation-table conversations --feedback-table feedback  # DynamoDB Local or moto server
+
+Each table is read with a parallel Scan, one segment per task on a process pool. Every segment streams its items
+into Parquet files partitioned by day and use case:
+    <output>/<table>/date=YYYY-MM-DD/use_case=<use case>/part-<segment>-<n>.parquet
+Artifact turns of the conversation table get the use case their feedback is recorded under (generate_cdk, ...),
+other turns their interaction type (agent, modify, image_insight). Offloaded prompts and responses are exported
+as their S3 key unless --rehydrate is given.
+
+The aggregates are written to <output>/aggregates/:
+    feedback_by_use_case.parquet   positive and negative feedback and the positive ratio per use case
+    feedback_by_model.parquet      the same per Bedrock model
+    response_sizes.parquet         response size distribution per table and use case
+
+--workers 0 scans the segments in this process, which works with moto's in-process mock_aws.
+Requires pyarrow (pip install pyarrow).
+"""
+import os
+import re
+import sys
+import time
+import argparse
+import multiprocessing
+from array import array
+from decimal import Decimal
+from pathlib import Path
+from collections import OrderedDict
+from collections import defaultdict
+from concurrent.futures import as_completed
+from concurrent.futures import ProcessPoolExecutor
+import boto3
+import numpy as np
+from botocore.config import Config
+from config import retrieve_environment_variables
+from payload_store import payload_store
+from payload_store import is_pointer
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+AWS_REGION = os.getenv("AWS_REGION")
+# Rows are written per partition in row groups of this many rows, or earlier once a segment buffers this much text
+EXPORT_ROWS_PER_GROUP = int(os.getenv("EXPORT_ROWS_PER_GROUP", "5000"))
+EXPORT_GROUP_BYTES = int(os.getenv("EXPORT_GROUP_BYTES", str(64 * 1024 * 1024)))
+# Parquet files a segment keeps open at once
+EXPORT_MAX_OPEN_FILES = int(os.getenv("EXPORT_MAX_OPEN_FILES", "64"))
+
+TABLES = ["conversation", "feedback"]
+
+# Use cases of the artifact turns, as their feedback is recorded by the widgets
+ARTIFACT_USE_CASES = {
+    "cost": "generate_cost",
+    "arch": "generate_architecture",
+    "cdk": "generate_cdk",
+    "cfn": "generate_cfn",
+    "doc": "generate_documentation",
+}
+
+# Text attributes and the response attribute of each table
+TEXT_ATTRIBUTES = {
+    "conversation": ["user_response", "assistant_response"],
+    "feedback": ["response"],
+}
+RESPONSE_ATTRIBUTE = {"conversation": "assistant_response", "feedback": "response"}
+
+SIZE_PERCENTILES = [50, 90, 99]
+
+
+def _schema(table):
+    # date and use_case are partition columns and live in the directory names
+    fields = [("conversation_id", pa.string()), ("uuid", pa.string()), ("conversation_time", pa.string())]
+    if table == "conversation":
+        fields += [("interaction_type", pa.string()), ("history", pa.string())]
+    else:
+        fields += [("bedrock_model", pa.string()), ("feedback", pa.int8()), ("feedback_explanation", pa.string())]
+    for attribute in TEXT_ATTRIBUTES[table]:
+        fields += [(attribute, pa.string()), (f"{attribute}_size", pa.int64()), (f"{attribute}_s3_key", pa.string())]
+    return pa.schema(fields)
+
+
+def _partition_value(value):
+    return re.sub(r"[^A-Za-z0-9._-]", "_", value) or "unknown"
+
+
+def _use_case(table, item):
+    if table == "feedback":
+        return item.get('use_case') or "unknown"
+    interaction_type = item.get('interaction_type')
+    if interaction_type is None:
+        return "unknown"
+    return ARTIFACT_USE_CASES.get(interaction_type, interaction_type)
+
+
+def _row(table, item, rehydrate):
+    row = {
+        "conversation_id": item.get('conversation_id'),
+        "uuid": item.get('uuid'),
+        "conversation_time": item.get('conversation_time'),
+    }
+    if table == "conversation":
+        row["interaction_type"] = item.get('interaction_type')
+        row["history"] = item.get('history')
+    else:
+        row["bedrock_model"] = item.get('bedrock_model')
+        row["feedback"] = int(item['feedback']) if isinstance(item.get('feedback'), Decimal) else None
+        row["feedback_explanation"] = item.get('feedback_explanation')
+    for attribute in TEXT_ATTRIBUTES[table]:
+        value = item.get(attribute)
+        if is_pointer(value):
+            row[f"{attribute}_s3_key"] = value["payload_s3_key"]
+            row[f"{attribute}_size"] = int(value["size"])
+            row[attribute] = payload_store.text(value) if rehydrate else None
+        else:
+            row[f"{attribute}_s3_key"] = None
+            row[f"{attribute}_size"] = len(value.encode("utf-8")) if isinstance(value, str) else None
+            row[attribute] = value if isinstance(value, str) else None
+    return row
+
+
+class SegmentWriter:
+    """Streams the rows of one segment into Parquet files, one open ParquetWriter per partition.
+
+    Rows are buffered per partition and written as a row group once rows_per_group rows are pending, or once the
+    buffered text of the segment reaches group_bytes, so memory stays bounded by about one row group. At most
+    max_open_files writers are kept open, a partition whose writer was closed continues in a new file.
+    """
+
+    def __init__(self, output, table, segment, rows_per_group, group_bytes, max_open_files=EXPORT_MAX_OPEN_FILES):
+        self.output = Path(output) / table
+        self.schema = _schema(table)
+        self.segment = segment
+        self.rows_per_group = rows_per_group
+        self.group_bytes = group_bytes
+        self.max_open_files = max_open_files
+        self.text_attributes = TEXT_ATTRIBUTES[table]
+        self.writers = OrderedDict()
+        self.buffers = defaultdict(list)
+        self.buffered_bytes = defaultdict(int)
+        self.total_buffered_bytes = 0
+        self.files = 0
+
+    def add(self, partition, row):
+        size = sum(len(row[attribute] or "") for attribute in self.text_attributes)
+        self.buffers[partition].append(row)
+        self.buffered_bytes[partition] += size
+        self.total_buffered_bytes += size
+        if len(self.buffers[partition]) >= self.rows_per_group:
+            self._write(partition)
+        while self.total_buffered_bytes >= self.group_bytes:
+            self._write(max(self.buffered_bytes, key=self.buffered_bytes.get))
+
+    def close(self):
+        for partition in list(self.buffers):
+            if self.buffers[partition]:
+                self._write(partition)
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
+
+    def _writer(self, partition):
+        if partition in self.writers:
+            self.writers.move_to_end(partition)
+            return self.writers[partition]
+        if len(self.writers) >= self.max_open_files:
+            _, writer = self.writers.popitem(last=False)
+            writer.close()
+        date, use_case = partition
+        directory = self.output / f"date={date}" / f"use_case={use_case}"
+        directory.mkdir(parents=True, exist_ok=True)
+        writer = pq.ParquetWriter(
+            directory / f"part-{self.segment:04d}-{self.files:05d}.parquet", self.schema, compression="zstd")
+        self.files += 1
+        self.writers[partition] = writer
+        return writer
+
+    def _write(self, partition):
+        rows = pa.Table.from_pylist(self.buffers[partition], schema=self.schema)
+        self._writer(partition).write_table(rows)
+        self.total_buffered_bytes -= self.buffered_bytes.pop(partition)
+        del self.buffers[partition]
+
+
+def export_segment(table, table_name, segment, total_segments, output, endpoint_url=None,
+                   rows_per_group=EXPORT_ROWS_PER_GROUP, group_bytes=EXPORT_GROUP_BYTES, rehydrate=False):
+    """Scan one segment of a table into Parquet files and return its partial aggregates.
+
+    Runs in a worker process, so it creates its own DynamoDB resource.
+    """
+    dynamodb_resource = boto3.resource(
+        'dynamodb', region_name=AWS_REGION, endpoint_url=endpoint_url,
+        config=Config(retries=dict(max_attempts=10, mode="adaptive")))
+    scan = {"Segment": segment, "TotalSegments": total_segments}
+    writer = SegmentWriter(output, table, segment, rows_per_group, group_bytes)
+    feedback_by_use_case = defaultdict(lambda: [0, 0])
+    feedback_by_model = defaultdict(lambda: [0, 0])
+    sizes = defaultdict(lambda: array("q"))
+    items = 0
+    while True:
+        response = dynamodb_resource.Table(table_name).scan(**scan)
+        for item in response['Items']:
+            items += 1
+            use_case = _use_case(table, item)
+            row = _row(table, item, rehydrate)
+            date = (row["conversation_time"] or "")[:10] or "unknown"
+            writer.add((_partition_value(date), _partition_value(use_case)), row)
+
+            size = row[f"{RESPONSE_ATTRIBUTE[table]}_size"]
+            if size is not None:
+                sizes[(table, use_case)].append(size)
+            if table == "feedback" and row["feedback"] in (0, 1):
+                # Streamlit thumbs feedback: 0 is thumbs down, 1 is thumbs up
+                feedback_by_use_case[use_case][row["feedback"]] += 1
+                feedback_by_model[row["bedrock_model"] or "unknown"][row["feedback"]] += 1
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan["ExclusiveStartKey"] = response['LastEvaluatedKey']
+    writer.close()
+    return {
+        "table": table,
+        "segment": segment,
+        "items": items,
+        "files": writer.files,
+        "feedback_by_use_case": dict(feedback_by_use_case),
+        "feedback_by_model": dict(feedback_by_model),
+        "sizes": dict(sizes),
+    }
+
+
+def _feedback_table(counts, key):
+    rows = []
+    for value, (negative, positive) in sorted(counts.items()):
+        total = negative + positive
+        rows.append({key: value, "positive": positive, "negative": negative, "total": total,
+                     "positive_ratio": positive / total if total else None})
+    return pa.Table.from_pylist(rows, schema=pa.schema([
+        (key, pa.string()), ("positive", pa.int64()), ("negative", pa.int64()), ("total", pa.int64()),
+        ("positive_ratio", pa.float64())]))
+
+
+def _sizes_table(sizes):
+    rows = []
+    for (table, use_case), values in sorted(sizes.items()):
+        values = np.frombuffer(values, dtype=np.int64)
+        row = {"table": table, "use_case": use_case, "count": len(values), "mean": float(values.mean()),
+               "max": int(values.max())}
+        for percentile in SIZE_PERCENTILES:
+            row[f"p{percentile}"] = float(np.percentile(values, percentile))
+        rows.append(row)
+    return pa.Table.from_pylist(rows, schema=pa.schema(
+        [("table", pa.string()), ("use_case", pa.string()), ("count", pa.int64()), ("mean", pa.float64()),
+         ("max", pa.int64())] + [(f"p{percentile}", pa.float64()) for percentile in SIZE_PERCENTILES]))
+
+
+def write_aggregates(output, results):
+    feedback_by_use_case = defaultdict(lambda: [0, 0])
+    feedback_by_model = defaultdict(lambda: [0, 0])
+    sizes = defaultdict(lambda: array("q"))
+    for result in results:
+        for merged, partial in ((feedback_by_use_case, result["feedback_by_use_case"]),
+                                (feedback_by_model, result["feedback_by_model"])):
+            for key, (negative, positive) in partial.items():
+                merged[key][0] += negative
+                merged[key][1] += positive
+        for key, values in result["sizes"].items():
+            sizes[key].extend(values)
+
+    directory = Path(output) / "aggregates"
+    directory.mkdir(parents=True, exist_ok=True)
+    pq.write_table(_feedback_table(feedback_by_use_case, "use_case"), directory / "feedback_by_use_case.parquet")
+    pq.write_table(_feedback_table(feedback_by_model, "bedrock_model"), directory / "feedback_by_model.parquet")
+    pq.write_table(_sizes_table(sizes), directory / "response_sizes.parquet")
+
+
+def export_tables(output, tables, table_names, segments=8, workers=4, endpoint_url=None,
+                  rows_per_group=EXPORT_ROWS_PER_GROUP, group_bytes=EXPORT_GROUP_BYTES, rehydrate=False):
+    """Export the tables with a parallel Scan of `segments` segments each and write the aggregates."""
+    for table in tables + ["aggregates"]:
+        directory = Path(output) / table
+        if directory.exists() and any(directory.iterdir()):
+            raise FileExistsError(f"{directory} is not empty, export into a new directory")
+
+    tasks = [(table, table_names[table], segment, segments, output, endpoint_url, rows_per_group, group_bytes,
+              rehydrate)
+             for table in tables for segment in range(segments)]
+    results = []
+    started = time.monotonic()
+    if workers == 0:
+        for task in tasks:
+            results.append(export_segment(*task))
+            _report(results[-1], len(results), len(tasks), started)
+    else:
+        # Worker processes are spawned rather than forked, boto3 clients are not fork safe
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(export_segment, *task) for task in tasks]
+            for future in as_completed(futures):
+                results.append(future.result())
+                _report(results[-1], len(results), len(tasks), started)
+
+    write_aggregates(output, results)
+    return results
+
+
+def _report(result, done, total, started):
+    print(f"[{done}/{total}] {result['table']} segment {result['segment']}: {result['items']} items, "
+          f"{result['files']} files ({time.monotonic() - started:.1f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default="exports")
+    parser.add_argument("--table", action="append", choices=TABLES, help="table to export (default: all)")
+    parser.add_argument("--segments", type=int, default=8, help="parallel Scan segments per table")
+    parser.add_argument("--workers", type=int, default=4, help="worker processes, 0 scans in this process")
+    parser.add_argument("--rows-per-group", type=int, default=EXPORT_ROWS_PER_GROUP, help="rows per Parquet row group")
+    parser.add_argument("--group-bytes", type=int, default=EXPORT_GROUP_BYTES,
+                        help="text bytes after which a row group is written early")
+    parser.add_argument("--endpoint-url", help="DynamoDB endpoint, e.g. DynamoDB Local or a moto server")
+    parser.add_argument("--conversation-table", help="default: CONVERSATION_TABLE_NAME of the deployment")
+    parser.add_argument("--feedback-table", help="default: FEEDBACK_TABLE_NAME of the deployment")
+    parser.add_argument("--rehydrate", action="store_true", help="export offloaded payloads from S3 as text")
+    args = parser.parse_args()
+
+    if pa is None:
+        sys.exit("export_tables.py requires pyarrow: pip install pyarrow")
+    tables = args.table or TABLES
+    table_names = {
+        "conversation": args.conversation_table,
+        "feedback": args.feedback_table,
+    }
+    for table in tables:
+        if table_names[table] is None:
+            table_names[table] = retrieve_environment_variables(f"{table.upper()}_TABLE_NAME")
+
+    results = export_tables(args.output, tables, table_names, args.segments, args.workers, args.endpoint_url,
+                            args.rows_per_group, args.group_bytes, args.rehydrate)
+    for table in tables:
+        items = sum(result["items"] for result in results if result["table"] == table)
+        print(f"{table}: {items} items exported to {Path(args.output) / table}")
+
+
+if __name__ == "__main__":
+    main()
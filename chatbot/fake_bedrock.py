@@ -0,0 +1,419 @@
+"""Local stand-in for bedrock-runtime, bedrock-agent-runtime and sts, for load testing without AWS.
+
+Serves invoke_model, invoke_model_with_response_stream, converse_stream, invoke_agent and
+GetCallerIdentity over HTTP with the AWS event stream encoding, so the regular boto3 clients talk to it.
+
+Usage:
+    python fake_bedrock.py serve --port 8599 --tokens-per-sec 80 --ttft 0.6 --throttle-rate 0.05
+    export BEDROCK_ENDPOINT_URL=http://localhost:8599
+    export AWS_ENDPOINT_URL_STS=http://localhost:8599
+    streamlit run agent.py
+
+    python fake_bedrock.py loadtest --sessions 10 --prompt "Build a serverless data lake"
+"""
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import base64
+import random
+import struct
+import argparse
+import binascii
+import threading
+from urllib.parse import unquote, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_PORT = 8599
+CHARS_PER_TOKEN = 4
+TOKENS_PER_DELTA = 3
+
+ARCHITECTURE_XML = (
+    '<mxfile host="drawio"><diagram name="Architecture"><mxGraphModel><root>'
+    '<mxCell id="0"/><mxCell id="1" parent="0"/>'
+    '<mxCell id="2" value="Amazon S3" style="shape=mxgraph.aws4.s3;" vertex="1" parent="1">'
+    '<mxGeometry x="40" y="40" width="60" height="60" as="geometry"/></mxCell>'
+    '<mxCell id="3" value="AWS Glue" style="shape=mxgraph.aws4.glue;" vertex="1" parent="1">'
+    '<mxGeometry x="200" y="40" width="60" height="60" as="geometry"/></mxCell>'
+    '<mxCell id="4" edge="1" source="2" target="3" parent="1"><mxGeometry relative="1" as="geometry"/></mxCell>'
+    '</root></mxGraphModel></diagram></mxfile>'
+)
+
+CFN_YAML = """AWSTemplateFormatVersion: '2010-09-09'
+Resources:
+  DataBucket:
+    Type: AWS::S3::Bucket
+"""
+
+FILLER = (
+    "The solution ingests data into **Amazon S3**, catalogs it with **AWS Glue** and queries it with "
+    "**Amazon Athena**, following the AWS Well-Architected analytics lens. "
+)
+
+
+def canned_response(tokens):
+    """Deterministic answer of roughly the given number of tokens, valid for every widget parser."""
+    text = f"```xml\n{ARCHITECTURE_XML}\n```\n\n```yaml\n{CFN_YAML}```\n\n"
+    target_chars = tokens * CHARS_PER_TOKEN
+    while len(text) < target_chars:
+        text += FILLER
+    return text
+
+
+# AWS event stream encoding (application/vnd.amazon.eventstream)
+def _encode_headers(headers):
+    encoded = b""
+    for name, value in headers.items():
+        name_bytes = name.encode("utf-8")
+        value_bytes = value.encode("utf-8")
+        encoded += struct.pack("B", len(name_bytes)) + name_bytes
+        encoded += struct.pack("!BH", 7, len(value_bytes)) + value_bytes  # 7 = string
+    return encoded
+
+
+def encode_event(event_type, payload, message_type="event"):
+    headers = {":message-type": message_type, ":content-type": "application/json"}
+    headers[":exception-type" if message_type == "exception" else ":event-type"] = event_type
+    header_bytes = _encode_headers(headers)
+    payload_bytes = json.dumps(payload).encode("utf-8")
+    total_length = 16 + len(header_bytes) + len(payload_bytes)
+    prelude = struct.pack("!II", total_length, len(header_bytes))
+    prelude += struct.pack("!I", binascii.crc32(prelude) & 0xffffffff)
+    message = prelude + header_bytes + payload_bytes
+    return message + struct.pack("!I", binascii.crc32(message) & 0xffffffff)
+
+
+def _b64(payload):
+    return base64.b64encode(json.dumps(payload).encode("utf-8")).decode("ascii")
+
+
+class FakeBedrockSettings:
+    def __init__(self, tokens_per_sec, ttft, throttle_rate, response_tokens, max_output_tokens):
+        self.tokens_per_sec = tokens_per_sec
+        self.ttft = ttft
+        self.throttle_rate = throttle_rate
+        self.response_tokens = response_tokens
+        self.max_output_tokens = max_output_tokens
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.active_streams = 0
+
+
+class FakeBedrockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    settings = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _throttle(self):
+        with self.settings.lock:
+            self.settings.requests += 1
+            throttled = random.random() < self.settings.throttle_rate
+            if throttled:
+                self.settings.throttled += 1
+        if throttled:
+            self._send_json(429, {"message": "Too many requests, please wait before trying again."},
+                            {"x-amzn-ErrorType": "ThrottlingException:"})
+        return throttled
+
+    def _start_stream(self, headers=None):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.amazon.eventstream")
+        self.send_header("Transfer-Encoding", "chunked")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def _write_event(self, event_bytes):
+        self.wfile.write(f"{len(event_bytes):x}\r\n".encode("ascii") + event_bytes + b"\r\n")
+        self.wfile.flush()
+
+    def _end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _generate(self, max_tokens, prefill=""):
+        """Yield text deltas paced by the configured speed, then return the stop reason."""
+        settings = self.settings
+        full_text = canned_response(settings.response_tokens)
+        # Continue a prefilled assistant turn from where it stops
+        offset = len(prefill) if full_text.startswith(prefill) else 0
+        remaining = full_text[offset:]
+        budget = max_tokens * CHARS_PER_TOKEN
+        if settings.max_output_tokens:
+            budget = min(budget, settings.max_output_tokens * CHARS_PER_TOKEN)
+        stop_reason = "end_turn"
+        if len(remaining) > budget:
+            remaining = remaining[:budget]
+            stop_reason = "max_tokens"
+
+        time.sleep(settings.ttft)
+        delta_chars = TOKENS_PER_DELTA * CHARS_PER_TOKEN
+        delay = TOKENS_PER_DELTA / settings.tokens_per_sec if settings.tokens_per_sec else 0
+        for position in range(0, len(remaining), delta_chars):
+            yield remaining[position:position + delta_chars]
+            time.sleep(delay)
+        return stop_reason
+
+    def _stream_with_stop(self, max_tokens, prefill, on_delta):
+        generator = self._generate(max_tokens, prefill)
+        output_tokens = 0
+        while True:
+            try:
+                text = next(generator)
+            except StopIteration as stop:
+                return stop.value, output_tokens
+            output_tokens += max(1, len(text) // CHARS_PER_TOKEN)
+            on_delta(text)
+
+    def _track(self, change):
+        with self.settings.lock:
+            self.settings.active_streams += change
+
+    def do_POST(self):
+        path = unquote(self.path.split("?")[0])
+        body = self._read_body()
+        try:
+            if match := re.fullmatch(r"/model/(.+)/invoke-with-response-stream", path):
+                self._invoke_model_stream(json.loads(body))
+            elif match := re.fullmatch(r"/model/(.+)/converse-stream", path):
+                self._converse_stream(json.loads(body))
+            elif match := re.fullmatch(r"/model/(.+)/invoke", path):
+                self._invoke_model(json.loads(body))
+            elif match := re.fullmatch(r"/agents/([^/]+)/agentAliases/([^/]+)/sessions/([^/]+)/text", path):
+                self._invoke_agent(json.loads(body), *match.groups())
+            elif path == "/":
+                self._sts(body)
+            else:
+                self._send_json(404, {"message": f"Unknown operation {path}"})
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _invoke_model(self, request):
+        if self._throttle():
+            return
+        chunks = []
+        stop_reason, output_tokens = self._stream_with_stop(request.get("max_tokens", 4096), "", chunks.append)
+        self._send_json(200, {
+            "id": f"msg_{uuid.uuid4().hex}", "type": "message", "role": "assistant",
+            "content": [{"type": "text", "text": "".join(chunks)}], "stop_reason": stop_reason,
+            "usage": {"input_tokens": len(json.dumps(request)) // CHARS_PER_TOKEN, "output_tokens": output_tokens},
+        })
+
+    def _invoke_model_stream(self, request):
+        if self._throttle():
+            return
+        messages = request.get("messages", [])
+        prefill = ""
+        if messages and messages[-1]["role"] == "assistant" and isinstance(messages[-1]["content"], str):
+            prefill = messages[-1]["content"]
+        input_tokens = len(json.dumps(messages)) // CHARS_PER_TOKEN
+
+        self._track(1)
+        try:
+            self._start_stream({"X-Amzn-Bedrock-Content-Type": "application/json"})
+            self._write_event(encode_event("chunk", {"bytes": _b64({
+                "type": "message_start",
+                "message": {"id": f"msg_{uuid.uuid4().hex}", "type": "message", "role": "assistant",
+                            "content": [], "usage": {"input_tokens": input_tokens, "output_tokens": 1}}})}))
+            self._write_event(encode_event("chunk", {"bytes": _b64({
+                "type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})}))
+            stop_reason, output_tokens = self._stream_with_stop(
+                request.get("max_tokens", 4096), prefill,
+                lambda text: self._write_event(encode_event("chunk", {"bytes": _b64({
+                    "type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": text}})})))
+            self._write_event(encode_event("chunk", {"bytes": _b64({"type": "content_block_stop", "index": 0})}))
+            self._write_event(encode_event("chunk", {"bytes": _b64({
+                "type": "message_delta", "delta": {"stop_reason": stop_reason, "stop_sequence": None},
+                "usage": {"output_tokens": output_tokens}})}))
+            self._write_event(encode_event("chunk", {"bytes": _b64({
+                "type": "message_stop", "amazon-bedrock-invocationMetrics": {
+                    "inputTokenCount": input_tokens, "outputTokenCount": output_tokens,
+                    "invocationLatency": 0, "firstByteLatency": int(self.settings.ttft * 1000)}})}))
+            self._end_stream()
+        finally:
+            self._track(-1)
+
+    def _converse_stream(self, request):
+        if self._throttle():
+            return
+        max_tokens = request.get("inferenceConfig", {}).get("maxTokens", 4096)
+
+        self._track(1)
+        try:
+            self._start_stream()
+            self._write_event(encode_event("messageStart", {"role": "assistant"}))
+            stop_reason, output_tokens = self._stream_with_stop(
+                max_tokens, "",
+                lambda text: self._write_event(encode_event(
+                    "contentBlockDelta", {"contentBlockIndex": 0, "delta": {"text": text}})))
+            self._write_event(encode_event("contentBlockStop", {"contentBlockIndex": 0}))
+            self._write_event(encode_event("messageStop", {"stopReason": stop_reason}))
+            self._write_event(encode_event("metadata", {
+                "usage": {"inputTokens": 1000, "outputTokens": output_tokens, "totalTokens": 1000 + output_tokens},
+                "metrics": {"latencyMs": 0}}))
+            self._end_stream()
+        finally:
+            self._track(-1)
+
+    def _invoke_agent(self, request, agent_id, agent_alias_id, session_id):
+        if self._throttle():
+            return
+        trace = {"agentId": agent_id, "agentAliasId": agent_alias_id, "sessionId": session_id, "agentVersion": "1"}
+
+        self._track(1)
+        try:
+            self._start_stream({
+                "x-amzn-bedrock-agent-content-type": "application/json",
+                "x-amz-bedrock-agent-session-id": session_id,
+            })
+            trace_id = uuid.uuid4().hex
+            self._write_event(encode_event("trace", dict(trace, trace={"orchestrationTrace": {
+                "rationale": {"traceId": trace_id, "text": "Looking up AWS reference architectures."}}})))
+            self._write_event(encode_event("trace", dict(trace, trace={"orchestrationTrace": {
+                "observation": {"traceId": trace_id, "type": "KNOWLEDGE_BASE",
+                                "knowledgeBaseLookupOutput": {"retrievedReferences": []}}}})))
+            answer = "".join(self._generate(4096))
+            self._write_event(encode_event("trace", dict(trace, trace={"orchestrationTrace": {
+                "observation": {"traceId": trace_id, "type": "FINISH", "finalResponse": {"text": answer}}}})))
+            self._write_event(encode_event(
+                "chunk", {"bytes": base64.b64encode(answer.encode("utf-8")).decode("ascii")}))
+            self._end_stream()
+        finally:
+            self._track(-1)
+
+    def _sts(self, body):
+        action = parse_qs(body.decode("utf-8")).get("Action", [""])[0]
+        if action != "GetCallerIdentity":
+            self._send_json(400, {"message": f"Unsupported STS action {action}"})
+            return
+        response = (
+            '<GetCallerIdentityResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">'
+            '<GetCallerIdentityResult><Arn>arn:aws:iam::000000000000:user/fake-bedrock</Arn>'
+            '<UserId>FAKEBEDROCK</UserId><Account>000000000000</Account></GetCallerIdentityResult>'
+            f'<ResponseMetadata><RequestId>{uuid.uuid4()}</RequestId></ResponseMetadata>'
+            '</GetCallerIdentityResponse>'
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+def serve(args):
+    FakeBedrockHandler.settings = FakeBedrockSettings(
+        tokens_per_sec=args.tokens_per_sec,
+        ttft=args.ttft,
+        throttle_rate=args.throttle_rate,
+        response_tokens=args.response_tokens,
+        max_output_tokens=args.max_output_tokens,
+    )
+    server = ThreadingHTTPServer((args.host, args.port), FakeBedrockHandler)
+    server.daemon_threads = True
+    print(f"Fake Bedrock listening on http://{args.host}:{args.port}")
+
+    def report():
+        settings = FakeBedrockHandler.settings
+        while True:
+            time.sleep(10)
+            with settings.lock:
+                print(f"requests: {settings.requests} throttled: {settings.throttled} "
+                      f"active streams: {settings.active_streams}")
+
+    threading.Thread(target=report, daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+def loadtest(args):
+    """Drive N concurrent Streamlit sessions of agent.py in-process and report throughput."""
+    from streamlit.testing.v1 import AppTest
+
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "agent.py")
+    timings = []
+    errors = []
+    lock = threading.Lock()
+
+    def run_session():
+        app = AppTest.from_file(app_path, default_timeout=args.timeout)
+        app.session_state["user_authenticated"] = True
+        app.session_state["conversation_id"] = str(uuid.uuid4())
+        start = time.perf_counter()
+        try:
+            app.run()
+            app.chat_input(key="Generate").set_value(args.prompt).run()
+            if app.exception:
+                raise RuntimeError(app.exception[0].message)
+            with lock:
+                timings.append(time.perf_counter() - start)
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run_session) for _ in range(args.sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    timings.sort()
+    print(f"sessions: {args.sessions} completed: {len(timings)} errors: {len(errors)} wall clock: {elapsed:.2f}s")
+    if timings:
+        print(f"throughput: {len(timings) / elapsed:.2f} sessions/s "
+              f"p50: {timings[len(timings) // 2]:.2f}s p95: {timings[int(len(timings) * 0.95) - 1 or 0]:.2f}s")
+    for error in errors[:5]:
+        print(f"error: {error}")
+    return 1 if errors else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="run the fake Bedrock endpoint")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    serve_parser.add_argument("--tokens-per-sec", type=float, default=80.0)
+    serve_parser.add_argument("--ttft", type=float, default=0.6, help="time to first token in seconds")
+    serve_parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests throttled")
+    serve_parser.add_argument("--response-tokens", type=int, default=1500, help="length of generated answers")
+    serve_parser.add_argument("--max-output-tokens", type=int, default=None,
+                              help="truncate answers at this many tokens with stop_reason max_tokens")
+
+    loadtest_parser = subparsers.add_parser("loadtest", help="run concurrent app sessions against the endpoint")
+    loadtest_parser.add_argument("--sessions", type=int, default=5)
+    loadtest_parser.add_argument("--prompt", default="How can I build an enterprise data lake on AWS?")
+    loadtest_parser.add_argument("--timeout", type=float, default=600)
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        serve(args)
+        return 0
+    return loadtest(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
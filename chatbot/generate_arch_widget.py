@@ -1,17 +1,41 @@
 import uuid
 import get_code_from_markdown
 import streamlit as st
-from utils import BEDROCK_MODEL_ID
 from utils import store_in_s3
 from utils import save_conversation
 from utils import collect_feedback
-from utils import continuation_prompt
+from utils import continuation_messages
+from utils import merge_continuation
 from utils import convert_xml_to_html
-from utils import invoke_bedrock_model_streaming
+from generation_jobs import run_generation
+from generation_jobs import retry_pending
+from context_manager import fit_to_budget
+from session_artifacts import get_artifact
+from session_artifacts import put_artifact
+
+
+# Build the architecture prompt and the messages sent to Bedrock
+def build_arch_request(arch_messages):
+    architecture_prompt = """
+            Generate an AWS architecture and data flow diagram for the given solution, applying AWS best practices. Follow these steps:
+            1. Create an XML file suitable for draw.io that captures the architecture and data flow.
+            2. Reference the latest AWS architecture icons here: https://aws.amazon.com/architecture/icons/, Always use the latest AWS icons for generating the architecture.
+            3. Respond only with the XML in markdown format—no additional text.
+            4. Ensure the XML is complete, with all elements having proper opening and closing tags.
+            5. Confirm that all AWS services/icons are properly connected and enclosed within an AWS Cloud icon, deployed inside a VPC where applicable.
+            6. Remove unnecessary whitespace to optimize size and minimize output tokens.
+            7. Use valid AWS architecture icons to represent services, avoiding random images.
+            8. Please ensure the architecture diagram is clearly defined, neatly organized, and highly readable. The flow should be visually clean, with all arrows properly connected without overlaps. Make sure AWS service icons are neatly aligned and not clashing with arrows or other elements. If non-AWS services like on-premises databases, servers, or external systems are included, use appropriate generic icons from draw.io to represent them. The final diagram should look polished, professional, and easy to understand at a glance.
+            9. Please create a clearly structured and highly readable architecture diagram. Arrange all AWS service icons and non-AWS components (use generic draw.io icons for on-premises servers, databases, etc.) in a way that is clean, visually aligned, and properly spaced. Ensure arrows are straight, not overlapped or tangled, and clearly indicate the flow without crossing over service icons. Maintain enough spacing between elements to avoid clutter. The overall diagram should look professional, polished, and the data flow must be immediately understandable at a glance.
+            10. The final XML should be syntactically correct and cover all components of the given solution.
+        """  # noqa
+
+    history = fit_to_budget(arch_messages, "arch")
+    return architecture_prompt, history + [{"role": "user", "content": architecture_prompt}]
 
 
 @st.fragment
-def generate_arch(arch_messages):
+def generate_arch(arch_messages, history="messages"):
 
     arch_messages = arch_messages[:]
 
@@ -40,67 +64,75 @@ def generate_arch(arch_messages):
             st.session_state.arch_user_select = select_arch
         st.markdown("</div>", unsafe_allow_html=True)
 
+    retry = False
     with right:
         if st.session_state.arch_user_select:
             st.markdown("<div class=stButton gen-style'>", unsafe_allow_html=True)
-            if st.button(label="⟳ Retry", key="retry", type="secondary"):
+            retry = st.button(label="⟳ Retry", key="retry", type="secondary")
+            if retry:
                 st.session_state.arch_user_select = True  # Probably redundant
             st.markdown("</div>", unsafe_allow_html=True)
 
     if st.session_state.arch_user_select:
-        architecture_prompt = """
-            Generate an AWS architecture and data flow diagram for the given solution, applying AWS best practices. Follow these steps:
-            1. Create an XML file suitable for draw.io that captures the architecture and data flow.
-            2. Reference the latest AWS architecture icons here: https://aws.amazon.com/architecture/icons/, Always use the latest AWS icons for generating the architecture.
-            3. Respond only with the XML in markdown format—no additional text.
-            4. Ensure the XML is complete, with all elements having proper opening and closing tags.
-            5. Confirm that all AWS services/icons are properly connected and enclosed within an AWS Cloud icon, deployed inside a VPC where applicable.
-            6. Remove unnecessary whitespace to optimize size and minimize output tokens.
-            7. Use valid AWS architecture icons to represent services, avoiding random images.
-            8. Please ensure the architecture diagram is clearly defined, neatly organized, and highly readable. The flow should be visually clean, with all arrows properly connected without overlaps. Make sure AWS service icons are neatly aligned and not clashing with arrows or other elements. If non-AWS services like on-premises databases, servers, or external systems are included, use appropriate generic icons from draw.io to represent them. The final diagram should look polished, professional, and easy to understand at a glance.
-            9. Please create a clearly structured and highly readable architecture diagram. Arrange all AWS service icons and non-AWS components (use generic draw.io icons for on-premises servers, databases, etc.) in a way that is clean, visually aligned, and properly spaced. Ensure arrows are straight, not overlapped or tangled, and clearly indicate the flow without crossing over service icons. Maintain enough spacing between elements to avoid clutter. The overall diagram should look professional, polished, and the data flow must be immediately understandable at a glance.
-            10. The final XML should be syntactically correct and cover all components of the given solution.
-        """  # noqa
-
-        st.session_state.arch_messages.append({"role": "user", "content": architecture_prompt})
-        arch_messages.append({"role": "user", "content": architecture_prompt})
-
-        max_attempts = 4
-        full_response_array = []
-        full_response = ""
-
-        for attempt in range(max_attempts):
-            arch_gen_response, stop_reason = invoke_bedrock_model_streaming(arch_messages, enable_reasoning=True)
-            # full_response += arch_gen_response
-            full_response_array.append(arch_gen_response)
-
-            if stop_reason != "max_tokens":
-                break
-
-            if attempt == 0:
-                full_response = ''.join(str(x) for x in full_response_array)
-                arch_messages = continuation_prompt(architecture_prompt, full_response)
-
-        if attempt == max_attempts - 1:
-            st.error("Reached maximum number of attempts. Final result is incomplete. Please try again.")
+        # Rendered from the artifact store until the conversation changes, Retry generates again. A Retry that a
+        # rerun interrupted is rendered once it finishes.
+        retry_pending_job = retry_pending(st.session_state['conversation_id'], "arch")
+        full_response = None if retry or retry_pending_job else get_artifact(history, "arch")
+        generated = full_response is None
+        if generated:
+            architecture_prompt, arch_messages = build_arch_request(arch_messages)
+
+            st.session_state.arch_messages.append({"role": "user", "content": architecture_prompt})
+
+            max_attempts = 4
+            full_response = ""
+            request_messages = arch_messages
+            enable_reasoning = True
+            task = "arch"
+            arch_model = None
+
+            for attempt in range(max_attempts):
+                # Each attempt runs as a job that survives reruns. The first one picks up a speculative generation.
+                arch_gen_response, stop_reason, model_id = run_generation(
+                    st.session_state['conversation_id'], task, request_messages,
+                    bypass_cache=retry, enable_reasoning=enable_reasoning)
+                # Feedback is recorded for the model of the first attempt, continuations only complete its answer
+                arch_model = arch_model or model_id
+                full_response = merge_continuation(full_response, arch_gen_response)
+
+                if stop_reason != "max_tokens":
+                    break
+
+                # Prefill the assistant turn with the partial answer so the model only generates new tokens.
+                # Extended thinking can't be combined with a prefilled assistant turn.
+                request_messages = continuation_messages(arch_messages, full_response)
+                enable_reasoning = False
+                task = "continuation"
+            else:
+                st.error("Reached maximum number of attempts. Final result is incomplete. Please try again.")
 
         try:
-            full_response = ''.join(str(x) for x in full_response_array)
             arch_content_xml = get_code_from_markdown.get_code_from_markdown(full_response, language="xml")[0]
             arch_content_html = convert_xml_to_html(arch_content_xml)
-            st.session_state.arch_messages.append({"role": "assistant", "content": "XML"})
 
             with st.container():
                 st.components.v1.html(arch_content_html, scrolling=True, height=350)
 
-            st.session_state.interaction.append({"type": "Solution Architecture", "details": full_response})
-            store_in_s3(content=full_response, content_type='architecture')
-            save_conversation(st.session_state['conversation_id'], architecture_prompt, full_response)
-            collect_feedback(str(uuid.uuid4()), arch_content_xml, "generate_architecture", BEDROCK_MODEL_ID)
+            if generated:
+                st.session_state.arch_messages.append({"role": "assistant", "content": "XML"})
+                st.session_state.interaction.append({"type": "Solution Architecture", "details": full_response})
+                store_in_s3(content=full_response, content_type='architecture')
+                save_conversation(
+                    st.session_state['conversation_id'], architecture_prompt, full_response, "arch", history)
+                collect_feedback(
+                    str(uuid.uuid4()), arch_content_xml, "generate_architecture", arch_model)
+                put_artifact(history, "arch", full_response)
 
         except Exception as e:
             st.error("Internal error occurred. Please try again.")
             print(f"Error occurred when generating architecture: {str(e)}")
-            # Removing last element from list so we can retry request by hitting "No" and "Yes"
-            del st.session_state.arch_messages[-1]
-            del arch_messages[-1]
+            # Removing the prompt appended by this run so we can retry request by hitting "No" and "Yes". A stored
+            # artifact that fails to parse appended nothing.
+            if generated and st.session_state.arch_messages:
+                del st.session_state.arch_messages[-1]
+                del arch_messages[-1]
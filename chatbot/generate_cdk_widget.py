@@ -1,15 +1,32 @@
 import streamlit as st
-from utils import BEDROCK_MODEL_ID
 from utils import store_in_s3
 from utils import save_conversation
 from utils import collect_feedback
-from utils import invoke_bedrock_model_streaming
+from generation_jobs import run_generation
+from generation_jobs import retry_pending
+from context_manager import fit_to_budget
+from session_artifacts import get_artifact
+from session_artifacts import put_artifact
 import uuid
 
 
+# Build the CDK prompt and the messages sent to Bedrock
+def build_cdk_request(cdk_messages):
+    cdk_prompt1 = """
+            For the given solution, generate a CDK script in TypeScript to automate and deploy the required AWS resources.
+            Provide the actual source code for all jobs wherever applicable. 
+            The CDK code should provision all resources and components without version restrictions. 
+            If Python code is needed, generate a "Hello, World!" code example.
+            At the end generate sample commands to deploy the CDK code.
+        """  # noqa
+
+    history = fit_to_budget(cdk_messages, "cdk")
+    return cdk_prompt1, history + [{"role": "user", "content": cdk_prompt1}]
+
+
 # Generate CDK
 @st.fragment
-def generate_cdk(cdk_messages):
+def generate_cdk(cdk_messages, history="messages"):
 
     cdk_messages = cdk_messages[:]
 
@@ -39,35 +56,40 @@ def generate_cdk(cdk_messages):
             st.session_state.cdk_user_select = select_cdk
         st.markdown("</div>", unsafe_allow_html=True)
 
+    retry = False
     with right:
         if st.session_state.cdk_user_select:
             st.markdown("<div class=stButton gen-style'>", unsafe_allow_html=True)
-            if st.button(label="⟳ Retry", key="retry-cdk", type="secondary"):
+            retry = st.button(label="⟳ Retry", key="retry-cdk", type="secondary")
+            if retry:
                 st.session_state.cdk_user_select = True  # Probably redundant
             st.markdown("</div>", unsafe_allow_html=True)
 
     if st.session_state.cdk_user_select:
-        cdk_prompt1 = """
-            For the given solution, generate a CDK script in TypeScript to automate and deploy the required AWS resources.
-            Provide the actual source code for all jobs wherever applicable. 
-            The CDK code should provision all resources and components without version restrictions. 
-            If Python code is needed, generate a "Hello, World!" code example.
-            At the end generate sample commands to deploy the CDK code.
-        """  # noqa
+        # Rendered from the artifact store until the conversation changes, Retry generates again. A Retry that a
+        # rerun interrupted is rendered once it finishes.
+        retry_pending_job = retry_pending(st.session_state['conversation_id'], "cdk")
+        cdk_response = None if retry or retry_pending_job else get_artifact(history, "cdk")
+        generated = cdk_response is None
+        if generated:
+            cdk_prompt1, cdk_messages = build_cdk_request(cdk_messages)
 
-        # Append the prompt to the session state and messages
-        st.session_state.cdk_messages.append({"role": "user", "content": cdk_prompt1})
-        cdk_messages.append({"role": "user", "content": cdk_prompt1})
+            # Append the prompt to the session state
+            st.session_state.cdk_messages.append({"role": "user", "content": cdk_prompt1})
 
-        # Invoke the Bedrock model to get the CDK response
-        cdk_response, stop_reason = invoke_bedrock_model_streaming(cdk_messages)
-        st.session_state.cdk_messages.append({"role": "assistant", "content": cdk_response})
+            # Invoke the Bedrock model to get the CDK response
+            # Runs as a job that survives reruns
+            cdk_response, stop_reason, cdk_model = run_generation(
+                st.session_state['conversation_id'], "cdk", cdk_messages, bypass_cache=retry)
+            st.session_state.cdk_messages.append({"role": "assistant", "content": cdk_response})
 
         # Display the CDK response
         with st.container(height=350):
             st.markdown(cdk_response)
 
-        st.session_state.interaction.append({"type": "CDK Template", "details": cdk_response})
-        store_in_s3(content=cdk_response, content_type='cdk')
-        save_conversation(st.session_state['conversation_id'], cdk_prompt1, cdk_response)
-        collect_feedback(str(uuid.uuid4()), cdk_response, "generate_cdk", BEDROCK_MODEL_ID)
+        if generated:
+            st.session_state.interaction.append({"type": "CDK Template", "details": cdk_response})
+            store_in_s3(content=cdk_response, content_type='cdk')
+            save_conversation(st.session_state['conversation_id'], cdk_prompt1, cdk_response, "cdk", history)
+            collect_feedback(str(uuid.uuid4()), cdk_response, "generate_cdk", cdk_model)
+            put_artifact(history, "cdk", cdk_response)
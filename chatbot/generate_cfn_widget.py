@@ -3,26 +3,47 @@ import boto3
 import streamlit as st
 import get_code_from_markdown
 from botocore.config import Config
-from utils import BEDROCK_MODEL_ID
-from utils import invoke_bedrock_model_streaming
-from utils import retrieve_environment_variables
+from generation_jobs import run_generation
+from generation_jobs import retry_pending
+from config import retrieve_environment_variables
 from utils import store_in_s3
 from utils import save_conversation
 from utils import collect_feedback
+from context_manager import fit_to_budget
+from session_artifacts import get_artifact
+from session_artifacts import put_artifact
 import uuid
 
 AWS_REGION = os.getenv("AWS_REGION")
+# Point the Bedrock clients at a local stand-in such as fake_bedrock.py
+BEDROCK_ENDPOINT_URL = os.getenv("BEDROCK_ENDPOINT_URL")
 
 config = Config(read_timeout=1000, retries=(dict(max_attempts=5)))
 s3_client = boto3.client('s3', region_name=AWS_REGION)
 dynamodb_resource = boto3.resource('dynamodb', region_name=AWS_REGION)
-bedrock_agent_runtime_client = boto3.client('bedrock-agent-runtime', region_name=AWS_REGION)
-bedrock_client = boto3.client('bedrock-runtime', region_name=AWS_REGION, config=config)
+bedrock_agent_runtime_client = boto3.client('bedrock-agent-runtime', region_name=AWS_REGION,
+                                            endpoint_url=BEDROCK_ENDPOINT_URL)
+bedrock_client = boto3.client('bedrock-runtime', region_name=AWS_REGION, config=config,
+                              endpoint_url=BEDROCK_ENDPOINT_URL)
+
+
+# Build the CloudFormation prompt and the messages sent to Bedrock
+def build_cfn_request(cfn_messages):
+    cfn_prompt = """
+            For the given solution, generate a CloudFormation template in YAML to automate the deployment of AWS resources.
+            Provide the actual source code for all the jobs wherever applicable.
+            The CloudFormation template should provision all the resources and the components.
+            If Python code is needed, generate a "Hello, World!" code example.
+            At the end generate sample commands to deploy the CloudFormation template.
+        """  # noqa
+
+    history = fit_to_budget(cfn_messages, "cfn")
+    return cfn_prompt, history + [{"role": "user", "content": cfn_prompt}]
 
 
 # Generate CFN
 @st.fragment
-def generate_cfn(cfn_messages):
+def generate_cfn(cfn_messages, history="messages"):
     cfn_messages = cfn_messages[:]
 
     # Retain messages and previous insights in the chat section
@@ -50,26 +71,28 @@ def generate_cfn(cfn_messages):
             st.session_state.cfn_user_select = select_cfn
         st.markdown("</div>", unsafe_allow_html=True)
 
+    retry = False
     with right:
         if st.session_state.cfn_user_select:
             st.markdown("<div class=stButton gen-style'>", unsafe_allow_html=True)
-            if st.button(label="⟳ Retry", key="retry-cfn", type="secondary"):
+            retry = st.button(label="⟳ Retry", key="retry-cfn", type="secondary")
+            if retry:
                 st.session_state.cfn_user_select = True  # Probably redundant
             st.markdown("</div>", unsafe_allow_html=True)
 
     if st.session_state.cfn_user_select:
-        cfn_prompt = """
-            For the given solution, generate a CloudFormation template in YAML to automate the deployment of AWS resources.
-            Provide the actual source code for all the jobs wherever applicable.
-            The CloudFormation template should provision all the resources and the components.
-            If Python code is needed, generate a "Hello, World!" code example.
-            At the end generate sample commands to deploy the CloudFormation template.
-        """  # noqa
-
-        cfn_messages.append({"role": "user", "content": cfn_prompt})
-
-        cfn_response, stop_reason = invoke_bedrock_model_streaming(cfn_messages)
-        st.session_state.cfn_messages.append({"role": "assistant", "content": cfn_response})
+        # Rendered from the artifact store until the conversation changes, Retry generates again. A Retry that a
+        # rerun interrupted is rendered once it finishes.
+        retry_pending_job = retry_pending(st.session_state['conversation_id'], "cfn")
+        cfn_response = None if retry or retry_pending_job else get_artifact(history, "cfn")
+        generated = cfn_response is None
+        if generated:
+            cfn_prompt, cfn_messages = build_cfn_request(cfn_messages)
+
+            # Runs as a job that survives reruns
+            cfn_response, stop_reason, cfn_model = run_generation(
+                st.session_state['conversation_id'], "cfn", cfn_messages, bypass_cache=retry)
+            st.session_state.cfn_messages.append({"role": "assistant", "content": cfn_response})
 
         cfn_yaml = get_code_from_markdown.get_code_from_markdown(cfn_response, language="yaml")[0]
 
@@ -78,14 +101,15 @@ def generate_cfn(cfn_messages):
 
         S3_BUCKET_NAME = retrieve_environment_variables("S3_BUCKET_NAME")
 
-        st.session_state.interaction.append({"type": "CloudFormation Template", "details": cfn_response})
-        store_in_s3(content=cfn_response, content_type='cfn')
-        save_conversation(st.session_state['conversation_id'], cfn_prompt, cfn_response)
-        collect_feedback(str(uuid.uuid4()), cfn_response, "generate_cfn", BEDROCK_MODEL_ID)
-
         # Write CFN template to S3 bucket and provide a button to launch the stack in the console
         object_name = f"{st.session_state['conversation_id']}/template.yaml"
-        s3_client.put_object(Body=cfn_yaml, Bucket=S3_BUCKET_NAME, Key=object_name)
+        if generated:
+            st.session_state.interaction.append({"type": "CloudFormation Template", "details": cfn_response})
+            store_in_s3(content=cfn_response, content_type='cfn')
+            save_conversation(st.session_state['conversation_id'], cfn_prompt, cfn_response, "cfn", history)
+            collect_feedback(str(uuid.uuid4()), cfn_response, "generate_cfn", cfn_model)
+            s3_client.put_object(Body=cfn_yaml, Bucket=S3_BUCKET_NAME, Key=object_name)
+            put_artifact(history, "cfn", cfn_response)
         template_object_url = f"https://s3.amazonaws.com/{S3_BUCKET_NAME}/{object_name}"
 
         st.write("Click the below button to deploy the generated solution in your AWS account")
@@ -1,15 +1,29 @@
 import uuid
 import streamlit as st
-from utils import BEDROCK_MODEL_ID
 from utils import store_in_s3
 from utils import save_conversation
 from utils import collect_feedback
-from utils import invoke_bedrock_model_streaming
+from generation_jobs import run_generation
+from generation_jobs import retry_pending
+from context_manager import fit_to_budget
+from session_artifacts import get_artifact
+from session_artifacts import put_artifact
+
+
+# Build the documentation prompt and the messages sent to Bedrock
+def build_doc_request(doc_messages):
+    doc_prompt = """
+            For the given solution, generate a complete, professional technical documentation including a table of contents, 
+            for the following architecture. Expand all the table of contents topics to create a comprehensive professional technical documentation
+        """  # noqa
+
+    history = fit_to_budget(doc_messages, "doc")
+    return doc_prompt, history + [{"role": "user", "content": doc_prompt}]
 
 
 # Generate documentation
 @st.fragment
-def generate_doc(doc_messages):
+def generate_doc(doc_messages, history="messages"):
 
     doc_messages = doc_messages[:]
 
@@ -38,29 +52,38 @@ def generate_doc(doc_messages):
             st.session_state.doc_user_select = select_doc
         st.markdown("</div>", unsafe_allow_html=True)
 
+    retry = False
     with right:
         if st.session_state.doc_user_select:
             st.markdown("<div class=stButton gen-style'>", unsafe_allow_html=True)
-            if st.button(label="⟳ Retry", key="retry-doc", type="secondary"):
+            retry = st.button(label="⟳ Retry", key="retry-doc", type="secondary")
+            if retry:
                 st.session_state.doc_user_select = True  # Probably redundant
             st.markdown("</div>", unsafe_allow_html=True)
 
     if st.session_state.doc_user_select:
-        doc_prompt = """
-            For the given solution, generate a complete, professional technical documentation including a table of contents, 
-            for the following architecture. Expand all the table of contents topics to create a comprehensive professional technical documentation
-        """  # noqa
+        # Rendered from the artifact store until the conversation changes, Retry generates again. A Retry that a
+        # rerun interrupted is rendered once it finishes.
+        retry_pending_job = retry_pending(st.session_state['conversation_id'], "doc")
+        doc_response = None if retry or retry_pending_job else get_artifact(history, "doc")
+        generated = doc_response is None
+        if generated:
+            doc_prompt, doc_messages = build_doc_request(doc_messages)
 
-        st.session_state.doc_messages.append({"role": "user", "content": doc_prompt})
-        doc_messages.append({"role": "user", "content": doc_prompt})
+            st.session_state.doc_messages.append({"role": "user", "content": doc_prompt})
 
-        doc_response, stop_reason = invoke_bedrock_model_streaming(doc_messages)
-        st.session_state.doc_messages.append({"role": "assistant", "content": doc_response})
+            # Runs as a job that survives reruns
+            doc_response, stop_reason, doc_model = run_generation(
+                st.session_state['conversation_id'], "doc", doc_messages, bypass_cache=retry)
+            st.session_state.doc_messages.append({"role": "assistant", "content": doc_response})
 
         with st.container(height=350):
             st.markdown(doc_response)
 
-        st.session_state.interaction.append({"type": "Technical documentation", "details": doc_response})
-        store_in_s3(content=doc_response, content_type='documentation')
-        save_conversation(st.session_state['conversation_id'], doc_prompt, doc_response)
-        collect_feedback(str(uuid.uuid4()), doc_response, "generate_documentation", BEDROCK_MODEL_ID)
+        if generated:
+            st.session_state.interaction.append({"type": "Technical documentation", "details": doc_response})
+            store_in_s3(content=doc_response, content_type='documentation')
+            save_conversation(st.session_state['conversation_id'], doc_prompt, doc_response, "doc", history)
+            collect_feedback(
+                str(uuid.uuid4()), doc_response, "generate_documentation", doc_model)
+            put_artifact(history, "doc", doc_response)
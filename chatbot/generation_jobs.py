@@ -0,0 +1,253 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
+from utils import stream_bedrock_model
+from stream_renderer import StreamRenderer
+from stream_renderer import STREAM_RENDER_INTERVAL_SECONDS
+
+# Generations run as jobs on a process wide executor, so Streamlit reruns only interrupt their rendering
+GENERATION_JOB_WORKERS = int(os.getenv("GENERATION_JOB_WORKERS", "16"))
+# Finished jobs kept for re-rendering, oldest are dropped first
+GENERATION_JOB_MAX_JOBS = int(os.getenv("GENERATION_JOB_MAX_JOBS", "500"))
+GENERATION_JOB_TTL_SECONDS = int(os.getenv("GENERATION_JOB_TTL_SECONDS", "3600"))
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def job_key(conversation_id, task, messages, options):
+    payload = json.dumps({"task": task, "messages": messages, "options": options}, sort_keys=True, default=str)
+    return conversation_id, task, hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class GenerationJob:
+    """A generation running in the background whose partial output can be rendered at any time.
+
+    Acts as the renderer of stream_bedrock_model, and aborts the stream once cancelled.
+    """
+
+    def __init__(self, key, messages, options, bypass_cache):
+        self.key = key
+        self.messages = messages
+        self.options = options
+        self.bypass_cache = bypass_cache
+        self.status = PENDING
+        self.result = None
+        self.stop_reason = None
+        self.model_id = None  # model that answered, set once the generation is done
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+        self._lock = threading.Lock()
+        self._chunks = []
+        self._resets = 0
+
+    @property
+    def conversation_id(self):
+        return self.key[0]
+
+    @property
+    def task(self):
+        return self.key[1]
+
+    # Renderer interface used by stream_bedrock_model
+    def write(self, text):
+        if self.cancelled.is_set():
+            raise JobCancelled(f"{self.task} generation cancelled")
+        with self._lock:
+            self._chunks.append(text)
+
+    def reset(self):
+        if self.cancelled.is_set():
+            raise JobCancelled(f"{self.task} generation cancelled")
+        with self._lock:
+            self._chunks = []
+            self._resets += 1
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def text(self):
+        with self._lock:
+            return ''.join(self._chunks)
+
+    def read(self, position):
+        """Return (text written since position, new position, restarted). Start from position (0, 0).
+
+        restarted tells that the stream was reset since position, the text then starts from the beginning.
+        """
+        resets, index = position
+        with self._lock:
+            restarted = resets != self._resets
+            if restarted:
+                index = 0
+            return ''.join(self._chunks[index:]), (self._resets, len(self._chunks)), restarted
+
+    def run(self):
+        if self.cancelled.is_set():
+            self._finish(CANCELLED)
+            return
+        self.status = RUNNING
+        try:
+            self.result, self.stop_reason = stream_bedrock_model(
+                self.messages, bypass_cache=self.bypass_cache, renderer=self, task=self.task,
+                on_model=self._answered_by, **self.options)
+            self._finish(DONE)
+        except JobCancelled:
+            self._finish(CANCELLED)
+        except Exception as e:
+            self.error = e
+            print(f"Error occurred in {self.task} generation job: {str(e)}")
+            self._finish(FAILED)
+
+    def _answered_by(self, model_id):
+        self.model_id = model_id
+
+    def _finish(self, status):
+        self.status = status
+        self.finished_at = time.time()
+        self.finished.set()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    @property
+    def done(self):
+        return self.finished.is_set()
+
+
+class GenerationJobRegistry:
+    """Jobs by (conversation_id, task, input hash), shared by every session of the process."""
+
+    def __init__(self, workers, max_jobs, ttl):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="generation-job")
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def submit(self, conversation_id, task, messages, force=False, **options):
+        """Return the job for this request, starting it if needed. force replaces a finished job."""
+        key = job_key(conversation_id, task, messages, options)
+        with self._lock:
+            job = self.jobs.get(key)
+            if job is not None and job.status not in (FAILED, CANCELLED):
+                # Single flight: identical requests attach to the one upstream stream. A forced request
+                # starts over, unless a forced request of its own is still in flight (e.g. a double click).
+                if not force or (job.bypass_cache and not job.done):
+                    self.coalesced += 1
+                    self.jobs.move_to_end(key)
+                    return job
+            if job is not None:
+                job.cancel()
+            job = GenerationJob(key, messages, options, bypass_cache=force)
+            self.jobs[key] = job
+            self._evict()
+        self.executor.submit(job.run)
+        return job
+
+    def _evict(self):
+        now = time.time()
+        for key, job in list(self.jobs.items()):
+            if job.done and (len(self.jobs) > self.max_jobs or now - job.finished_at > self.ttl):
+                del self.jobs[key]
+
+    def cancel_conversation(self, conversation_id):
+        with self._lock:
+            keys = [key for key in self.jobs if key[0] == conversation_id]
+            for key in keys:
+                self.jobs.pop(key).cancel()
+
+    def metrics(self):
+        with self._lock:
+            statuses = [job.status for job in self.jobs.values()]
+            coalesced = self.coalesced
+        metrics = {status: statuses.count(status) for status in (PENDING, RUNNING, DONE, FAILED, CANCELLED)}
+        metrics["coalesced"] = coalesced
+        return metrics
+
+
+generation_jobs = GenerationJobRegistry(GENERATION_JOB_WORKERS, GENERATION_JOB_MAX_JOBS, GENERATION_JOB_TTL_SECONDS)
+
+
+class JobView:
+    """Copies the output a job wrote since the last update into a StreamRenderer."""
+
+    def __init__(self, job, renderer):
+        self.job = job
+        self.renderer = renderer
+        self.position = (0, 0)
+
+    def update(self):
+        text, self.position, restarted = self.job.read(self.position)
+        if restarted:
+            self.renderer.reset()
+        if text:
+            self.renderer.write(text)
+
+
+def render_job(job, placeholder=None):
+    """Render the partial output of a job until it finishes, and return its (result, stop_reason, model_id).
+
+    A rerun interrupting this loop leaves the job running; the next run picks it up again.
+    """
+    if not job.done:
+        placeholder = placeholder or st.empty()
+        view = JobView(job, StreamRenderer(placeholder))
+        while not job.finished.wait(STREAM_RENDER_INTERVAL_SECONDS):
+            view.update()
+        placeholder.empty()
+
+    if job.status == FAILED:
+        raise job.error
+    if job.status == CANCELLED:
+        raise JobCancelled(f"{job.task} generation cancelled")
+    return job.result, job.stop_reason, job.model_id
+
+
+def retry_pending(conversation_id, task):
+    """True while a Retry of task that a rerun interrupted has not been rendered yet.
+
+    The widget then skips its stored artifact, and run_generation attaches to the retried job again.
+    """
+    return (conversation_id, task) in st.session_state.get("retry_jobs", {})
+
+
+def run_generation(conversation_id, task, messages, bypass_cache=False, **options):
+    """Generate through the job registry. Retry (bypass_cache) is the only way to start over.
+
+    The job of a Retry is kept in session state until it has been rendered, so a run that interrupted it
+    attaches to the same job instead of showing the previous artifact.
+    """
+    if "retry_jobs" not in st.session_state:
+        st.session_state.retry_jobs = {}
+    retry_jobs = st.session_state.retry_jobs
+    job = generation_jobs.submit(conversation_id, task, messages, force=bypass_cache, **options)
+    if bypass_cache:
+        retry_jobs[(conversation_id, task)] = job.key
+    elif retry_jobs.get((conversation_id, task)) != job.key:
+        # The conversation changed since the Retry, its job is stale
+        retry_jobs.pop((conversation_id, task), None)
+    try:
+        return render_job(job)
+    finally:
+        if job.done:
+            retry_jobs.pop((conversation_id, task), None)
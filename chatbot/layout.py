@@ -1,5 +1,13 @@
 import streamlit as st
+import os
 import uuid
+from session_artifacts import set_messages
+from dynamodb import persistence
+from utils import current_user
+from utils import save_session
+
+# Sessions listed in the sidebar history
+SESSION_HISTORY_SIZE = int(os.getenv("SESSION_HISTORY_SIZE", "10"))
 
 
 def login_page():
@@ -28,6 +36,11 @@ def login_page():
             if submit:
                 st.session_state.conversation_id = str(uuid.uuid4())
                 st.session_state.user_authenticated = True
+                st.session_state.user_name, st.session_state.user_email = current_user()
+                session = save_session(
+                    st.session_state.conversation_id, st.session_state.user_name, st.session_state.user_email)
+                st.session_state.session_start_time = session['session_start_time']
+                st.session_state.session_history = None
                 st.rerun()
 
     # Description and Disclaimer
@@ -109,10 +122,19 @@ def welcome_sidebar():
 
         if st.button("New Session", use_container_width=True):
             st.session_state.user_authenticated = False
-            st.session_state.messages = []
-            st.session_state.mod_messages = []
+            set_messages("messages", [])
+            set_messages("mod_messages", [])
+            st.rerun()
+
+        # Pick up an earlier conversation by the SessionID shown below
+        resume_conversation_id = st.text_input("Resume a conversation", placeholder="SessionID")
+        if st.button("Resume", use_container_width=True) and resume_conversation_id.strip():
+            st.session_state.resume_conversation_id = resume_conversation_id.strip()
             st.rerun()
-        
+
+        if st.session_state.get('user_email'):
+            session_history()
+
         st.divider()
     # Bottom divider and session ID
     # st.divider()
@@ -136,6 +158,47 @@ def welcome_sidebar():
     """, unsafe_allow_html=True)
 
 
+def load_session_history(start_key=None):
+    # One query of the session table's user index per page
+    try:
+        sessions, next_key = persistence.list_user_sessions(
+            st.session_state.user_email, SESSION_HISTORY_SIZE, start_key)
+    except Exception as e:
+        print(f"Loading the session history failed: {str(e)}")
+        sessions, next_key = [], None
+    if start_key is None:
+        st.session_state.session_history = sessions
+    else:
+        loaded = {session['conversation_id'] for session in st.session_state.session_history}
+        st.session_state.session_history += [
+            session for session in sessions if session['conversation_id'] not in loaded]
+    st.session_state.session_history_next = next_key
+
+
+def session_history():
+    if st.session_state.get("session_history") is None:
+        load_session_history()
+
+    with st.expander("Your sessions"):
+        if not st.session_state.session_history:
+            st.caption("No earlier sessions")
+        for session in st.session_state.session_history:
+            summary = session['session_summary']
+            if len(summary) > 40:
+                summary = summary[:40] + "…"
+            if st.button(
+                f"{session['session_start_time'][:16]} {summary}", key=f"history-{session['conversation_id']}",
+                disabled=session['conversation_id'] == st.session_state.conversation_id, use_container_width=True
+            ):
+                st.session_state.resume_conversation_id = session['conversation_id']
+                st.rerun()
+        if st.session_state.get("session_history_next") and st.button(
+            "More sessions", key="history-more", use_container_width=True
+        ):
+            load_session_history(st.session_state.session_history_next)
+            st.rerun()
+
+
 def create_tabs():
     """Create and return the Streamlit tabs."""
     # tabs = st.tabs(["Build a solution", "Modify your existing architecture", "Modify AWS solutions"])
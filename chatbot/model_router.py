@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+from botocore.exceptions import ClientError
+from usage_stats import percentile
+
+# Model tiers, as cross region inference profile IDs (or full ARNs). Override with a JSON object.
+MODEL_TIERS = {
+    "default": "us.anthropic.claude-3-7-sonnet-20250219-v1:0",
+    "fast": "us.anthropic.claude-3-5-haiku-20241022-v1:0",
+    "vision": "us.anthropic.claude-3-5-sonnet-20241022-v2:0",
+}
+MODEL_TIERS.update(json.loads(os.getenv("BEDROCK_MODEL_TIERS", "{}")))
+
+# Task -> model tier and output token limit. Override single routes with a JSON object, e.g.
+# BEDROCK_MODEL_ROUTES='{"cost": {"tier": "fast", "max_tokens": 8192}}'
+MODEL_ROUTES = {
+    "chat": {"tier": "default", "max_tokens": 128000},
+    "cost": {"tier": "default", "max_tokens": 128000},
+    "doc": {"tier": "default", "max_tokens": 128000},
+    "cfn": {"tier": "default", "max_tokens": 128000},
+    "cdk": {"tier": "default", "max_tokens": 128000},
+    "arch": {"tier": "default", "max_tokens": 128000},
+    "continuation": {"tier": "default", "max_tokens": 128000},
+    "image_insight": {"tier": "vision", "max_tokens": 2000},
+    "summary": {"tier": "fast", "max_tokens": int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "2048"))},
+}
+for task, route in json.loads(os.getenv("BEDROCK_MODEL_ROUTES", "{}")).items():
+    MODEL_ROUTES[task] = dict(MODEL_ROUTES.get(task, MODEL_ROUTES["chat"]), **route)
+
+# Number of recent latencies kept per route for the percentiles
+ROUTE_LATENCY_WINDOW = 200
+# Route metrics are logged after a call at most this often
+ROUTE_METRICS_LOG_INTERVAL_SECONDS = float(os.getenv("ROUTE_METRICS_LOG_INTERVAL_SECONDS", "300"))
+
+# Errors meaning the routed model can't be used here, which the default model may not share. Throttling and
+# request errors would only fail again, or add load, on the default model.
+FALLBACK_ERRORS = {"ResourceNotFoundException", "AccessDeniedException", "ModelNotReadyException"}
+
+
+class ModelRoute:
+    def __init__(self, task, model_id, max_tokens):
+        self.task = task
+        self.model_id = model_id
+        self.max_tokens = max_tokens
+
+
+class RouteStats:
+    """Per-route call counts, errors, fallbacks and latency percentiles."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.fallbacks = 0
+        self.latencies = deque(maxlen=ROUTE_LATENCY_WINDOW)
+
+    def record(self, latency, error=False, fallback=False):
+        with self._lock:
+            self.calls += 1
+            self.errors += int(error)
+            self.fallbacks += int(fallback)
+            if not error:
+                self.latencies.append(latency)
+
+    def summary(self):
+        with self._lock:
+            latencies = sorted(self.latencies)
+            return {
+                "calls": self.calls,
+                "errors": self.errors,
+                "fallbacks": self.fallbacks,
+                "p50_latency": percentile(latencies, 0.5),
+                "p95_latency": percentile(latencies, 0.95),
+            }
+
+
+class ModelRouter:
+    """Maps each task to a model and its output limit, falling back to the default model if it is unavailable."""
+
+    def __init__(self, region, account_id, tiers=None, routes=None,
+                 metrics_log_interval=ROUTE_METRICS_LOG_INTERVAL_SECONDS):
+        self.region = region
+        self.account_id = account_id
+        self.tiers = tiers or MODEL_TIERS
+        self.routes = routes or MODEL_ROUTES
+        self.metrics_log_interval = metrics_log_interval
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        self._metrics_logged_at = time.monotonic()
+
+    def model_arn(self, tier):
+        model_id = self.tiers[tier]
+        if model_id.startswith("arn:"):
+            return model_id
+        # Cross Region Inference for improved resilience https://docs.aws.amazon.com/bedrock/latest/userguide/cross-region-inference.html  # noqa
+        return f"arn:aws:bedrock:{self.region}:{self.account_id}:inference-profile/{model_id}"
+
+    @property
+    def default_model_id(self):
+        return self.model_arn("default")
+
+    def route(self, task):
+        route = self.routes.get(task, self.routes["chat"])
+        return ModelRoute(task, self.model_arn(route["tier"]), route["max_tokens"])
+
+    def model_for(self, task):
+        return self.route(task).model_id
+
+    def stats(self, task):
+        with self._stats_lock:
+            return self._stats.setdefault(task, RouteStats())
+
+    def call(self, task, operation):
+        """Run operation(model_id, max_tokens) on the task's model, retrying once on the default model if the task's
+        model is unavailable."""
+        route = self.route(task)
+        stats = self.stats(task)
+        start = time.monotonic()
+        try:
+            result = operation(route.model_id, route.max_tokens)
+        except ClientError as e:
+            stats.record(time.monotonic() - start, error=True)
+            if route.model_id == self.default_model_id or e.response['Error']['Code'] not in FALLBACK_ERRORS:
+                raise
+            print(f"Model {route.model_id} unavailable for task {task}, falling back to the default model: {str(e)}")
+            start = time.monotonic()
+            result = operation(self.default_model_id, route.max_tokens)
+            stats.record(time.monotonic() - start, fallback=True)
+            self._log_metrics()
+            return result
+
+        stats.record(time.monotonic() - start)
+        self._log_metrics()
+        return result
+
+    def _log_metrics(self):
+        with self._stats_lock:
+            if time.monotonic() - self._metrics_logged_at < self.metrics_log_interval:
+                return
+            self._metrics_logged_at = time.monotonic()
+        print(f"Model route metrics: {self.metrics()}")
+
+    def metrics(self):
+        with self._stats_lock:
+            tasks = list(self._stats)
+        return {task: dict(self.stats(task).summary(), model_id=self.model_for(task)) for task in tasks}
@@ -0,0 +1,117 @@
+import os
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+import boto3
+from botocore.config import Config
+from config import retrieve_environment_variables
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+AWS_REGION = os.getenv("AWS_REGION")
+# Text attributes larger than this are stored compressed in S3, and the DynamoDB item keeps a pointer
+PAYLOAD_OFFLOAD_THRESHOLD_BYTES = int(os.getenv("PAYLOAD_OFFLOAD_THRESHOLD_BYTES", "16384"))
+# Payloads are stored under <conversation_id>/<PAYLOAD_S3_FOLDER>/<sha256>.gz (or .zst)
+PAYLOAD_S3_FOLDER = os.getenv("PAYLOAD_S3_FOLDER", "payloads")
+# Rehydrated payloads kept in memory
+PAYLOAD_CACHE_ENTRIES = int(os.getenv("PAYLOAD_CACHE_ENTRIES", "256"))
+
+CODEC_EXTENSIONS = {"gzip": "gz", "zstd": "zst"}
+
+s3_client = boto3.client('s3', region_name=AWS_REGION, config=Config(retries=dict(max_attempts=5)))
+
+
+def compress(data):
+    """Return (codec, compressed bytes), zstd when the zstandard package is installed."""
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=6).compress(data)
+    return "gzip", gzip.compress(data, compresslevel=6)
+
+
+def decompress(codec, data):
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def is_pointer(value):
+    return isinstance(value, dict) and "payload_s3_key" in value
+
+
+class PayloadStore:
+    def __init__(self, threshold, cache_entries):
+        self.threshold = threshold
+        self.cache_entries = cache_entries
+        self._cache = OrderedDict()  # s3 key -> text
+        self._lock = threading.Lock()
+        self.offloaded = 0
+        self.bytes_in = 0
+        self.bytes_stored = 0
+
+    def offload(self, conversation_id, item, attributes):
+        """Return a copy of the item with large text attributes replaced by pointers to S3.
+
+        An attribute that fails to upload is kept inline.
+        """
+        item = dict(item)
+        for attribute in attributes:
+            value = item.get(attribute)
+            if not isinstance(value, str):
+                continue
+            data = value.encode("utf-8")
+            if len(data) <= self.threshold:
+                continue
+            try:
+                item[attribute] = self._put(conversation_id, data)
+            except Exception as e:
+                print(f"Payload offload of {attribute} failed, writing it inline: {str(e)}")
+        return item
+
+    def _put(self, conversation_id, data):
+        digest = hashlib.sha256(data).hexdigest()
+        codec, body = compress(data)
+        key = f"{conversation_id}/{PAYLOAD_S3_FOLDER}/{digest}.{CODEC_EXTENSIONS[codec]}"
+        s3_client.put_object(
+            Body=body, Bucket=retrieve_environment_variables("S3_BUCKET_NAME"), Key=key,
+            ContentType=f"application/{codec}")
+        with self._lock:
+            self.offloaded += 1
+            self.bytes_in += len(data)
+            self.bytes_stored += len(body)
+        return {"payload_s3_key": key, "codec": codec, "size": len(data), "sha256": digest}
+
+    def text(self, value):
+        """Return the text of an attribute value, loading it from S3 if it is a pointer."""
+        if not is_pointer(value):
+            return value
+        key = value["payload_s3_key"]
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        response = s3_client.get_object(Bucket=retrieve_environment_variables("S3_BUCKET_NAME"), Key=key)
+        data = decompress(value["codec"], response['Body'].read())
+        if hashlib.sha256(data).hexdigest() != value["sha256"]:
+            raise ValueError(f"Payload {key} does not match its hash")
+        text = data.decode("utf-8")
+        with self._lock:
+            self._cache[key] = text
+            while len(self._cache) > self.cache_entries:
+                self._cache.popitem(last=False)
+        return text
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "offloaded": self.offloaded,
+                "bytes_in": self.bytes_in,
+                "bytes_stored": self.bytes_stored,
+                "cached": len(self._cache),
+            }
+
+
+payload_store = PayloadStore(PAYLOAD_OFFLOAD_THRESHOLD_BYTES, PAYLOAD_CACHE_ENTRIES)
@@ -0,0 +1,122 @@
+import os
+import time
+import random
+import threading
+from botocore.exceptions import ClientError
+
+# Process wide client-side rate limit for Bedrock calls, adapted to the observed throttle rate (AIMD)
+BEDROCK_RATE_LIMIT_INITIAL = float(os.getenv("BEDROCK_RATE_LIMIT_INITIAL", "5"))
+BEDROCK_RATE_LIMIT_MIN = float(os.getenv("BEDROCK_RATE_LIMIT_MIN", "0.2"))
+BEDROCK_RATE_LIMIT_MAX = float(os.getenv("BEDROCK_RATE_LIMIT_MAX", "50"))
+BEDROCK_RATE_LIMIT_INCREASE = float(os.getenv("BEDROCK_RATE_LIMIT_INCREASE", "0.1"))
+BEDROCK_RATE_LIMIT_DECREASE = float(os.getenv("BEDROCK_RATE_LIMIT_DECREASE", "0.5"))
+BEDROCK_RATE_LIMIT_BURST = float(os.getenv("BEDROCK_RATE_LIMIT_BURST", "5"))
+BEDROCK_MAX_RETRIES = int(os.getenv("BEDROCK_MAX_RETRIES", "3"))
+BEDROCK_BACKOFF_BASE_SECONDS = float(os.getenv("BEDROCK_BACKOFF_BASE_SECONDS", "1"))
+BEDROCK_BACKOFF_CAP_SECONDS = float(os.getenv("BEDROCK_BACKOFF_CAP_SECONDS", "20"))
+
+THROTTLING_ERROR_CODES = {"throttlingexception", "toomanyrequestsexception", "servicequotaexceededexception"}
+
+
+def is_throttling_error(error):
+    # Errors raised while reading an event stream use lower camel case codes, e.g. throttlingException
+    error_code = error.response.get('Error', {}).get('Code', '')
+    return error_code.lower() in THROTTLING_ERROR_CODES
+
+
+def full_jitter_backoff(attempt, base=BEDROCK_BACKOFF_BASE_SECONDS, cap=BEDROCK_BACKOFF_CAP_SECONDS):
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class AdaptiveRateLimiter:
+    """Token bucket whose refill rate grows additively on success and shrinks multiplicatively on throttling."""
+
+    def __init__(self, initial_rate, min_rate, max_rate, increase_step, decrease_factor, burst):
+        self.rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        self.queue_depth = 0
+        self.successes = 0
+        self.throttles = 0
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        with self._condition:
+            self.queue_depth += 1
+            try:
+                while True:
+                    self._refill()
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    self._condition.wait((1 - self.tokens) / self.rate)
+            finally:
+                self.queue_depth -= 1
+
+    def on_success(self):
+        with self._condition:
+            self.successes += 1
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+            self._condition.notify_all()
+
+    def on_throttle(self):
+        with self._condition:
+            self.throttles += 1
+            self._refill()
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            # Drain the burst so waiting callers pick up the lower rate straight away
+            self.tokens = min(self.tokens, 0)
+
+    def metrics(self):
+        with self._condition:
+            return {
+                "rate": round(self.rate, 3),
+                "queue_depth": self.queue_depth,
+                "tokens": round(self.tokens, 3),
+                "successes": self.successes,
+                "throttles": self.throttles,
+            }
+
+
+bedrock_rate_limiter = AdaptiveRateLimiter(
+    initial_rate=BEDROCK_RATE_LIMIT_INITIAL,
+    min_rate=BEDROCK_RATE_LIMIT_MIN,
+    max_rate=BEDROCK_RATE_LIMIT_MAX,
+    increase_step=BEDROCK_RATE_LIMIT_INCREASE,
+    decrease_factor=BEDROCK_RATE_LIMIT_DECREASE,
+    burst=BEDROCK_RATE_LIMIT_BURST,
+)
+
+
+def call_with_rate_limit(operation, *args, max_retries=BEDROCK_MAX_RETRIES, **kwargs):
+    """Call a Bedrock operation through the shared limiter, retrying throttles with full jitter backoff.
+
+    operation may also consume a response stream, so throttles raised mid-stream are retried as well.
+    """
+    for attempt in range(max_retries):
+        bedrock_rate_limiter.acquire()
+        try:
+            response = operation(*args, **kwargs)
+            bedrock_rate_limiter.on_success()
+            return response
+        except ClientError as e:
+            if not is_throttling_error(e):
+                raise e  # Re-raise if it's not a rate limit error
+            bedrock_rate_limiter.on_throttle()
+            if attempt == max_retries - 1:
+                raise e  # If this was our last retry, re-raise the exception
+
+            delay = full_jitter_backoff(attempt)
+            print(f"Rate limit exceeded. Retrying in {delay:.2f} seconds... (Attempt {attempt + 1}/{max_retries}) "
+                  f"limiter: {bedrock_rate_limiter.metrics()}")
+            time.sleep(delay)
@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import tempfile
+import boto3
+from botocore.exceptions import ClientError
+
+AWS_REGION = os.getenv("AWS_REGION")
+
+# Response cache settings. Generations run at temperature 0, so identical requests
+# can be answered from the cache instead of paying for a new Bedrock generation.
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "86400"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "256"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Persistent tier: "disk" (default), "s3" or "none"
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "disk").lower()
+RESPONSE_CACHE_DIR = os.getenv(
+    "RESPONSE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "devgenius-response-cache"))
+RESPONSE_CACHE_S3_BUCKET = os.getenv("RESPONSE_CACHE_S3_BUCKET")
+RESPONSE_CACHE_S3_PREFIX = os.getenv("RESPONSE_CACHE_S3_PREFIX", "response-cache")
+
+
+def make_cache_key(messages, model_id, max_tokens, thinking=None):
+    """Canonical hash of everything that determines the model output."""
+    payload = {
+        "messages": messages,
+        "model_id": model_id,
+        "max_tokens": max_tokens,
+        "thinking": thinking,
+    }
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class DiskCacheTier:
+    """Persistent cache tier storing one JSON file per entry in a local directory."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key):
+        return self.directory / f"{key}.json"
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, entry):
+        path = self._path(key)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def delete(self, key):
+        try:
+            self._path(key).unlink()
+        except OSError:
+            pass
+
+    def _evict(self):
+        # Size based eviction, oldest files first
+        files = []
+        total = 0
+        for path in self.directory.glob("*.json"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        files.sort()
+        while files and total > self.max_bytes:
+            _, size, path = files.pop(0)
+            try:
+                path.unlink()
+                total -= size
+            except OSError:
+                pass
+
+
+class S3CacheTier:
+    """Persistent cache tier storing one JSON object per entry under an S3 prefix."""
+
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.s3_client = boto3.client('s3', region_name=AWS_REGION)
+
+    def _key(self, key):
+        return f"{self.prefix}/{key}.json"
+
+    def get(self, key):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self._key(key))
+            return json.loads(response['Body'].read())
+        except ClientError:
+            return None
+
+    def put(self, key, entry):
+        # Size based eviction is left to an S3 lifecycle rule on the prefix
+        self.s3_client.put_object(Body=json.dumps(entry), Bucket=self.bucket, Key=self._key(key))
+
+    def delete(self, key):
+        try:
+            self.s3_client.delete_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError:
+            pass
+
+
+class ResponseCache:
+    """Two tier (in-process LRU + persistent) cache for Bedrock generations."""
+
+    def __init__(self, ttl_seconds, max_entries, max_bytes, persistent_tier=None, enabled=True):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.persistent_tier = persistent_tier
+        self.enabled = enabled
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls):
+        persistent_tier = None
+        try:
+            if RESPONSE_CACHE_BACKEND == "s3" and RESPONSE_CACHE_S3_BUCKET:
+                persistent_tier = S3CacheTier(RESPONSE_CACHE_S3_BUCKET, RESPONSE_CACHE_S3_PREFIX)
+            elif RESPONSE_CACHE_BACKEND == "disk":
+                persistent_tier = DiskCacheTier(RESPONSE_CACHE_DIR, RESPONSE_CACHE_MAX_BYTES)
+        except OSError as e:
+            print(f"Response cache persistent tier disabled: {str(e)}")
+        return cls(
+            ttl_seconds=RESPONSE_CACHE_TTL_SECONDS,
+            max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+            max_bytes=RESPONSE_CACHE_MAX_BYTES,
+            persistent_tier=persistent_tier,
+            enabled=RESPONSE_CACHE_ENABLED,
+        )
+
+    def _expired(self, entry):
+        return time.time() - entry["created_at"] > self.ttl_seconds
+
+    def get(self, key):
+        """Return (result, stop_reason) for the key, or None on a miss."""
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry["result"], entry["stop_reason"]
+
+        if self.persistent_tier is not None:
+            try:
+                entry = self.persistent_tier.get(key)
+            except Exception as e:
+                print(f"Response cache read failed: {str(e)}")
+                entry = None
+            if entry is not None and self._expired(entry):
+                self.persistent_tier.delete(key)
+                entry = None
+            if entry is not None:
+                with self._lock:
+                    self._insert(key, entry)
+                    self.persistent_hits += 1
+                return entry["result"], entry["stop_reason"]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, result, stop_reason):
+        if not self.enabled:
+            return
+
+        entry = {"result": result, "stop_reason": stop_reason, "created_at": time.time()}
+        with self._lock:
+            self._insert(key, entry)
+
+        if self.persistent_tier is not None:
+            try:
+                self.persistent_tier.put(key, entry)
+            except Exception as e:
+                print(f"Response cache write failed: {str(e)}")
+
+    def _insert(self, key, entry):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self._bytes += len(entry["result"].encode("utf-8"))
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry["result"].encode("utf-8"))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.persistent_hits + self.misses
+            return {
+                "hits": self.hits,
+                "persistent_hits": self.persistent_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.persistent_hits) / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+
+response_cache = ResponseCache.from_env()
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+from utils import bedrock_client
+from config import retrieve_environment_variables
+from rate_limiter import call_with_rate_limit
+
+# Semantic cache of first-turn agent answers. Near-duplicate questions are answered from the cache.
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+# Minimum cosine similarity between two questions for a hit
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_TTL_SECONDS = int(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "86400"))
+# Entries per agent alias, least recently used entries are evicted first
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "1000"))
+SEMANTIC_CACHE_EMBEDDING_MODEL_ID = os.getenv("SEMANTIC_CACHE_EMBEDDING_MODEL_ID", "amazon.titan-embed-text-v2:0")
+SEMANTIC_CACHE_DIMENSIONS = int(os.getenv("SEMANTIC_CACHE_DIMENSIONS", "512"))
+
+
+def embed_query(query):
+    """Unit length Titan embedding of a query."""
+    response = call_with_rate_limit(
+        bedrock_client.invoke_model,
+        body=json.dumps({"inputText": query, "dimensions": SEMANTIC_CACHE_DIMENSIONS, "normalize": True}),
+        modelId=SEMANTIC_CACHE_EMBEDDING_MODEL_ID,
+        contentType='application/json',
+        accept='application/json'
+    )
+    embedding = np.asarray(json.loads(response['body'].read())['embedding'], dtype=np.float32)
+    return embedding / (np.linalg.norm(embedding) or 1.0)
+
+
+class VectorIndex:
+    """Brute force cosine index over unit vectors, kept in LRU order."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # entry id -> entry dict
+        self._matrix = None
+        self._ids = []
+        self._next_id = 0
+
+    def _rebuild(self):
+        self._ids = list(self.entries)
+        self._matrix = np.stack([self.entries[entry_id]["embedding"] for entry_id in self._ids]) if self._ids else None
+
+    def _remove(self, entry_id):
+        del self.entries[entry_id]
+        self._matrix = None
+
+    def search(self, embedding, threshold):
+        """Return (entry, similarity) of the most similar live entry above the threshold, or (None, similarity)."""
+        now = time.time()
+        expired = [entry_id for entry_id, entry in self.entries.items() if now - entry["created_at"] > self.ttl]
+        for entry_id in expired:
+            self._remove(entry_id)
+        if not self.entries:
+            return None, None
+        if self._matrix is None:
+            self._rebuild()
+
+        similarities = self._matrix @ embedding
+        best = int(np.argmax(similarities))
+        similarity = float(similarities[best])
+        if similarity < threshold:
+            return None, similarity
+        entry_id = self._ids[best]
+        self.entries.move_to_end(entry_id)
+        return self.entries[entry_id], similarity
+
+    def add(self, embedding, entry):
+        """Add an entry and return the number of evicted entries."""
+        entry = dict(entry, embedding=embedding, created_at=time.time())
+        self.entries[self._next_id] = entry
+        self._next_id += 1
+        self._matrix = None
+        evicted = 0
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            evicted += 1
+        return evicted
+
+
+class SemanticCache:
+    def __init__(self, enabled, threshold, max_entries, ttl):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._indexes = {}  # agent id/alias -> VectorIndex
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.evictions = 0
+        self.embedding_seconds = 0.0
+
+    def _index(self):
+        # Answers depend on the agent version behind the alias, so each alias gets its own index
+        namespace = (f'{retrieve_environment_variables("BEDROCK_AGENT_ID")}/'
+                     f'{retrieve_environment_variables("BEDROCK_AGENT_ALIAS_ID")}')
+        if namespace not in self._indexes:
+            self._indexes[namespace] = VectorIndex(self.max_entries, self.ttl)
+        return self._indexes[namespace]
+
+    def lookup(self, query):
+        """Return (cached entry or None, query embedding). The embedding is None if it could not be computed."""
+        if not self.enabled:
+            return None, None
+        start = time.monotonic()
+        try:
+            embedding = embed_query(query)
+        except Exception as e:
+            print(f"Semantic cache embedding failed: {str(e)}")
+            return None, None
+        with self._lock:
+            self.embedding_seconds += time.monotonic() - start
+            self.lookups += 1
+            entry, similarity = self._index().search(embedding, self.threshold)
+            if entry is not None:
+                self.hits += 1
+        print(f"Semantic cache {'hit' if entry else 'miss'} (similarity {similarity}): {self.stats()}")
+        return entry, embedding
+
+    def store(self, query, embedding, answer, ask_user):
+        if not self.enabled or embedding is None:
+            return
+        with self._lock:
+            self.evictions += self._index().add(embedding, {"query": query, "answer": answer, "ask_user": ask_user})
+
+    def stats(self):
+        return {
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.lookups, 3) if self.lookups else 0.0,
+            "entries": sum(len(index.entries) for index in self._indexes.values()),
+            "evictions": self.evictions,
+            "avg_embedding_seconds": round(self.embedding_seconds / self.lookups, 3) if self.lookups else None,
+        }
+
+
+semantic_cache = SemanticCache(
+    enabled=SEMANTIC_CACHE_ENABLED,
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+    max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+    ttl=SEMANTIC_CACHE_TTL_SECONDS,
+)
@@ -0,0 +1,45 @@
+import streamlit as st
+from payload_store import payload_store
+from payload_store import is_pointer
+
+# Generated artifacts are kept in session state per message history ("messages" in "Build a solution",
+# "mod_messages" in "Modify your existing architecture"). Every change to a history bumps its version, which
+# invalidates the artifacts generated from the previous version. Until then the widgets render the stored
+# artifacts again without calling Bedrock.
+
+
+def _version_key(history):
+    return f"{history}_version"
+
+
+def history_version(history):
+    return st.session_state.get(_version_key(history), 0)
+
+
+def set_messages(history, messages):
+    st.session_state[history] = messages
+    st.session_state[_version_key(history)] = history_version(history) + 1
+
+
+def append_message(history, message):
+    if history not in st.session_state:
+        st.session_state[history] = []
+    st.session_state[history].append(message)
+    st.session_state[_version_key(history)] = history_version(history) + 1
+
+
+def get_artifact(history, task):
+    """Return the artifact generated for the current version of the history, or None."""
+    entry = st.session_state.get("artifacts", {}).get((history, task))
+    if entry is None or entry["version"] != history_version(history):
+        return None
+    # Artifacts of a resumed conversation may still be pointers to offloaded payloads
+    if is_pointer(entry["artifact"]):
+        entry["artifact"] = payload_store.text(entry["artifact"])
+    return entry["artifact"]
+
+
+def put_artifact(history, task, artifact):
+    if "artifacts" not in st.session_state:
+        st.session_state.artifacts = {}
+    st.session_state.artifacts[(history, task)] = {"version": history_version(history), "artifact": artifact}
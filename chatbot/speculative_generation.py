@@ -0,0 +1,18 @@
+import os
+from generation_jobs import generation_jobs
+
+# Start the artifacts users usually ask for next as soon as the agent has a final answer
+SPECULATIVE_GENERATION = os.getenv("SPECULATIVE_GENERATION", "false").lower() == "true"
+SPECULATIVE_TASKS = [task.strip() for task in os.getenv("SPECULATIVE_TASKS", "cost,arch").split(",") if task.strip()]
+
+
+def start_speculation(conversation_id, messages, generators):
+    """Submit the SPECULATIVE_TASKS generations as jobs, which the widgets pick up once selected.
+
+    generators is a list of (task, request builder, generation options), see concurrent_generation.py.
+    """
+    for task, build_request, options in generators:
+        if task not in SPECULATIVE_TASKS:
+            continue
+        _, request_messages = build_request(messages[:])
+        generation_jobs.submit(conversation_id, task, request_messages, **options)
@@ -0,0 +1,157 @@
+"""Precomputed agent answers for the topic starter questions.
+
+Answers are stored per agent and agent alias, so deploying a new alias starts from a fresh set.
+Warm the store after a deployment with:
+    python starter_answers.py refresh
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import hashlib
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+from botocore.exceptions import ClientError
+from utils import s3_client
+from utils import invoke_bedrock_agent
+from config import retrieve_environment_variables
+
+STARTER_QUESTIONS = {
+    "Data Lake": "How can I build an enterprise data lake on AWS?",
+    "Log Analytics": "How can I build a log analytics solution on AWS?"
+}
+
+# Where the answers are kept: "s3" (default, shared by all containers), "disk" or "none"
+STARTER_ANSWERS_BACKEND = os.getenv("STARTER_ANSWERS_BACKEND", "s3").lower()
+STARTER_ANSWERS_S3_PREFIX = os.getenv("STARTER_ANSWERS_S3_PREFIX", "starter-answers")
+STARTER_ANSWERS_DIR = os.getenv(
+    "STARTER_ANSWERS_DIR", os.path.join(tempfile.gettempdir(), "devgenius-starter-answers"))
+# Older answers are still served, but refreshed in the background
+STARTER_ANSWERS_MAX_AGE_SECONDS = int(os.getenv("STARTER_ANSWERS_MAX_AGE_SECONDS", "86400"))
+
+
+class StarterAnswerStore:
+    def __init__(self, backend, max_age):
+        self.backend = backend
+        self.max_age = max_age
+        self._memory = {}
+        self._lock = threading.Lock()
+        self._refreshing = set()
+
+    @property
+    def enabled(self):
+        return self.backend in ("s3", "disk")
+
+    def _key(self, question):
+        agent_id = retrieve_environment_variables("BEDROCK_AGENT_ID")
+        agent_alias_id = retrieve_environment_variables("BEDROCK_AGENT_ALIAS_ID")
+        question_hash = hashlib.sha256(question.encode("utf-8")).hexdigest()
+        return f"{agent_id}/{agent_alias_id}/{question_hash}.json"
+
+    def _read(self, key):
+        try:
+            if self.backend == "s3":
+                response = s3_client.get_object(
+                    Bucket=retrieve_environment_variables("S3_BUCKET_NAME"), Key=f"{STARTER_ANSWERS_S3_PREFIX}/{key}")
+                return json.loads(response['Body'].read())
+            with open(Path(STARTER_ANSWERS_DIR) / key, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (ClientError, OSError, ValueError):
+            return None
+
+    def _write(self, key, entry):
+        body = json.dumps(entry)
+        if self.backend == "s3":
+            s3_client.put_object(
+                Body=body, Bucket=retrieve_environment_variables("S3_BUCKET_NAME"),
+                Key=f"{STARTER_ANSWERS_S3_PREFIX}/{key}", ContentType="application/json")
+        else:
+            path = Path(STARTER_ANSWERS_DIR) / key
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(body, encoding="utf-8")
+
+    def get(self, question):
+        """Return the stored answer to a starter question, or None. Stale answers are refreshed in the background."""
+        if not self.enabled:
+            return None
+        key = self._key(question)
+        with self._lock:
+            entry = self._memory.get(key)
+        if entry is None:
+            entry = self._read(key)
+            if entry is None:
+                return None
+            with self._lock:
+                self._memory[key] = entry
+
+        if time.time() - entry["generated_at"] > self.max_age:
+            self.refresh_in_background(question)
+        return entry["answer"]
+
+    def put(self, question, answer):
+        if not self.enabled:
+            return
+        key = self._key(question)
+        entry = {
+            "question": question,
+            "answer": answer,
+            "agent_id": retrieve_environment_variables("BEDROCK_AGENT_ID"),
+            "agent_alias_id": retrieve_environment_variables("BEDROCK_AGENT_ALIAS_ID"),
+            "generated_at": time.time(),
+        }
+        with self._lock:
+            self._memory[key] = entry
+        try:
+            self._write(key, entry)
+        except (ClientError, OSError) as e:
+            print(f"Starter answer write failed: {str(e)}")
+
+    def refresh(self, question):
+        # A throwaway agent session, so the answer does not depend on any user's conversation
+        answer = invoke_bedrock_agent(str(uuid.uuid4()), question).answer
+        self.put(question, answer)
+        return answer
+
+    def refresh_in_background(self, question):
+        with self._lock:
+            if question in self._refreshing:
+                return
+            self._refreshing.add(question)
+
+        def run():
+            try:
+                self.refresh(question)
+            except Exception as e:
+                print(f"Starter answer refresh failed for '{question}': {str(e)}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(question)
+
+        threading.Thread(target=run, name="starter-answer-refresh", daemon=True).start()
+
+
+starter_answer_store = StarterAnswerStore(STARTER_ANSWERS_BACKEND, STARTER_ANSWERS_MAX_AGE_SECONDS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["refresh"])
+    parser.add_argument("--topic", action="append", choices=list(STARTER_QUESTIONS),
+                        help="topic to refresh (default: all)")
+    args = parser.parse_args()
+
+    if not starter_answer_store.enabled:
+        print("STARTER_ANSWERS_BACKEND is none, nothing to refresh")
+        return 1
+    for topic in args.topic or STARTER_QUESTIONS:
+        start = time.monotonic()
+        answer = starter_answer_store.refresh(STARTER_QUESTIONS[topic])
+        print(f"Refreshed '{topic}' ({len(answer)} characters) in {time.monotonic() - start:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,50 @@
+import os
+import time
+
+# Streamed text is coalesced and flushed to the UI at most every STREAM_RENDER_INTERVAL_SECONDS,
+# or sooner once STREAM_RENDER_FLUSH_BYTES of new text are pending.
+STREAM_RENDER_INTERVAL_SECONDS = float(os.getenv("STREAM_RENDER_INTERVAL_SECONDS", "0.25"))
+STREAM_RENDER_FLUSH_BYTES = int(os.getenv("STREAM_RENDER_FLUSH_BYTES", "16384"))
+
+
+class StreamRenderer:
+    """Buffer streamed text chunks and re-render a Streamlit placeholder on a time or size threshold."""
+
+    def __init__(self, placeholder, render=None, interval=None, flush_bytes=None):
+        self.placeholder = placeholder
+        self.render = render or placeholder.markdown
+        self.interval = STREAM_RENDER_INTERVAL_SECONDS if interval is None else interval
+        self.flush_bytes = STREAM_RENDER_FLUSH_BYTES if flush_bytes is None else flush_bytes
+        self.chunks = []
+        self.pending_bytes = 0
+        self.last_flush = time.monotonic()
+        self.flushes = 0
+
+    def write(self, text):
+        self.chunks.append(text)
+        self.pending_bytes += len(text)
+        if self.pending_bytes >= self.flush_bytes or time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if not self.pending_bytes:
+            return
+        # Collapse the buffered chunks so the next join only touches new text
+        text = ''.join(self.chunks)
+        self.chunks = [text]
+        self.pending_bytes = 0
+        self.last_flush = time.monotonic()
+        self.flushes += 1
+        self.render(text)
+
+    def reset(self):
+        """Drop buffered text, e.g. when a throttled stream is retried from the start."""
+        self.chunks = []
+        self.pending_bytes = 0
+
+    def close(self):
+        """Final flush, called once the stream has finished."""
+        self.flush()
+
+    def text(self):
+        return ''.join(self.chunks)
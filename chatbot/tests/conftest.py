@@ -0,0 +1,17 @@
+import os
+import sys
+import json
+
+# The app modules read their configuration at import time
+os.environ.setdefault("AWS_REGION", "us-east-1")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ.setdefault("AWS_RESOURCE_NAMES_PARAMETER", json.dumps({
+    "CONVERSATION_TABLE_NAME": "conversation-table",
+    "FEEDBACK_TABLE_NAME": "feedback-table",
+    "SESSION_TABLE_NAME": "session-table",
+    "S3_BUCKET_NAME": "artifact-bucket",
+}))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
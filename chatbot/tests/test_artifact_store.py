@@ -0,0 +1,49 @@
+import json
+import pytest
+
+moto = pytest.importorskip("moto")
+import boto3
+import artifact_store
+from artifact_store import ArtifactStore
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="artifact-bucket")
+        monkeypatch.setattr(artifact_store, "s3_client", client)
+        yield client
+
+
+@pytest.fixture
+def store(s3_client):
+    return ArtifactStore(workers=2, max_attempts=2, backoff_seconds=0, max_conversations=10)
+
+
+def manifest(s3_client, conversation_id):
+    body = s3_client.get_object(Bucket="artifact-bucket", Key=f"{conversation_id}/manifest.json")["Body"].read()
+    return json.loads(body)
+
+
+def test_identical_content_is_uploaded_once_per_type(s3_client, store):
+    cost_key = store.put("c1", "cost", "same content")
+    assert store.flush("c1")
+    assert store.put("c1", "cost", "same content") == cost_key
+    assert store.flush("c1")
+    assert store.metrics()["uploaded"] == 1
+    assert store.metrics()["skipped"] == 1
+
+
+def test_identical_content_of_another_type_is_uploaded(s3_client, store):
+    cost_key = store.put("c1", "cost", "same content")
+    assert store.flush("c1")
+    doc_key = store.put("c1", "doc", "same content")
+    assert store.flush("c1")
+
+    assert cost_key != doc_key
+    artifacts = manifest(s3_client, "c1")["artifacts"]
+    assert (artifacts["cost"]["key"], artifacts["doc"]["key"]) == (cost_key, doc_key)
+    for key in (cost_key, doc_key):
+        assert s3_client.get_object(Bucket="artifact-bucket", Key=key)["Body"].read() == b"same content"
+    assert store.metrics()["uploaded"] == 2
@@ -0,0 +1,51 @@
+import pytest
+
+moto = pytest.importorskip("moto")
+pytest.importorskip("streamlit")
+
+
+@pytest.fixture(scope="module")
+def context_manager():
+    # utils looks up the account id when it is imported
+    with moto.mock_aws():
+        import context_manager
+        yield context_manager
+
+
+def conversation(*contents):
+    return [{"role": "user" if index % 2 == 0 else "assistant", "content": content}
+            for index, content in enumerate(contents)]
+
+
+def test_history_within_budget_is_sent_unchanged(context_manager):
+    messages = conversation("Use RDS?", "Which engine?", "yes", "Multi-AZ?", "yes", "Done.")
+    assert context_manager.fit_to_budget(messages, "cost") is messages
+
+
+def test_repeated_short_answers_are_kept(context_manager):
+    messages = conversation("Start", "Use RDS?", "yes", "Enable Multi-AZ?", "yes", "Noted.")
+    assert context_manager.deduplicate_messages(messages) == messages
+
+
+def test_repeated_turns_are_sent_once(context_manager):
+    messages = conversation("Add a cache", "Added ElastiCache.", "Add a cache", "Added ElastiCache.", "Thanks", "Ok.")
+    assert context_manager.deduplicate_messages(messages) == messages[2:]
+
+
+def test_repeated_long_answer_is_replaced_by_a_note(context_manager):
+    answer = "Here is the architecture. " * 40
+    messages = conversation("Design it", answer, "Again please", answer)
+    deduplicated = context_manager.deduplicate_messages(messages)
+    assert [message["role"] for message in deduplicated] == ["user", "assistant", "user", "assistant"]
+    assert deduplicated[1]["content"] == context_manager.REPEATED_ANSWER_NOTE
+    assert deduplicated[3]["content"] == answer
+
+
+def test_over_budget_history_keeps_user_decisions(context_manager, monkeypatch):
+    monkeypatch.setattr(context_manager, "CONTEXT_POLICY", "truncate")
+    monkeypatch.setitem(context_manager.WIDGET_INPUT_TOKEN_BUDGETS, "cost", 40)
+    answer = "Here is the architecture. " * 20
+    messages = conversation(
+        "Design it", answer, "Again please", answer, "Go on", "Use RDS?", "yes", "Enable Multi-AZ?", "yes")
+    fitted = context_manager.fit_to_budget(messages, "cost")
+    assert fitted[-4:] == messages[-4:]
@@ -0,0 +1,150 @@
+import threading
+import pytest
+
+moto = pytest.importorskip("moto")
+import boto3
+from dynamodb import DynanmoPersistance
+
+
+@pytest.fixture
+def dynamodb_resource():
+    with moto.mock_aws():
+        resource = boto3.resource("dynamodb", region_name="us-east-1")
+        for name, sort_key in (("conversation-table", "uuid"), ("feedback-table", "uuid"), ("session-table", None)):
+            keys = [("conversation_id", "HASH")] + ([(sort_key, "RANGE")] if sort_key else [])
+            resource.create_table(
+                TableName=name,
+                KeySchema=[{"AttributeName": key, "KeyType": key_type} for key, key_type in keys],
+                AttributeDefinitions=[{"AttributeName": key, "AttributeType": "S"} for key, _ in keys],
+                BillingMode="PAY_PER_REQUEST")
+        yield resource
+
+
+def persistence_for(dynamodb_resource, **kwargs):
+    kwargs.setdefault("backoff_seconds", 0)
+    persistence = DynanmoPersistance(**kwargs)
+    persistence.dynamodb_resource = dynamodb_resource
+    return persistence
+
+
+class HeldWorker:
+    """Blocks the first BatchWriteItem call until released, so later writes pile up in the queue."""
+
+    def __init__(self, persistence):
+        self.entered = threading.Event()
+        self.released = threading.Event()
+        self.client = persistence.dynamodb_resource.meta.client
+        self.batch_write_item = self.client.batch_write_item
+        self.first = True
+
+    def __call__(self, **kwargs):
+        if self.first:
+            self.first = False
+            self.entered.set()
+            assert self.released.wait(10)
+        return self.batch_write_item(**kwargs)
+
+    def hold(self, persistence, monkeypatch):
+        monkeypatch.setattr(self.client, "batch_write_item", self)
+        persistence.save_session("held", "user", "user@example.com")
+        assert self.entered.wait(10)
+        return self
+
+
+def held_worker(persistence, monkeypatch):
+    return HeldWorker(persistence).hold(persistence, monkeypatch)
+
+
+def session(dynamodb_resource, conversation_id):
+    return dynamodb_resource.Table("session-table").get_item(Key={"conversation_id": conversation_id}).get("Item")
+
+
+def test_updates_apply_after_the_puts_queued_before_them(dynamodb_resource, monkeypatch):
+    persistence = persistence_for(dynamodb_resource)
+    worker = held_worker(persistence, monkeypatch)
+    persistence.save_session("c1", "user", "user@example.com")
+    persistence.update_session("c1", "https://example.com/artifacts.zip")
+    for turn in range(3):
+        persistence.save_conversation("c1", f"prompt {turn}", f"response {turn}")
+    worker.released.set()
+
+    assert persistence.flush(timeout=10)
+    assert session(dynamodb_resource, "c1")["presigned_url"] == "https://example.com/artifacts.zip"
+    items = [item for page in persistence.query_conversation("c1", 10) for item in page]
+    assert [item["user_response"] for item in items] == ["prompt 0", "prompt 1", "prompt 2"]
+    assert persistence.metrics()["written"] == 6
+
+
+def test_full_queue_writes_on_the_caller_thread_in_order(dynamodb_resource, monkeypatch):
+    persistence = persistence_for(dynamodb_resource, queue_size=1, block_seconds=0.05)
+    worker = held_worker(persistence, monkeypatch)
+    persistence.update_session("held", "https://example.com/first.zip")
+    caller = threading.Thread(target=persistence.update_session, args=("held", "https://example.com/second.zip"))
+    caller.start()
+
+    # The caller waits for the batch in flight instead of overtaking it and the queued update
+    caller.join(0.2)
+    assert caller.is_alive()
+    worker.released.set()
+    caller.join(10)
+    assert not caller.is_alive()
+
+    assert persistence.flush(timeout=10)
+    assert session(dynamodb_resource, "held")["presigned_url"] == "https://example.com/second.zip"
+    metrics = persistence.metrics()
+    assert (metrics["written"], metrics["sync_writes"], metrics["queue_depth"]) == (3, 1, 0)
+
+
+def test_unprocessed_items_are_retried(dynamodb_resource, monkeypatch):
+    persistence = persistence_for(dynamodb_resource)
+    client = dynamodb_resource.meta.client
+    batch_write_item = client.batch_write_item
+    batches = []
+
+    def write_first_item_only(RequestItems):
+        (table, requests), = RequestItems.items()
+        batches.append(len(requests))
+        if len(batches) > 2 or len(requests) < 2:
+            return batch_write_item(RequestItems=RequestItems)
+        batch_write_item(RequestItems={table: requests[:1]})
+        return {"UnprocessedItems": {table: requests[1:]}}
+
+    monkeypatch.setattr(client, "batch_write_item", write_first_item_only)
+    worker = held_worker(persistence, monkeypatch)
+    for i in range(3):
+        persistence.save_session(f"c{i}", "user", "user@example.com")
+    worker.released.set()
+
+    assert persistence.flush(timeout=10)
+    # The held session, the three sessions, then the two left unprocessed
+    assert batches == [1, 3, 2]
+    assert all(session(dynamodb_resource, f"c{i}") is not None for i in range(3))
+    metrics = persistence.metrics()
+    assert (metrics["written"], metrics["failed"], metrics["retries"]) == (4, 0, 1)
+
+
+def test_invalid_item_does_not_drop_the_batch(dynamodb_resource, monkeypatch):
+    persistence = persistence_for(dynamodb_resource)
+    worker = held_worker(persistence, monkeypatch)
+    for i in range(10):
+        persistence.save_session(f"c{i}", "user", "user@example.com")
+    # Over the 400 KB item limit
+    persistence.save_session("too-large", "user", "user@example.com", notes="x" * 500 * 1024)
+    worker.released.set()
+
+    assert persistence.flush(timeout=10)
+    assert all(session(dynamodb_resource, f"c{i}") is not None for i in range(10))
+    assert session(dynamodb_resource, "too-large") is None
+    metrics = persistence.metrics()
+    assert (metrics["written"], metrics["failed"], metrics["retries"]) == (11, 1, 0)
+
+
+def test_flush_times_out_while_writes_are_pending(dynamodb_resource, monkeypatch):
+    persistence = persistence_for(dynamodb_resource)
+    worker = held_worker(persistence, monkeypatch)
+    persistence.save_session("c1", "user", "user@example.com")
+
+    assert persistence.flush(timeout=0.1) is False
+    worker.released.set()
+    assert persistence.flush(timeout=10)
+    assert session(dynamodb_resource, "c1") is not None
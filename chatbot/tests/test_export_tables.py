@@ -0,0 +1,77 @@
+import pytest
+
+moto = pytest.importorskip("moto")
+pytest.importorskip("pyarrow")
+import boto3
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from export_tables import export_tables
+
+TABLE_NAMES = {"conversation": "conversation-table", "feedback": "feedback-table"}
+
+
+@pytest.fixture
+def seeded_tables():
+    with moto.mock_aws():
+        resource = boto3.resource("dynamodb", region_name="us-east-1")
+        for name in TABLE_NAMES.values():
+            resource.create_table(
+                TableName=name,
+                KeySchema=[{"AttributeName": "conversation_id", "KeyType": "HASH"},
+                           {"AttributeName": "uuid", "KeyType": "RANGE"}],
+                AttributeDefinitions=[{"AttributeName": "conversation_id", "AttributeType": "S"},
+                                      {"AttributeName": "uuid", "AttributeType": "S"}],
+                BillingMode="PAY_PER_REQUEST")
+        for i in range(60):
+            resource.Table("conversation-table").put_item(Item={
+                "conversation_id": f"c{i % 6}",
+                "uuid": f"u{i:03d}",
+                "user_response": f"prompt {i}",
+                "assistant_response": "answer " * i,
+                "interaction_type": ["agent", "cdk", "modify"][i % 3],
+                "history": "messages",
+                "conversation_time": f"2026-10-0{1 + i % 2} 10:00:00",
+            })
+        for i in range(20):
+            resource.Table("feedback-table").put_item(Item={
+                "conversation_id": f"c{i % 6}",
+                "uuid": f"f{i:03d}",
+                "feedback": i % 2,
+                "feedback_explanation": "explanation",
+                "response": "answer",
+                "conversation_time": "2026-10-01 10:00:00",
+                "bedrock_model": "model-a" if i < 15 else "model-b",
+                "use_case": "generate_cdk",
+            })
+        yield
+
+
+def partition_rows(directory):
+    rows = {}
+    for path in directory.rglob("*.parquet"):
+        partition = path.relative_to(directory).parts[:-1]
+        rows[partition] = rows.get(partition, 0) + pq.read_metadata(path).num_rows
+    return rows
+
+
+def test_export_partitions_rows_by_date_and_use_case(seeded_tables, tmp_path):
+    results = export_tables(str(tmp_path), ["conversation", "feedback"], TABLE_NAMES, segments=3, workers=0,
+                            rows_per_group=4)
+
+    assert sum(result["items"] for result in results) == 80
+    assert partition_rows(tmp_path / "conversation") == {
+        (f"date=2026-10-0{day}", f"use_case={use_case}"): 10
+        for day in (1, 2) for use_case in ("agent", "generate_cdk", "modify")}
+    assert partition_rows(tmp_path / "feedback") == {("date=2026-10-01", "use_case=generate_cdk"): 20}
+
+    conversation = ds.dataset(tmp_path / "conversation", partitioning="hive").to_table()
+    assert sorted(conversation.column("uuid").to_pylist()) == [f"u{i:03d}" for i in range(60)]
+
+    by_model = pq.read_table(tmp_path / "aggregates" / "feedback_by_model.parquet").to_pylist()
+    assert {(row["bedrock_model"], row["total"]) for row in by_model} == {("model-a", 15), ("model-b", 5)}
+
+
+def test_export_refuses_a_non_empty_directory(seeded_tables, tmp_path):
+    export_tables(str(tmp_path), ["feedback"], TABLE_NAMES, segments=1, workers=0)
+    with pytest.raises(FileExistsError):
+        export_tables(str(tmp_path), ["feedback"], TABLE_NAMES, segments=1, workers=0)
@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import random
+import threading
+
+# Compact agent trace records, written off the request thread. Destination: "stdout" (default), "file" or "none"
+AGENT_TRACE_SINK = os.getenv("AGENT_TRACE_SINK", "stdout").lower()
+AGENT_TRACE_FILE = os.getenv("AGENT_TRACE_FILE", "agent-traces.jsonl")
+# Fraction of agent invocations whose traces are recorded
+AGENT_TRACE_SAMPLE_RATE = float(os.getenv("AGENT_TRACE_SAMPLE_RATE", "1.0"))
+# Records are dropped rather than blocking the stream when the writer falls behind
+AGENT_TRACE_QUEUE_SIZE = int(os.getenv("AGENT_TRACE_QUEUE_SIZE", "1000"))
+# Free text (rationale, knowledge base queries) is truncated to this many characters
+AGENT_TRACE_TEXT_LIMIT = int(os.getenv("AGENT_TRACE_TEXT_LIMIT", "500"))
+
+
+def _truncate(text):
+    if text is None or len(text) <= AGENT_TRACE_TEXT_LIMIT:
+        return text
+    return text[:AGENT_TRACE_TEXT_LIMIT] + "..."
+
+
+def compact_step(step_trace):
+    """Reduce one orchestration (or pre/post processing) step to the fields needed for latency analysis."""
+    if 'rationale' in step_trace:
+        rationale = step_trace['rationale']
+        return {"step": "rationale", "trace_id": rationale.get('traceId'), "text": _truncate(rationale.get('text'))}
+
+    if 'invocationInput' in step_trace:
+        invocation_input = step_trace['invocationInput']
+        record = {"step": "invocation_input", "trace_id": invocation_input.get('traceId'),
+                  "invocation_type": invocation_input.get('invocationType')}
+        if 'knowledgeBaseLookupInput' in invocation_input:
+            lookup = invocation_input['knowledgeBaseLookupInput']
+            record.update(knowledge_base_id=lookup.get('knowledgeBaseId'), query=_truncate(lookup.get('text')))
+        if 'actionGroupInvocationInput' in invocation_input:
+            record["action_group"] = invocation_input['actionGroupInvocationInput'].get('actionGroupName')
+        return record
+
+    if 'modelInvocationInput' in step_trace:
+        model_input = step_trace['modelInvocationInput']
+        return {"step": "model_input", "trace_id": model_input.get('traceId'), "type": model_input.get('type'),
+                "prompt_chars": len(model_input.get('text') or "")}
+
+    if 'modelInvocationOutput' in step_trace:
+        model_output = step_trace['modelInvocationOutput']
+        usage = model_output.get('metadata', {}).get('usage', {})
+        return {"step": "model_output", "trace_id": model_output.get('traceId'),
+                "input_tokens": usage.get('inputTokens'), "output_tokens": usage.get('outputTokens')}
+
+    if 'observation' in step_trace:
+        observation = step_trace['observation']
+        record = {"step": "observation", "trace_id": observation.get('traceId'), "type": observation.get('type')}
+        if 'knowledgeBaseLookupOutput' in observation:
+            record["references"] = len(observation['knowledgeBaseLookupOutput'].get('retrievedReferences', []))
+        if 'finalResponse' in observation:
+            record["final_response_chars"] = len(observation['finalResponse'].get('text') or "")
+        return record
+
+    return {"step": next(iter(step_trace), "unknown")}
+
+
+class AgentTraceRecorder:
+    """Turns the traces of one invoke_agent call into timed records for the sink."""
+
+    def __init__(self, sink, sampled):
+        self.sink = sink
+        self.sampled = sampled
+        self.invocation_id = str(uuid.uuid4())
+        self.session_id = None
+        self.start = time.monotonic()
+        self.last_step = self.start
+        self.first_chunk_elapsed = None
+        self.steps = 0
+        self.step_durations = {}
+
+    def _elapsed(self, now):
+        return round(now - self.start, 3)
+
+    def record(self, trace):
+        """Record a trace event (event['trace'] of the invoke_agent stream)."""
+        if not self.sampled:
+            return
+        now = time.monotonic()
+        self.session_id = trace.get('sessionId', self.session_id)
+        for phase, step_trace in trace.get('trace', {}).items():
+            record = compact_step(step_trace) if isinstance(step_trace, dict) else {"step": "unknown"}
+            duration = round(now - self.last_step, 3)
+            # Time since the previous step is attributed to this step
+            self.step_durations[record["step"]] = round(self.step_durations.get(record["step"], 0) + duration, 3)
+            record.update(
+                record="step",
+                phase=phase,
+                invocation_id=self.invocation_id,
+                session_id=self.session_id,
+                timestamp=time.time(),
+                elapsed=self._elapsed(now),
+                step_duration=duration,
+            )
+            self.sink.emit(record)
+        self.steps += 1
+        self.last_step = now
+
+    def chunk_received(self):
+        if self.first_chunk_elapsed is None:
+            self.first_chunk_elapsed = self._elapsed(time.monotonic())
+
+    def finish(self, ask_user, answer_chars):
+        if not self.sampled:
+            return
+        self.sink.emit({
+            "record": "invocation",
+            "invocation_id": self.invocation_id,
+            "session_id": self.session_id,
+            "timestamp": time.time(),
+            "duration": self._elapsed(time.monotonic()),
+            "first_chunk_elapsed": self.first_chunk_elapsed,
+            "trace_events": self.steps,
+            "step_durations": self.step_durations,
+            "ask_user": ask_user,
+            "answer_chars": answer_chars,
+        })
+
+
+class TraceSink:
+    """Bounded queue of trace records drained by a background writer thread."""
+
+    def __init__(self, destination, path, sample_rate, queue_size):
+        self.destination = destination
+        self.path = path
+        self.sample_rate = sample_rate
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._writer = None
+        self.emitted = 0
+        self.dropped = 0
+        self.written = 0
+
+    @property
+    def enabled(self):
+        return self.destination != "none" and self.sample_rate > 0
+
+    def start_invocation(self):
+        return AgentTraceRecorder(self, self.enabled and random.random() < self.sample_rate)
+
+    def emit(self, record):
+        self._ensure_writer()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return
+        with self._lock:
+            self.emitted += 1
+
+    def _ensure_writer(self):
+        if self._writer is not None:
+            return
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name="agent-trace-writer", daemon=True)
+                self._writer.start()
+
+    def _run(self):
+        output = open(self.path, "a", encoding="utf-8") if self.destination == "file" else sys.stdout
+        while True:
+            record = self.queue.get()
+            try:
+                output.write(json.dumps(record, default=str) + "\n")
+                # Flush in batches, once the queue has been drained
+                if self.queue.empty():
+                    output.flush()
+                self.written += 1
+            except Exception as e:
+                print(f"Agent trace write failed: {str(e)}")
+            finally:
+                self.queue.task_done()
+
+    def metrics(self):
+        return {
+            "emitted": self.emitted,
+            "dropped": self.dropped,
+            "written": self.written,
+            "queue_depth": self.queue.qsize(),
+        }
+
+
+agent_trace_sink = TraceSink(
+    destination=AGENT_TRACE_SINK,
+    path=AGENT_TRACE_FILE,
+    sample_rate=AGENT_TRACE_SAMPLE_RATE,
+    queue_size=AGENT_TRACE_QUEUE_SIZE,
+)
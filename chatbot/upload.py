@@ -11,10 +11,14 @@ from langchain.document_loaders import UnstructuredPowerPointLoader
 # NORTHSTAR_S3_BUCKET_NAME = os.environ.get('NORTHSTAR_S3_BUCKET_NAME')
 NORTHSTAR_S3_BUCKET_NAME = "devgenius-reinvent-release-037225164867-us-west-2"
 AWS_REGION = os.getenv("AWS_REGION")
+# Point the Bedrock clients at a local stand-in such as fake_bedrock.py
+BEDROCK_ENDPOINT_URL = os.getenv("BEDROCK_ENDPOINT_URL")
 config = Config(read_timeout=1000, retries=(dict(max_attempts=5)))
 
-bedrock_agent_runtime_client = boto3.client('bedrock-agent-runtime', region_name=AWS_REGION)
-bedrock_client = boto3.client('bedrock-runtime', region_name=AWS_REGION, config=config)
+bedrock_agent_runtime_client = boto3.client('bedrock-agent-runtime', region_name=AWS_REGION,
+                                            endpoint_url=BEDROCK_ENDPOINT_URL)
+bedrock_client = boto3.client('bedrock-runtime', region_name=AWS_REGION, config=config,
+                              endpoint_url=BEDROCK_ENDPOINT_URL)
 s3_client = boto3.client('s3', region_name=AWS_REGION, config=config)
 s3_resource = boto3.resource('s3', region_name=AWS_REGION)
 
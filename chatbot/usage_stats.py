@@ -0,0 +1,65 @@
+import threading
+from collections import deque
+
+# Time to first token of this many recent calls is averaged
+USAGE_TTFT_WINDOW = 1000
+
+
+class BedrockUsageStats:
+    """Aggregates token usage, prompt cache reads/writes and time to first token across Bedrock calls."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_read_input_tokens = 0
+        self.cache_write_input_tokens = 0
+        self.cached_calls_ttft = deque(maxlen=USAGE_TTFT_WINDOW)
+        self.uncached_calls_ttft = deque(maxlen=USAGE_TTFT_WINDOW)
+
+    def record(self, usage, time_to_first_token=None):
+        with self._lock:
+            self.calls += 1
+            self.input_tokens += usage.get("input_tokens", 0)
+            self.output_tokens += usage.get("output_tokens", 0)
+            self.cache_read_input_tokens += usage.get("cache_read_input_tokens", 0)
+            self.cache_write_input_tokens += usage.get("cache_creation_input_tokens", 0)
+            if time_to_first_token is not None:
+                if usage.get("cache_read_input_tokens", 0):
+                    self.cached_calls_ttft.append(time_to_first_token)
+                else:
+                    self.uncached_calls_ttft.append(time_to_first_token)
+
+    def summary(self):
+        with self._lock:
+            total_input = self.input_tokens + self.cache_read_input_tokens + self.cache_write_input_tokens
+            avg_ttft_cached = _average(self.cached_calls_ttft)
+            avg_ttft_uncached = _average(self.uncached_calls_ttft)
+            return {
+                "calls": self.calls,
+                "input_tokens": self.input_tokens,
+                "output_tokens": self.output_tokens,
+                "cache_read_input_tokens": self.cache_read_input_tokens,
+                "cache_write_input_tokens": self.cache_write_input_tokens,
+                "cache_read_ratio": self.cache_read_input_tokens / total_input if total_input else 0.0,
+                "avg_ttft_cached": avg_ttft_cached,
+                "avg_ttft_uncached": avg_ttft_uncached,
+                # Time to first token saved by a prompt cache read, on average
+                "avg_ttft_saved": round(avg_ttft_uncached - avg_ttft_cached, 3)
+                if avg_ttft_cached is not None and avg_ttft_uncached is not None else None,
+            }
+
+
+def percentile(values, fraction):
+    """Percentile of sorted values, None when there are none."""
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(len(values) * fraction))], 3)
+
+
+def _average(values):
+    return round(sum(values) / len(values), 3) if values else None
+
+
+bedrock_usage_stats = BedrockUsageStats()
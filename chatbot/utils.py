@@ -1,5 +1,4 @@
 import streamlit as st
-import uuid
 import boto3
 import os
 import json
@@ -15,45 +14,123 @@ import zipfile
 import shutil
 from pathlib import Path
 import base64
+from response_cache import response_cache
+from response_cache import make_cache_key
+from rate_limiter import call_with_rate_limit
+from usage_stats import bedrock_usage_stats
+from model_router import ModelRouter
+from trace_sink import agent_trace_sink
+from dynamodb import persistence
+from payload_store import payload_store
+from artifact_store import artifact_store
+from config import retrieve_environment_variables
 
 AWS_REGION = os.getenv("AWS_REGION")
+# Point the Bedrock clients at a local stand-in such as fake_bedrock.py
+BEDROCK_ENDPOINT_URL = os.getenv("BEDROCK_ENDPOINT_URL")
 config = Config(read_timeout=1000, retries=(dict(max_attempts=5)))
-BEDROCK_MAX_TOKENS = 128000
+# Throttles of the Bedrock clients are retried by call_with_rate_limit, not stacked under botocore's own retries
+bedrock_config = Config(read_timeout=1000, retries=dict(max_attempts=1, mode="standard"))
 BEDROCK_TEMPERATURE = 0
+# Anthropic prompt caching of the conversation prefix shared by the widget calls
+BEDROCK_PROMPT_CACHING = os.getenv("BEDROCK_PROMPT_CACHING", "true").lower() == "true"
+# Prefixes shorter than the model's minimum cacheable length are not worth a breakpoint
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv("PROMPT_CACHE_MIN_TOKENS", "1024"))
+# Window used to detect text repeated at the seam of a continuation
+CONTINUATION_MAX_OVERLAP = 2000
+CONTINUATION_MIN_OVERLAP = 16
+# Have the agent stream its final answer in several chunks instead of one chunk at the end
+AGENT_STREAM_FINAL_RESPONSE = os.getenv("AGENT_STREAM_FINAL_RESPONSE", "true").lower() == "true"
 sts_client = boto3.client('sts', region_name=AWS_REGION)
 ACCOUNT_ID = sts_client.get_caller_identity()["Account"]
-# Cross Region Inference for improved resilience https://docs.aws.amazon.com/bedrock/latest/userguide/cross-region-inference.html  # noqa
-BEDROCK_MODEL_ID = f"arn:aws:bedrock:{AWS_REGION}:{ACCOUNT_ID}:inference-profile/us.anthropic.claude-3-7-sonnet-20250219-v1:0"  # noqa
-
-dynamodb_resource = boto3.resource('dynamodb', region_name=AWS_REGION)
-bedrock_agent_runtime_client = boto3.client('bedrock-agent-runtime', region_name=AWS_REGION)
-bedrock_client = boto3.client('bedrock-runtime', region_name=AWS_REGION, config=config)
+# Per-task model and output limits, see model_router.py
+model_router = ModelRouter(AWS_REGION, ACCOUNT_ID)
+BEDROCK_MODEL_ID = model_router.default_model_id
+
+bedrock_agent_runtime_client = boto3.client('bedrock-agent-runtime', region_name=AWS_REGION, config=bedrock_config,
+                                            endpoint_url=BEDROCK_ENDPOINT_URL)
+bedrock_client = boto3.client('bedrock-runtime', region_name=AWS_REGION, config=bedrock_config,
+                              endpoint_url=BEDROCK_ENDPOINT_URL)
 s3_client = boto3.client('s3', region_name=AWS_REGION, config=config)
-secrets_client = boto3.client('secretsmanager', region_name=AWS_REGION, config=config)
 s3_resource = boto3.resource('s3', region_name=AWS_REGION)
 
 
 def invoke_bedrock_agent(
-        session_id, query, bedrock_agent='solution', enable_trace=True, end_session=False):
+        session_id, query, bedrock_agent='solution', enable_trace=True, end_session=False, session_state=None,
+        renderer=None, on_trace=None):
+    """Invoke the agent and read its answer. Returns the AgentResponseStream that was read.
+
+    The request and its event stream are read in one rate limited call, so throttles raised mid-stream are retried
+    too. The optional StreamRenderer shows the answer as it arrives and is reset for every attempt.
+    """
     agent_id = retrieve_environment_variables("BEDROCK_AGENT_ID")
     agent_alias_id = retrieve_environment_variables("BEDROCK_AGENT_ALIAS_ID")
 
-    return bedrock_agent_runtime_client.invoke_agent(
-        inputText=query,
-        agentId=agent_id,
-        agentAliasId=agent_alias_id,
-        enableTrace=enable_trace,
-        endSession=end_session,
-        sessionId=session_id
-    )
+    optional_params = {}
+    if AGENT_STREAM_FINAL_RESPONSE:
+        optional_params["streamingConfigurations"] = {"streamFinalResponse": True}
+    if session_state:
+        optional_params["sessionState"] = session_state
+
+    def invoke_and_read():
+        response = bedrock_agent_runtime_client.invoke_agent(
+            inputText=query,
+            agentId=agent_id,
+            agentAliasId=agent_alias_id,
+            enableTrace=enable_trace,
+            endSession=end_session,
+            sessionId=session_id,
+            **optional_params
+        )
+        agent_stream = AgentResponseStream(response['completion'], on_trace=on_trace)
+        if renderer:
+            renderer.reset()
+        for text in agent_stream:
+            if renderer:
+                renderer.write(text)
+        if renderer:
+            renderer.close()
+        return agent_stream
 
+    return call_with_rate_limit(invoke_and_read)
 
-@st.fragment
-def invoke_bedrock_model_streaming(messages, enable_reasoning=False, reasoning_budget=4096):
+
+def add_prompt_cache_breakpoint(messages):
+    """Return a copy of messages with a cache_control breakpoint at the end of the shared conversation prefix.
+
+    The prefix is everything before the final (widget specific) user instruction.
+    """
+    if len(messages) < 2:
+        return messages
+
+    prefix_chars = sum(len(json.dumps(message['content'], default=str)) for message in messages[:-1])
+    if prefix_chars / 4 < PROMPT_CACHE_MIN_TOKENS:
+        return messages
+
+    last_prefix_message = messages[-2]
+    content = last_prefix_message['content']
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    else:
+        content = [dict(block) for block in content]
+    content[-1]["cache_control"] = {"type": "ephemeral"}
+
+    return messages[:-2] + [{"role": last_prefix_message['role'], "content": content}] + messages[-1:]
+
+
+def stream_bedrock_model(messages, enable_reasoning=False, reasoning_budget=4096, bypass_cache=False, renderer=None,
+                         task="chat", on_model=None):
+    """Stream a generation from Bedrock without touching the UI directly.
+
+    The model and output limit come from the task's route. Text deltas are written to the optional
+    StreamRenderer, which is closed on message_stop. on_model is called with the model that answered, which
+    differs from the route's model after a fallback. Safe to call from worker threads.
+    """
+    route = model_router.route(task)
     body = {
         "anthropic_version": "bedrock-2023-05-31",
-        "max_tokens": BEDROCK_MAX_TOKENS,
-        "messages": messages,
+        "max_tokens": route.max_tokens,
+        "messages": add_prompt_cache_breakpoint(messages) if BEDROCK_PROMPT_CACHING else messages,
         "temperature": BEDROCK_TEMPERATURE,
     }
 
@@ -64,89 +141,161 @@ def invoke_bedrock_model_streaming(messages, enable_reasoning=False, reasoning_b
         }
         body["temperature"] = 1   # temperature may only be set to 1 when thinking is enabled.
 
-    retry_count = 0
-    max_retries = 3
-    initial_delay = 1
-    while retry_count < max_retries:
-        try:
-            response = bedrock_client.invoke_model_with_response_stream(
-                body=json.dumps(body),
-                modelId=BEDROCK_MODEL_ID,
-                contentType='application/json',
-                accept='application/json'
-            )
-
-            result = ""
-            response_placeholder = st.empty()
-            stop_reason = None
-
-            with response_placeholder.container(height=150):
-                for event in response['body']:
-                    chunk = event.get('chunk')
-                    if chunk and 'bytes' in chunk:
-                        decoded_chunk = json.loads(chunk['bytes'].decode('utf-8'))
-                        if decoded_chunk.get("type") == "content_block_delta":
-                            result += decoded_chunk["delta"].get("text", "")
-                            response_placeholder.markdown(result)
-                        elif decoded_chunk['type'] == 'message_delta':
-                            stop_reason = decoded_chunk['delta'].get('stop_reason')
-
-            response_placeholder.empty()
-            return result, stop_reason
-
-        except ClientError as e:
-            error_code = e.response.get('Error', {}).get('Code', '')
-            if error_code == 'ThrottlingException' or error_code == 'TooManyRequestsException':
-                if retry_count == max_retries - 1:
-                    raise e  # If this was our last retry, re-raise the exception
-
-                # Calculate exponential backoff delay
-                delay = initial_delay * (2 ** retry_count)
-                print(f"Rate limit exceeded. Retrying in {delay} seconds... (Attempt {retry_count + 1}/{max_retries})")
-                time.sleep(delay)
-                retry_count += 1
-            else:
-                raise e  # Re-raise if it's not a rate limit error
-
-
-def continuation_prompt(architecture_prompt, prev_response):
-    continuation_prompt = f"""
-    Please analyze the prompt and initial answer below. The initial answer is cut off due to token limits.
-    Provide a continuation relevant to the prompt, starting exactly where the initial answer left off.
-
-    <PROMPT>
-    {architecture_prompt}
-    </PROMPT>
-
-    <INITIAL ANSWER>
-    {prev_response}
-    </INITIAL ANSWER>
+    # Serve repeated generations from the response cache. Retry passes bypass_cache to force a new generation.
+    cache_key = make_cache_key(messages, route.model_id, body["max_tokens"], body.get("thinking"))
+    if not bypass_cache:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            print(f"Response cache hit: {response_cache.stats()}, Bedrock usage: {bedrock_usage_stats.summary()}")
+            # Fallback answers are cached under the fallback model, so a hit was answered by the route's model
+            if on_model:
+                on_model(route.model_id)
+            return cached
+
+    def consume_stream(model_id):
+        start_time = time.monotonic()
+        response = bedrock_client.invoke_model_with_response_stream(
+            body=json.dumps(body),
+            modelId=model_id,
+            contentType='application/json',
+            accept='application/json'
+        )
+
+        chunks = []
+        stop_reason = None
+        usage = {}
+        time_to_first_token = None
+        if renderer:
+            renderer.reset()
+
+        for event in response['body']:
+            chunk = event.get('chunk')
+            if chunk and 'bytes' in chunk:
+                decoded_chunk = json.loads(chunk['bytes'].decode('utf-8'))
+                if decoded_chunk.get("type") == "content_block_delta":
+                    text = decoded_chunk["delta"].get("text", "")
+                    if text:
+                        if time_to_first_token is None:
+                            time_to_first_token = time.monotonic() - start_time
+                        chunks.append(text)
+                        if renderer:
+                            renderer.write(text)
+                elif decoded_chunk['type'] == 'message_start':
+                    # Input usage, including prompt cache reads and writes
+                    usage.update(decoded_chunk['message'].get('usage', {}))
+                elif decoded_chunk['type'] == 'message_delta':
+                    stop_reason = decoded_chunk['delta'].get('stop_reason')
+                    usage.update(decoded_chunk.get('usage', {}))
+                elif decoded_chunk['type'] == 'message_stop' and renderer:
+                    renderer.close()
+
+        bedrock_usage_stats.record(usage, time_to_first_token)
+        print(f"Bedrock usage: {usage}, time to first token: {time_to_first_token}, "
+              f"totals: {bedrock_usage_stats.summary()}")
+        return ''.join(chunks), stop_reason
+
+    def generate(model_id, max_tokens):
+        answered_by.append(model_id)
+        return call_with_rate_limit(consume_stream, model_id)
+
+    # Throttles, including those raised while reading the stream, are retried through the shared limiter.
+    # A routed model that is unavailable is retried once on the default model.
+    answered_by = []
+    result, stop_reason = model_router.call(task, generate)
+    if on_model:
+        on_model(answered_by[-1])
+    if stop_reason is not None:
+        # A fallback answer is cached under the model that generated it
+        if answered_by[-1] != route.model_id:
+            cache_key = make_cache_key(messages, answered_by[-1], body["max_tokens"], body.get("thinking"))
+        response_cache.put(cache_key, result, stop_reason)
+    return result, stop_reason
+
+
+def continuation_messages(messages, partial_response):
+    """Continue a truncated answer by prefilling the assistant turn with the partial output."""
+    # The final assistant content may not end with trailing whitespace
+    return messages + [{"role": "assistant", "content": partial_response.rstrip()}]
+
+
+def merge_continuation(partial_response, continuation, max_overlap=CONTINUATION_MAX_OVERLAP,
+                       min_overlap=CONTINUATION_MIN_OVERLAP):
+    """Join a continuation to the partial answer, removing text duplicated at the seam."""
+    if not partial_response:
+        return continuation
+
+    partial_response = partial_response.rstrip()
+
+    # The model restarted and repeated the end of the partial answer: keep only what follows it
+    probe = partial_response[-max_overlap:]
+    if len(probe) >= min_overlap:
+        position = continuation.find(probe)
+        if position != -1:
+            return partial_response + continuation[position + len(probe):]
+
+    # Longest prefix of the continuation that is also a suffix of the partial answer
+    for size in range(min(max_overlap, len(partial_response), len(continuation)), min_overlap - 1, -1):
+        if partial_response.endswith(continuation[:size]):
+            return partial_response + continuation[size:]
+
+    return partial_response + continuation
+
+
+def cached_answer_session_state(question, answer):
+    """Session state handing an answer served from a cache to the agent, whose own session never saw it."""
+    return {"promptSessionAttributes": {"previous_question": question, "previous_answer": answer}}
+
+
+class AgentResponseStream:
+    """Iterates over the text chunks of an invoke_agent event stream as they arrive.
+
+    Traces are consumed along the way and handed to the trace sink as compact, timed records.
+    Once iterated, ask_user tells whether the agent is asking a follow up question and answer
+    holds the concatenated response.
     """
-    return prompts_to_messages(continuation_prompt)
 
+    def __init__(self, event_stream, on_trace=None):
+        self.event_stream = event_stream
+        self.on_trace = on_trace
+        self.ask_user = False
+        self.chunks = []
+        self.trace_recorder = agent_trace_sink.start_invocation()
 
-def read_agent_response(event_stream):
-    ask_user = False
-    agent_answer = ""
-    try:
-        for event in event_stream:
-            if 'chunk' in event:
-                data = event['chunk']['bytes']
-                agent_answer = data.decode('utf8')
-            elif 'trace' in event:
-                print(f"orchestration trace = {event['trace']['trace']['orchestrationTrace']}")
-                if 'observation' in event['trace']['trace']['orchestrationTrace']:
-                    if event['trace']['trace']['orchestrationTrace']['observation']['type'] == "ASK_USER":
-                        ask_user = True
-                    else:
-                        ask_user = False
+    @property
+    def answer(self):
+        return ''.join(self.chunks)
+
+    def __iter__(self):
+        try:
+            for event in self.event_stream:
+                if 'chunk' in event:
+                    text = event['chunk']['bytes'].decode('utf8')
+                    self.trace_recorder.chunk_received()
+                    self.chunks.append(text)
+                    yield text
+                elif 'trace' in event:
+                    self.trace_recorder.record(event['trace'])
+                    orchestration_trace = event['trace']['trace'].get('orchestrationTrace')
+                    if orchestration_trace is None:
+                        continue
+                    self.ask_user = orchestration_trace.get('observation', {}).get('type') == "ASK_USER"
+                    if self.on_trace:
+                        self.on_trace(orchestration_trace)
                 else:
-                    ask_user = False
-            else:
-                raise ValueError(f"Unexpected event: {event}")
-    except Exception as e:
-        raise ValueError(f"Unexpected Error:: {str(e)}")
-    return ask_user, agent_answer
+                    raise ValueError(f"Unexpected event: {event}")
+        except ClientError:
+            # Throttles raised mid-stream are retried by the caller
+            raise
+        except Exception as e:
+            raise ValueError(f"Unexpected Error:: {str(e)}")
+        self.trace_recorder.finish(self.ask_user, sum(len(chunk) for chunk in self.chunks))
+
+
+def read_agent_response(event_stream):
+    agent_stream = AgentResponseStream(event_stream)
+    for _ in agent_stream:
+        pass
+    return agent_stream.ask_user, agent_stream.answer
 
 
 def prompts_to_messages(prompts):
@@ -182,7 +331,6 @@ def convert_xml_to_html(xml_string):
 # Retrieve feedback
 @st.fragment
 def collect_feedback(uuid, response, use_case, bedrock_model_name):
-    FEEDBACK_TABLE_NAME = retrieve_environment_variables("FEEDBACK_TABLE_NAME")
     selected = st.feedback("thumbs", key=f"s-{uuid}")
     if selected is not None:
         print("about to write to dynamo")
@@ -206,77 +354,61 @@ def collect_feedback(uuid, response, use_case, bedrock_model_name):
                 'bedrock_model': bedrock_model_name,
                 'use_case': use_case
             }
-            feedback_table = dynamodb_resource.Table(FEEDBACK_TABLE_NAME)
             print(f"About to write item to dynamodb: {item}")
-            feedback_table.put_item(Item=item)
-            print(f"updated item in DynamoDB table: {FEEDBACK_TABLE_NAME}")
+            persistence.save_feedback(item)
             sentiment_mapping = [":material/thumb_down:", ":material/thumb_up:"]
             st.markdown(f"Feedback rating: {sentiment_mapping[selected]}. Feedback text: {text}")
 
 
-def retrieve_environment_variables(key):
-    ssm_parameter = json.loads(os.getenv("AWS_RESOURCE_NAMES_PARAMETER"))
-    return ssm_parameter[key]
-
-
-def retrieve_cognito_details(key):
-    response = secrets_client.get_secret_value(SecretId=retrieve_environment_variables("COGNITO_SECRET_ID"))
-    cognito_details = json.loads(response['SecretString'])
-    return cognito_details[key]
-
-
 # Store conversation details in DynamoDB
-def save_conversation(conversation_id, prompt, response):
-    CONVERSATION_TABLE_NAME = retrieve_environment_variables("CONVERSATION_TABLE_NAME")
-    item = {
-        'conversation_id': conversation_id,
-        'uuid': str(uuid.uuid4()),
-        'user_response': prompt,
-        'assistant_response': response,
-        'conversation_time': datetime.datetime.now(tz=datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
-    }
-    dynamodb_resource.Table(CONVERSATION_TABLE_NAME).put_item(Item=item)
+def save_conversation(conversation_id, prompt, response, interaction_type="agent", history="messages"):
+    persistence.save_conversation(conversation_id, prompt, response, interaction_type, history)
+    # The first prompt of a session is its summary in the session history
+    if interaction_type in ("agent", "modify") and st.session_state.get("session_summary_id") != conversation_id:
+        summary = persistence.update_session_summary(conversation_id, prompt, st.session_state.get('user_email'))
+        st.session_state.session_summary_id = conversation_id
+        # The write is still queued, so the session is added to the loaded history here instead of querying again
+        sessions = st.session_state.get("session_history")
+        if summary and sessions is not None and all(s['conversation_id'] != conversation_id for s in sessions):
+            sessions.insert(0, {
+                'conversation_id': conversation_id,
+                'session_start_time': st.session_state.get("session_start_time", ""),
+                'session_summary': summary
+            })
 
 
 # Store conversation details in DynamoDB
 def save_session(conversation_id, name, email):
-    SESSION_TABLE_NAME = retrieve_environment_variables("SESSION_TABLE_NAME")
-    item = {
-        'conversation_id': conversation_id,
-        'user_name': name,
-        'user_email': email,
-        'aws_midway_user_name': st.session_state.midway_user,
-        'session_start_time': datetime.datetime.now(tz=datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
-    }
-    dynamodb_resource.Table(SESSION_TABLE_NAME).put_item(Item=item)
+    return persistence.save_session(
+        conversation_id, name, email, aws_midway_user_name=st.session_state.get('midway_user'))
+
+
+# The Lambda@Edge authenticator (cognito-at-edge) validates the Cognito tokens before a request reaches the app and
+# keeps them in cookies named CognitoIdentityServiceProvider.<client id>.<user name>.<token type>
+def current_user():
+    """Return (name, email) of the signed in user from the ID token cookie, or (None, None) without one."""
+    for name, value in st.context.cookies.items():
+        if not (name.startswith("CognitoIdentityServiceProvider.") and name.endswith(".idToken")):
+            continue
+        try:
+            payload = value.split(".")[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        except (IndexError, ValueError) as e:
+            print(f"Unreadable ID token cookie: {str(e)}")
+            continue
+        return claims.get("name") or claims.get("cognito:username"), claims.get("email")
+    return None, None
 
 
 # Store conversation details in DynamoDB
 def update_session(conversation_id, presigned_url):
-    SESSION_TABLE_NAME = retrieve_environment_variables("SESSION_TABLE_NAME")
-    response = dynamodb_resource.Table(SESSION_TABLE_NAME).update_item(
-        Key={
-            'conversation_id': conversation_id
-        },
-        UpdateExpression='SET presigned_url = :url, session_update_time = :update_time',
-        ExpressionAttributeValues={
-            ':url': presigned_url,
-            ':update_time': datetime.datetime.now(tz=datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
-        },
-        ReturnValues="UPDATED_NEW"
-    )
-
-    return response
+    persistence.update_session(conversation_id, presigned_url)
 
 
 # Store content in S3
 def store_in_s3(content, content_type):
-    S3_BUCKET_NAME = retrieve_environment_variables("S3_BUCKET_NAME")
-    print(f"Bucket Name: {S3_BUCKET_NAME}")
-    current_datetime = datetime.datetime.now(tz=datetime.timezone.utc)
-    current_datetime = current_datetime.strftime("%Y%m%d-%H%M%S")
-    object_name = f"{st.session_state['conversation_id']}/{content_type}-{current_datetime}.md"
-    s3_client.put_object(Body=content, Bucket=S3_BUCKET_NAME, Key=object_name)
+    # Uploaded in the background, see artifact_store.py
+    artifact_store.put(st.session_state['conversation_id'], content_type, content)
 
 
 # Zip files in S3 pertaining to conversation
@@ -291,9 +423,14 @@ def create_artifacts_zip(object_name):
     Path(f"{tmpdir}/{conversation_id}").mkdir(parents=True, exist_ok=True)
     print(f"Created directory: {tmpdir}/{conversation_id}")
 
+    # Artifacts still being uploaded in the background belong in the zip
+    artifact_store.flush(conversation_id)
+
     # download objects from S3 pertaining to the current conversation
     bucket = s3_resource.Bucket(S3_BUCKET_NAME)
-    conversation_artifacts = list(bucket.objects.filter(Prefix=conversation_id))
+    # Only the markdown artifacts are zipped, offloaded conversation payloads are skipped
+    conversation_artifacts = [
+        artifact for artifact in bucket.objects.filter(Prefix=conversation_id) if artifact.key.endswith(".md")]
     for artifact in conversation_artifacts:
         out_name = f"{tmpdir}/{conversation_id}/{artifact.key.split('/')[-1]}"
         bucket.download_file(artifact.key, out_name)
@@ -331,7 +468,7 @@ def enable_artifacts_download():
             tmp_transcript = ["# Transcript"]
             for interaction in st.session_state.interaction:
                 tmp_transcript.append(f"## {interaction['type']}")
-                tmp_transcript.append(f"{interaction['details']}")
+                tmp_transcript.append(f"{payload_store.text(interaction['details'])}")
             
             transcript = '\n\n'.join(str(x) for x in tmp_transcript)
             
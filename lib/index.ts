@@ -573,7 +573,24 @@ export class DevGeniusStack extends cdk.Stack {
             encryption: dynamodb.TableEncryptionV2.dynamoOwnedKey(),
             tableName: `${cdk.Stack.of(this).stackName}-session-table`,
             removalPolicy: cdk.RemovalPolicy.DESTROY,
-            billing: dynamodb.Billing.onDemand()
+            billing: dynamodb.Billing.onDemand(),
+            // Sessions of a user, newest first, for the session history. Sparse: session_user is set with the
+            // summary at the first prompt, so sessions without a prompt or an email are not indexed.
+            globalSecondaryIndexes: [
+                {
+                    indexName: "session_user-session_start_time-index",
+                    partitionKey: {
+                        name: "session_user",
+                        type: dynamodb.AttributeType.STRING
+                    },
+                    sortKey: {
+                        name: "session_start_time",
+                        type: dynamodb.AttributeType.STRING
+                    },
+                    projectionType: dynamodb.ProjectionType.INCLUDE,
+                    nonKeyAttributes: ["session_summary"]
+                }
+            ]
         })
 
         // Create VPC for hosting Streamlit application in ECS